@@ -0,0 +1,257 @@
+import argparse
+import csv
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+from itertools import product
+from typing import Dict, List, Tuple
+
+from simulation.simulation import Simulation
+from simulation.slice import SliceConfiguration
+from simulation.user import UserConfiguration
+from simulation.sestore import SETrial
+from simulation.latency import LatencyHistogram
+from simulation.sacactor import SACActor
+from simulation import intersched, intrasched
+
+slice_types = ["eMBB", "URLLC", "BE"] # Repeated in this order when there are more than 3 slices
+
+param_columns = ["scheduler", "engine", "users_per_slice", "n_slices", "max_lat", "window_max", "bandwidth"]
+result_columns = [
+    "n_users",
+    "n_rbgs",
+    "TTIs", # Timed TTIs per repeat
+    "repeats",
+    "best_s", # Fastest repeat
+    "median_s",
+    "ttis_per_s", # From the fastest repeat
+    "median_ttis_per_s",
+    "us_per_user_tti", # From the fastest repeat
+    "schedule_p50_us", # Inter-slice scheduling time per TTI, over every repeat
+    "schedule_p99_us",
+]
+run_columns = ["commit", "timestamp", "python", "numpy"]
+columns = param_columns + result_columns + run_columns
+
+def get_slice_config(slice_type: str, max_lat: int) -> SliceConfiguration:
+    # Same requirements and flows as create_simulation in main.py
+    if slice_type == "eMBB":
+        requirements = {"latency": 20, "throughput": 10e6, "pkt_loss": 0.2}
+        pkt_size, flow_throughput = 1500*8, 15e6
+    elif slice_type == "URLLC":
+        requirements = {"latency": 1, "throughput": 1e6, "pkt_loss": 1e-5}
+        pkt_size, flow_throughput = 500*8, 1e6
+    elif slice_type == "BE":
+        requirements = {"long_term_thr": 5e6, "fifth_perc_thr": 2e6}
+        pkt_size, flow_throughput = 1500*8, 15e6
+    else:
+        raise Exception("Slice type {} is not valid".format(slice_type))
+    return SliceConfiguration(
+        type=slice_type,
+        requirements=requirements,
+        user_config=UserConfiguration(
+            max_lat=max_lat, # TTIs
+            buffer_size=32*1024*8, # bits
+            pkt_size=pkt_size, # bits
+            flow_type="poisson",
+            flow_throughput=flow_throughput, # bits/s
+        )
+    )
+
+def create_benchmark_simulation(
+    scheduler: str, # SOA, RR or DRL
+    engine: str,
+    users_per_slice: int,
+    n_slices: int,
+    max_lat: int,
+    window_max: int,
+    bandwidth: float, # Hz
+    seed: int = 1,
+    sac_agent = None, # Required by DRL
+) -> Tuple[Simulation, int]:
+    sim = Simulation(
+        option_5g=0, # TTI = 1ms
+        rbs_per_rbg=4,
+        experiment_name="benchmark"
+    )
+    if scheduler == "SOA":
+        inter_scheduler = intersched.StepwiseOptimalAlgorithm(
+            rb_bandwidth=sim.rb_bandwidth,
+            rbs_per_rbg=sim.rbs_per_rbg,
+            window_max=window_max,
+        )
+    elif scheduler == "RR":
+        inter_scheduler = intersched.RoundRobin()
+    elif scheduler == "DRL":
+        inter_scheduler = intersched.SAC(
+            window_max=window_max,
+            TTI=sim.TTI,
+            best_model_zip_path="./best_sac/best_model.zip",
+            agent=sac_agent,
+        )
+    else:
+        raise Exception("Scheduler {} is not valid (must be SOA, RR or DRL)".format(scheduler))
+    bs_id = sim.add_basestation(
+        inter_scheduler=inter_scheduler,
+        rbs_per_rbg=sim.rbs_per_rbg,
+        bandwidth=bandwidth,
+        seed=seed,
+        name=scheduler,
+        window_max=window_max,
+        engine=engine,
+    )
+    for i in range(n_slices):
+        slice_id = sim.add_slice(
+            basestation_id=bs_id,
+            slice_config=get_slice_config(slice_types[i % len(slice_types)], max_lat),
+            intra_scheduler=intrasched.RoundRobin()
+        )
+        sim.add_users(
+            basestation_id=bs_id,
+            slice_id=slice_id,
+            n_users=users_per_slice
+        )
+    return sim, bs_id
+
+def get_synthetic_se(n_users: int, TTIs: int, seed: int = 1) -> SETrial:
+    # Spans the range of the SE dataset (bits/s/Hz), so it is not needed to run the benchmark
+    rng = np.random.default_rng(seed)
+    return SETrial(se=rng.uniform(0.2, 6.0, size=(n_users, TTIs)), multipliers=np.ones(n_users))
+
+def run_ttis(sim: Simulation, bs_id: int, SEs: SETrial, TTIs: int) -> None:
+    users = sim.basestations[bs_id].users
+    for _ in range(TTIs):
+        for u in users.values():
+            u.set_spectral_efficiency(SEs.get(u.id, u.step))
+        sim.arrive_packets()
+        sim.schedule_rbgs()
+        sim.transmit()
+
+def run_config(params: Dict, TTIs: int, warmup: int, repeats: int, seed: int, sac_agent = None) -> Dict:
+    times = []
+    schedule_latency = LatencyHistogram()
+    for _ in range(repeats): # A new simulation per repeat, so every repeat times the same TTIs
+        sim, bs_id = create_benchmark_simulation(**params, seed=seed, sac_agent=sac_agent)
+        bs = sim.basestations[bs_id]
+        SEs = get_synthetic_se(len(bs.users), warmup + TTIs, seed)
+        run_ttis(sim, bs_id, SEs, warmup) # Fills the windows used by the metrics
+        bs.scheduler_latency = LatencyHistogram(deadline=sim.TTI) # Only the timed TTIs
+        start = time.perf_counter()
+        run_ttis(sim, bs_id, SEs, TTIs)
+        times.append(time.perf_counter() - start)
+        schedule_latency.add(bs.scheduler_latency)
+    best, median = min(times), float(np.median(times))
+    return {
+        "n_users": len(bs.users),
+        "n_rbgs": len(bs.rbgs),
+        "TTIs": TTIs,
+        "repeats": repeats,
+        "best_s": best,
+        "median_s": median,
+        "ttis_per_s": TTIs/best,
+        "median_ttis_per_s": TTIs/median,
+        "us_per_user_tti": best/TTIs/len(bs.users)*1e6,
+        "schedule_p50_us": schedule_latency.get_percentile(50)/1e3,
+        "schedule_p99_us": schedule_latency.get_percentile(99)/1e3,
+    }
+
+def get_run_info() -> Dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.decode().strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+
+def get_config_key(row: Dict) -> Tuple:
+    return (
+        row["scheduler"],
+        row["engine"],
+        int(row["users_per_slice"]),
+        int(row["n_slices"]),
+        int(row["max_lat"]),
+        int(row["window_max"]),
+        float(row["bandwidth"]),
+    )
+
+def read_baseline(baseline_file: str) -> Dict[Tuple, float]: # Last TTIs/s of each configuration
+    baseline = {}
+    with open(baseline_file, newline="") as f:
+        for row in csv.DictReader(f):
+            baseline[get_config_key(row)] = float(row["ttis_per_s"])
+    return baseline
+
+def positive_int(value: str) -> int:
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError("{} is not >= 1".format(value))
+    return n
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures the simulated TTIs per second over a grid of simulation sizes and schedulers")
+    parser.add_argument("--schedulers", nargs="+", default=["SOA", "RR"], choices=["SOA", "RR", "DRL"])
+    parser.add_argument("--engines", nargs="+", default=["object"], choices=["object", "pool"])
+    parser.add_argument("--users-per-slice", type=int, nargs="+", default=[1, 5, 10, 20])
+    parser.add_argument("--slices", type=int, nargs="+", default=[3])
+    parser.add_argument("--max-lats", type=int, nargs="+", default=[100], help="TTIs")
+    parser.add_argument("--window-maxes", type=int, nargs="+", default=[10])
+    parser.add_argument("--bandwidths", type=float, nargs="+", default=[100e6], help="Hz")
+    parser.add_argument("--TTIs", type=positive_int, default=500)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument("--repeats", type=positive_int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="./experiment_data/benchmark_results.csv")
+    parser.add_argument("--baseline", default=None, help="Previous results to compare the TTIs/s with")
+    parser.add_argument("--best-model", default="./best_sac/best_model.zip")
+    args = parser.parse_args()
+
+    configs = [
+        dict(zip(param_columns, config)) for config in product(
+            args.schedulers, args.engines, args.users_per_slice, args.slices,
+            args.max_lats, args.window_maxes, args.bandwidths,
+        )
+    ]
+    sac_agent = None
+    if "DRL" in args.schedulers:
+        sac_agent = SACActor.load(args.best_model)
+        # The agent was trained with one slice of each type
+        skipped = [c for c in configs if c["scheduler"] == "DRL" and c["n_slices"] != len(slice_types)]
+        if len(skipped) > 0:
+            print("Skipping {} DRL configurations without exactly {} slices".format(len(skipped), len(slice_types)))
+        configs = [c for c in configs if c not in skipped]
+    baseline = read_baseline(args.baseline) if args.baseline is not None else {}
+    run_info = get_run_info()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    write_header = not os.path.exists(args.output)
+    with open(args.output, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        if write_header:
+            writer.writeheader()
+        for config in configs:
+            row = dict(config)
+            row.update(run_config(config, args.TTIs, args.warmup, args.repeats, args.seed, sac_agent))
+            row.update(run_info)
+            writer.writerow(row)
+            f.flush() # Keeps the finished configurations if the benchmark is interrupted
+            line = "{:<4} {:<7} {:>3} users/slice {:>2} slices max_lat {:>4} window {:>3} {:>4} RBGs: {:>9.1f} TTIs/s ({:.1f} us/user/TTI, scheduling p50 {:.1f} us p99 {:.1f} us)".format(
+                config["scheduler"], config["engine"], config["users_per_slice"], config["n_slices"],
+                config["max_lat"], config["window_max"], row["n_rbgs"], row["ttis_per_s"], row["us_per_user_tti"],
+                row["schedule_p50_us"], row["schedule_p99_us"],
+            )
+            key = get_config_key(row)
+            if key in baseline:
+                line += " {:.2f}x baseline".format(row["ttis_per_s"]/baseline[key])
+            print(line)
+    print("Results saved in {}".format(args.output))
@@ -1,6 +1,5 @@
-import pickle
+from simulation.results import load_results
 import sys
-import numpy as np
 
 if __name__ == "__main__":
     if len(sys.argv) != 2 or sys.argv[1] not in ["full", "standard", "minimum"]:
@@ -8,15 +7,24 @@ if __name__ == "__main__":
         print("Experiment name must be standard, full, or minimum")
         exit(1)
 
-    sim_data_file = open("experiment_data/{}_experiment_data.pickle".format(sys.argv[1]), "rb")
-    sim = pickle.load(sim_data_file)
-    sim_data_file.close()
+    sim = load_results("experiment_data/{}_experiment_data.npz".format(sys.argv[1]))
 
-    for bs in sim.basestations.values():
-        
-        print("Scheduling time for {} - Min: {:.2f}ms - Avg: {:.2f}ms - Max: {:.2f}ms".format(
-            bs.name,
-            np.min(bs.scheduler_elapsed_time)*1e3,
-            np.mean(bs.scheduler_elapsed_time)*1e3,
-            np.max(bs.scheduler_elapsed_time)*1e3,
-        ))
\ No newline at end of file
+    # Read from the latency histograms, so the report does not depend on the run length
+    names = [bs.name for bs in sim.basestations.values()]
+    summaries = [bs.scheduler_latency.get_summary() for bs in sim.basestations.values()]
+    rows = [
+        ("TTIs", "count", "{:d}"),
+        ("Min (ms)", "min_ms", "{:.3f}"),
+        ("Avg (ms)", "mean_ms", "{:.3f}"),
+        ("p50 (ms)", "p50_ms", "{:.3f}"),
+        ("p90 (ms)", "p90_ms", "{:.3f}"),
+        ("p99 (ms)", "p99_ms", "{:.3f}"),
+        ("p99.9 (ms)", "p99.9_ms", "{:.3f}"),
+        ("Max (ms)", "max_ms", "{:.3f}"),
+        ("Deadline misses", "deadline_misses", "{:d}"),
+        ("Deadline miss ratio", "deadline_miss_ratio", "{:.2%}"),
+    ]
+    print("Scheduling time per basestation (deadline: TTI of {:.4f}ms)".format(sim.TTI*1e3))
+    print("{:<20}".format("") + "".join("{:>12}".format(name) for name in names))
+    for label, key, fmt in rows:
+        print("{:<20}".format(label) + "".join("{:>12}".format(fmt.format(s[key])) for s in summaries))
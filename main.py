@@ -1,7 +1,7 @@
 import sys
 import numpy as np
 from tqdm import tqdm
-from typing import List, Dict
+from typing import List, Dict, Tuple
 import time 
 
 from simulation.user import UserConfiguration, User
@@ -9,6 +9,10 @@ from simulation.slice import SliceConfiguration
 from simulation.basestation import BaseStation
 from simulation.simulation import Simulation
 from simulation.plotter import Plotter
+from simulation.sestore import SEStore, SETrial
+from simulation.results import export_results
+from simulation.metricsink import MetricsSink
+from simulation.profiler import PhaseProfiler
 
 # def print_slice_avg_metrics(bs: BaseStation, window: int):
 #     print("\nAverage metrics for basestation {}".format(bs.id))
@@ -58,13 +62,12 @@ from simulation.plotter import Plotter
 #         user, metric = s.get_worst_user_pkt_loss(window)
 #         print("Maximum packet loss rate for the last {}ms: user {} with {:.2f}%".format(window, user, metric*100)) # [0,1] -> %
 
-if __name__ == "__main__":
-    
-    if len(sys.argv) != 2 or sys.argv[1] not in ["full", "standard", "minimum"]:
-        print("Usage: python main.py <experiment_name>")
-        print("Experiment name must be standard, full, or minimum")
-        exit(1)
-
+def create_simulation(
+    experiment_name: str,
+    seed: int = 1, # For generating random numbers
+    load_multiplier: float = 1.0, # Multiplies the throughput of every flow
+    sac_agent = None, # Already loaded SAC agent (None loads it from best_sac)
+) -> Tuple[Simulation, List[int]]:
     # Configuring slices
     embb_config = SliceConfiguration(
         type="eMBB",
@@ -78,7 +81,7 @@ if __name__ == "__main__":
             buffer_size= 32*1024*8,#1024*2048*8, # bits
             pkt_size=1500*8, # bits
             flow_type="poisson",
-            flow_throughput=15e6, # bits/s
+            flow_throughput=15e6*load_multiplier, # bits/s
         )
     )
 
@@ -94,7 +97,7 @@ if __name__ == "__main__":
             buffer_size=32*1024*8, #1024*2048*8, # bits
             pkt_size=500*8, # bits
             flow_type="poisson",
-            flow_throughput=1e6, # bits/s
+            flow_throughput=1e6*load_multiplier, # bits/s
         )
     )
     
@@ -109,7 +112,7 @@ if __name__ == "__main__":
             buffer_size=32*1024*8, #1024*2048*8, # bits
             pkt_size=1500*8, # bits
             flow_type="poisson",
-            flow_throughput=15e6, # bits/s
+            flow_throughput=15e6*load_multiplier, # bits/s
         )
     )
 
@@ -118,7 +121,7 @@ if __name__ == "__main__":
     sim = Simulation(
         option_5g=0, # TTI = 1ms
         rbs_per_rbg=4,
-        experiment_name=sys.argv[1]
+        experiment_name=experiment_name
     )
     
     from simulation import intersched, intrasched
@@ -148,7 +151,7 @@ if __name__ == "__main__":
         ),
         rbs_per_rbg=sim.rbs_per_rbg,
         bandwidth=100e6, # 100MHz
-        seed = 1, # For generating random numbers
+        seed = seed, # For generating random numbers
         name = "SOA",
         window_max=10,
     )
@@ -157,7 +160,7 @@ if __name__ == "__main__":
         inter_scheduler=intersched.RoundRobin(),
         rbs_per_rbg=sim.rbs_per_rbg,
         bandwidth=100e6, # 100MHz
-        seed = 1, # For generating random numbers
+        seed = seed, # For generating random numbers
         name = "RR",
         window_max=10,
     )
@@ -166,11 +169,12 @@ if __name__ == "__main__":
         inter_scheduler=intersched.SAC(
             window_max=10,
             TTI=sim.TTI,
-            best_model_zip_path="./best_sac/best_model.zip"
+            best_model_zip_path="./best_sac/best_model.zip",
+            agent=sac_agent,
         ),
         rbs_per_rbg=sim.rbs_per_rbg,
         bandwidth=100e6, # 100MHz
-        seed = 1, # For generating random numbers
+        seed = seed, # For generating random numbers
         name = "DRL",
         window_max=10,
     )
@@ -220,47 +224,23 @@ if __name__ == "__main__":
         #print("Basestation {} users: {}".format(sim.basestations[bs_id].name, list(sim.basestations[bs_id].users.keys())))
         #print("Basestation {} slices: {}".format(sim.basestations[bs_id].name, list(sim.basestations[bs_id].slices.keys())))
     
-    # Loading the spectral efficiency for each user
-    SEs:Dict[int, List[float]] = dict()
-    SE_trial = 46 # 1, ..., 50
-    SE_sub_carrier = 2 # 1, 2
-    SE_file_base_string = "se/trial{}_f{}_ue{}.npy"
 
-    SE_multipliers = {
-        1: 1.0,
-        2: 1.0,
-        3: 1.0,
-        4: 2.0,
-        5: 2.0,
-        6: 2.0,
-        7: 2.0,
-        8: 2.0,
-        9: 2.0,
-        10: 2.0,
-    }
-    # SE_multipliers = {
-    #     1: 1.0,
-    #     2: 1.0,
-    #     3: 1.0,
-    #     4: 1.0,
-    #     5: 1.0,
-    #     6: 1.0,
-    #     7: 1.0,
-    #     8: 1.0,
-    #     9: 1.0,
-    #     10: 1.0,
-    # }
+    return sim, bs_ids
 
-    for u in range(10):
-        SE_file_string = SE_file_base_string.format(SE_trial, SE_sub_carrier, u+1)
-        SEs[u] = list(np.load(SE_file_string)*SE_multipliers[u+1])
-    
-    def set_users_spectral_efficiency(users:Dict[int, User], SEs: Dict[int, List[float]]):
-        for u in users.values():
-            u.set_spectral_efficiency(SEs[u.id][u.step])
-            #u.set_spectral_efficiency(1.0)
-    
+def set_users_spectral_efficiency(users:Dict[int, User], SEs: SETrial):
+    for u in users.values():
+        u.set_spectral_efficiency(SEs.get(u.id, u.step))
+        #u.set_spectral_efficiency(1.0)
 
+def run_experiment(
+    sim: Simulation,
+    bs_ids: List[int], # SOA, RR and DRL basestations
+    SEs: SETrial,
+    TTIs: int = 2000,
+    parallel: bool = False, # Each basestation in its own process
+    progress: bool = True,
+) -> None:
+    optheur_bs, rr_bs, sac_bs = bs_ids
     # print("Creating combinations of choices for the sac agent...")
     # sim.basestations[sac_bs].scheduler.create_combinations(
     #     n_rbgs=len(sim.basestations[sac_bs].rbgs),
@@ -268,17 +248,21 @@ if __name__ == "__main__":
     # )
     # print("Finished!")
 
-    # Running 2000 TTIs = 2s
-    TTIs = 2000
-    if sim.experiment_name in ["standard", "full"]:
-        for _ in tqdm(range(TTIs), leave=False, desc="TTIs"):
+    if parallel:
+        sim.run_parallel(
+            TTIs=TTIs,
+            SEs=SEs,
+            limiting_basestation_id=optheur_bs if sim.experiment_name == "minimum" else None,
+        )
+    elif sim.experiment_name in ["standard", "full"]:
+        for _ in tqdm(range(TTIs), leave=False, desc="TTIs", disable=not progress):
             for bs_id in bs_ids:
                 set_users_spectral_efficiency(users=sim.basestations[bs_id].users, SEs=SEs)
             sim.arrive_packets()
             sim.schedule_rbgs()
             sim.transmit()
     elif sim.experiment_name == "minimum": # Minimum RBGs for every agent
-        for _ in tqdm(range(TTIs), leave=False, desc="TTIs"):
+        for _ in tqdm(range(TTIs), leave=False, desc="TTIs", disable=not progress):
             for bs_id in bs_ids:
                 set_users_spectral_efficiency(users=sim.basestations[bs_id].users, SEs=SEs)
             
@@ -289,32 +273,16 @@ if __name__ == "__main__":
             n_lim_rbgs = sum(len(s.rbgs) for s in sim.basestations[optheur_bs].slices.values())
 
             # Round robin
-            start = time.time()
-            sim.basestations[rr_bs].scheduler.schedule(
-                slices=sim.basestations[rr_bs].slices,
-                users=sim.basestations[rr_bs].users,
-                rbgs=sim.basestations[rr_bs].rbgs[:n_lim_rbgs] # Limited RBGs
-            )
-            sim.basestations[rr_bs].scheduler_elapsed_time.append(time.time() - start)
-            for s in sim.basestations[rr_bs].slices.values():
-                s.schedule_rbgs()
+            sim.basestations[rr_bs].schedule_rbgs(n_rbgs=n_lim_rbgs) # Limited RBGs
             
             # SAC
-            start = time.time()
-            sim.basestations[sac_bs].scheduler.schedule(
-                slices=sim.basestations[sac_bs].slices,
-                users=sim.basestations[sac_bs].users,
-                rbgs=sim.basestations[sac_bs].rbgs[:n_lim_rbgs] # Limited RBGs
-            )
-            sim.basestations[sac_bs].scheduler_elapsed_time.append(time.time() - start)
-            for s in sim.basestations[sac_bs].slices.values():
-                s.schedule_rbgs()
+            sim.basestations[sac_bs].schedule_rbgs(n_rbgs=n_lim_rbgs) # Limited RBGs
             # print("Reward:", sim.basestations[sac_bs].calculate_reward())
 
             sim.transmit()
             
     # Removed because the optimal scheduler is not used
-    # for _ in tqdm(range(TTIs), leave=False, desc="TTIs"):
+    # for _ in tqdm(range(TTIs), leave=False, desc="TTIs", disable=not progress):
     #     for bs_id in bs_ids:
     #         set_users_spectral_efficiency(users=sim.basestations[bs_id].users, SEs=SEs)
     #     # bs_id = 0
@@ -359,15 +327,89 @@ if __name__ == "__main__":
     #     # #print_slice_avg_metrics(bs=sim.basestations[bs_id], window=10) # 10ms window
     #     # print_slice_worst_metrics(bs=sim.basestations[bs_id], window=10) # 10ms window
 
+
+if __name__ == "__main__":
+    
+    if len(sys.argv) not in [2, 3] or sys.argv[1] not in ["full", "standard", "minimum"] or (len(sys.argv) == 3 and sys.argv[2] not in ["parallel", "profile"]):
+        print("Usage: python main.py <experiment_name> [parallel|profile]")
+        print("Experiment name must be standard, full, or minimum")
+        print("parallel runs each basestation in its own process")
+        print("profile measures the time of each phase of the TTIs")
+        exit(1)
+    parallel = len(sys.argv) == 3 and sys.argv[2] == "parallel"
+    profiler = PhaseProfiler() if len(sys.argv) == 3 and sys.argv[2] == "profile" else None
+
+    sim, bs_ids = create_simulation(sys.argv[1])
+    optheur_bs, rr_bs, sac_bs = bs_ids
+
+    # Loading the spectral efficiency for each user
+    SE_trial = 46 # 1, ..., 50
+    SE_sub_carrier = 2 # 1, 2
+
+    SE_multipliers = {
+        1: 1.0,
+        2: 1.0,
+        3: 1.0,
+        4: 2.0,
+        5: 2.0,
+        6: 2.0,
+        7: 2.0,
+        8: 2.0,
+        9: 2.0,
+        10: 2.0,
+    }
+    # SE_multipliers = {
+    #     1: 1.0,
+    #     2: 1.0,
+    #     3: 1.0,
+    #     4: 1.0,
+    #     5: 1.0,
+    #     6: 1.0,
+    #     7: 1.0,
+    #     8: 1.0,
+    #     9: 1.0,
+    #     10: 1.0,
+    # }
+
+    SEs = SEStore(multipliers=SE_multipliers).get_trial(SE_trial, SE_sub_carrier)
+
+    import os
+    os.makedirs("./experiment_data/", exist_ok=True)
+
+    # Streaming the histories to disk while running, so they survive an interrupted run
+    metrics_sink = None
+    metrics_path = "./experiment_data/{}_metrics.bin".format(sim.experiment_name)
+    if os.path.exists(metrics_path): # Also in parallel runs, so a stale file is not taken for their metrics
+        os.remove(metrics_path)
+    if not parallel: # The sink lives in this process
+        metrics_sink = MetricsSink(metrics_path)
+        sim.set_metrics_sink(metrics_sink)
+    if profiler is not None:
+        sim.set_profiler(profiler)
+
+    # Running 2000 TTIs = 2s
+    try:
+        run_experiment(sim, bs_ids, SEs, TTIs=2000, parallel=parallel)
+    finally:
+        if metrics_sink is not None:
+            sim.remove_metrics_sink()
+            metrics_sink.close()
+        if profiler is not None:
+            sim.remove_profiler()
+
+    if profiler is not None:
+        profile_path = "./experiment_data/{}_profile.npz".format(sim.experiment_name)
+        profiler.save(profile_path)
+        print("\nTime per TTI phase (basestations {})".format(", ".join(
+            "{}: {}".format(bs_id, sim.basestations[bs_id].name) for bs_id in bs_ids)))
+        profiler.print_summary()
+        print("Per-TTI times saved in {}".format(profile_path))
+
     # Saving simulation data
     sim.basestations[sac_bs].action_set = sim.basestations[sac_bs].scheduler.action_set
     sim.basestations[sac_bs].raw_action_set = sim.basestations[sac_bs].scheduler.raw_action_set
     sim.basestations[sac_bs].scheduler = None
-    import pickle, os
-    os.makedirs("./experiment_data/", exist_ok=True)
-    path = "./experiment_data/{}_experiment_data.pickle".format(sim.experiment_name)
-    sim_data_file = open(path, "wb")
-    pickle.dump(sim, file=sim_data_file)
-    sim_data_file.close()
+    path = "./experiment_data/{}_experiment_data.npz".format(sim.experiment_name)
+    export_results(sim, path)
     print("\nData saved in {}. Plot the simulation metrics with:".format(path))
     print("python plot_metrics.py {}".format(sim.experiment_name))
\ No newline at end of file
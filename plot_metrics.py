@@ -1,5 +1,5 @@
 from simulation.plotter import Plotter
-import pickle
+from simulation.results import load_results
 import sys
 
 if __name__ == "__main__":
@@ -37,9 +37,7 @@ if __name__ == "__main__":
     density=20
     
     print("Plotting metrics...")
-    sim_data_file = open("experiment_data/{}_experiment_data.pickle".format(sys.argv[1]), "rb")
-    sim = pickle.load(sim_data_file)
-    sim_data_file.close()
+    sim = load_results("experiment_data/{}_experiment_data.npz".format(sys.argv[1]))
     import numpy as np
     for bs in sim.basestations.values():
         print(bs.name, "RBG allocation stats:")
@@ -1,4 +1,4 @@
-import pickle
+from simulation.results import load_results
 import sys
 
 from simulation.plotter import Plotter
@@ -9,9 +9,7 @@ if __name__ == "__main__":
         print("Experiment name must be standard, full, or minimum")
         exit(1)
     
-    sim_data_file = open("experiment_data/{}_experiment_data.pickle".format(sys.argv[1]), "rb")
-    sim = pickle.load(sim_data_file)
-    sim_data_file.close()
+    sim = load_results("experiment_data/{}_experiment_data.npz".format(sys.argv[1]))
     plotter = Plotter(sim)
 
     #trials = [7, 18, 20, 27, 29, 30, 36, 37, 46, 50]
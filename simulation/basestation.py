@@ -10,8 +10,20 @@ from simulation.slice import Slice, SliceConfiguration
 from simulation.user import User
 from  simulation.intrasched import IntraSliceScheduler
 from simulation.intersched import InterSliceScheduler
+from simulation.history import HistoryConfiguration
+from simulation.userpool import UserPool
+from simulation.metricsink import MetricsSink
+from simulation.profiler import PhaseProfiler
+from simulation.latency import LatencyHistogram
 
 class BaseStation:
+    hist_names = [
+        "hist_n_allocated_RBGs",
+        "scheduler_elapsed_time",
+        "hist_agent_reward",
+        "hist_agent_reward_cumulative",
+    ]
+
     def __init__(
         self,
         id: int,
@@ -21,14 +33,28 @@ class BaseStation:
         scheduler: InterSliceScheduler,
         rng:np.random.BitGenerator,
         window_max: int,
+        history_config: HistoryConfiguration = None,
+        engine: str = "object", # "object" (one User per user) or "pool" (NumPy UserPool)
+        user_seed_sequence: np.random.SeedSequence = None, # Per-user rng streams instead of sharing rng
+        record_scheduler_times: bool = False, # Also keeps every scheduling time in scheduler_elapsed_time (one entry per TTI)
     ) -> None:
+        if engine not in ["object", "pool"]:
+            raise Exception("Engine {} is not valid (must be object or pool)".format(engine))
+        if engine == "pool" and history_config is not None:
+            raise Exception("History retention is not supported by the pool engine")
         self.id = id
         self.name = name
         self.TTI = TTI
         self.rb_bandwidth = rb_bandwidth
         self.scheduler = scheduler
         self.rng = rng
+        self.user_seed_sequence = user_seed_sequence
         self.window_max = window_max
+        # Each basestation spills its users' histories to its own subdirectory
+        self.history_config = history_config.for_subdir(name) if history_config is not None else None
+        self.engine = engine
+        self.record_scheduler_times = record_scheduler_times
+        self.pool = UserPool(TTI=TTI, rng=rng, window_max=window_max) if engine == "pool" else None
         self.step = 0
         self.slices: Dict[int, Slice] = {}
         self.users: Dict[int, User] = {}
@@ -38,9 +64,13 @@ class BaseStation:
         self.window = 1
         self.cumulative_reward = 0.0
         self.hist_n_allocated_RBGs: List[int] = []
-        self.scheduler_elapsed_time: List[float] = []
+        self.scheduler_elapsed_time: List[float] = [] # Empty unless record_scheduler_times
+        self.scheduler_latency = LatencyHistogram(deadline=TTI) # Every scheduling time, in fixed memory
         self.hist_agent_reward: List[float] = []
         self.hist_agent_reward_cumulative: List[float] = []
+        self.metrics_sink: MetricsSink = None
+        self.metrics_prefix: str = None
+        self.profiler: PhaseProfiler = None
 
     def reset(self) -> None:
         self.step = 0
@@ -48,19 +78,105 @@ class BaseStation:
         self.cumulative_reward = 0.0
         self.hist_n_allocated_RBGs = []
         self.scheduler_elapsed_time = []
+        self.scheduler_latency = LatencyHistogram(deadline=self.TTI)
         self.hist_agent_reward: List[float] = []
         self.hist_agent_reward_cumulative: List[float] = []
+        if self.pool is not None:
+            self.pool.reset()
         for s in self.slices.values():
             s.reset()
         for u in self.users.values():
             u.reset()
 
+    def reseed(self, seed: int) -> None: # Same streams as a basestation created with this seed
+        # Reseeding in place also reseeds the users and flows that share the generators
+        self.rng.bit_generator.state = np.random.default_rng(seed).bit_generator.state
+        if self.user_seed_sequence is None:
+            return
+        self.user_seed_sequence = np.random.SeedSequence(seed)
+        for s in self.slices.values():
+            s.user_seed_sequence = self.user_seed_sequence
+            for u in s.users.values():
+                u.rng.bit_generator.state = s.get_user_rng(u.id).bit_generator.state
+
     def __hist_update_after_transmit(self) -> None:
-        self.hist_n_allocated_RBGs.append(sum(s.hist_n_allocated_RBGs[-1] for s in self.slices.values()))
+        if self.profiler is not None:
+            start = time.perf_counter_ns()
         reward = self.calculate_reward()
+        if self.profiler is not None:
+            rewarded = time.perf_counter_ns()
+            self.profiler.add(self.id, None, "calculate_reward", rewarded - start)
+        self.hist_n_allocated_RBGs.append(sum(s.hist_n_allocated_RBGs[-1] for s in self.slices.values()))
         self.cumulative_reward += reward
         self.hist_agent_reward.append(reward)
         self.hist_agent_reward_cumulative.append(self.cumulative_reward)
+        if self.metrics_sink is not None:
+            self.metrics_sink.push(self.metrics_prefix + "hist_n_allocated_RBGs", self.hist_n_allocated_RBGs[-1])
+            self.metrics_sink.push(self.metrics_prefix + "hist_agent_reward", reward)
+            self.metrics_sink.push(self.metrics_prefix + "hist_agent_reward_cumulative", self.cumulative_reward)
+        if self.profiler is not None:
+            self.profiler.add(self.id, None, "bs_hist_update", time.perf_counter_ns() - rewarded)
+
+    def set_metrics_sink(self, sink: MetricsSink) -> None: # Streams the histories from now on (call between TTIs)
+        self.metrics_sink = sink
+        self.metrics_prefix = "bs{}/".format(self.id)
+        for name in self.hist_names:
+            sink.push_many(self.metrics_prefix + name, getattr(self, name))
+        for slice_id, s in self.slices.items():
+            s.set_metrics_sink(sink, self.metrics_prefix + "slice{}/".format(slice_id))
+
+    def remove_metrics_sink(self) -> None:
+        self.metrics_sink = None
+        for s in self.slices.values():
+            s.metrics_sink = None
+            for u in s.users.values():
+                u.metrics_sink = None
+
+    def set_profiler(self, profiler: PhaseProfiler) -> None: # Profiles the TTIs from now on (call between TTIs)
+        self.profiler = profiler
+        if self.pool is not None:
+            self.pool.profiler = profiler
+            self.pool.profiler_bs_id = self.id
+        for s in self.slices.values():
+            s.set_profiler(profiler, self.id)
+
+    def remove_profiler(self) -> None:
+        self.set_profiler(None)
+
+    def snapshot(self, history_tail: int = None) -> Dict: # Between TTIs
+        # Windowed metrics look back at most window_max+1 entries
+        history_tail = max(history_tail, self.window_max + 1) if history_tail is not None else self.window_max + 1
+        snapshot = {name: getattr(self, name)[-history_tail:] for name in self.hist_names}
+        snapshot.update({
+            "step": self.step,
+            "window": self.window,
+            "cumulative_reward": self.cumulative_reward,
+            "rng": self.rng.bit_generator.state,
+            "scheduler": self.scheduler.snapshot(),
+            "scheduler_latency": self.scheduler_latency.snapshot(),
+            "pool": self.pool.snapshot(history_tail) if self.pool is not None else None,
+            "slices": {id: s.snapshot(history_tail) for id, s in self.slices.items()},
+        })
+        return snapshot
+
+    def restore(self, snapshot: Dict) -> None:
+        if set(snapshot["slices"]) != set(self.slices):
+            raise Exception("Snapshot slices {} do not match the slices {} of basestation {}".format(
+                sorted(snapshot["slices"]), sorted(self.slices), self.id))
+        if (snapshot["pool"] is None) != (self.pool is None):
+            raise Exception("Snapshot engine does not match the {} engine of basestation {}".format(self.engine, self.id))
+        for name in self.hist_names:
+            setattr(self, name, list(snapshot[name]))
+        self.step = snapshot["step"]
+        self.window = snapshot["window"]
+        self.cumulative_reward = snapshot["cumulative_reward"]
+        self.rng.bit_generator.state = snapshot["rng"]
+        self.scheduler.restore(snapshot["scheduler"])
+        self.scheduler_latency.restore(snapshot["scheduler_latency"])
+        if self.pool is not None:
+            self.pool.restore(snapshot["pool"])
+        for id, s in self.slices.items():
+            s.restore(snapshot["slices"][id])
 
     def add_slice(
         self,
@@ -74,6 +190,9 @@ class BaseStation:
             TTI=self.TTI,
             rng=self.rng,
             window_max=self.window_max,
+            history_config=self.history_config,
+            pool=self.pool,
+            user_seed_sequence=self.user_seed_sequence,
         )
         self.slice_id += 1
         return self.slice_id -1
@@ -105,12 +224,21 @@ class BaseStation:
         return u_ids
 
     def arrive_pkts(self) -> None:
+        if self.pool is not None:
+            if self.profiler is not None:
+                start = time.perf_counter_ns()
+            self.pool.arrive_pkts()
+            if self.profiler is not None:
+                self.profiler.add(self.id, None, "arrive_pkts", time.perf_counter_ns() - start)
+            return
         for s in self.slices.values():
             s.arrive_pkts()
 
     def transmit(self) -> None:
         if len(self.rbgs) == 0:
             raise Exception("Basestation {} cannot transmit because it has no RBGs".format(self.id))
+        if self.pool is not None:
+            self.pool.transmit()
         for s in self.slices.values():
             s.transmit()
         self.step += 1
@@ -118,17 +246,31 @@ class BaseStation:
         if self.window > self.window_max:
             self.window = self.window_max
         self.__hist_update_after_transmit()
+        if self.profiler is not None:
+            self.profiler.end_tti(self.id)
     
-    def schedule_rbgs(self) -> None:
-        start = time.time()
+    def schedule_rbgs(self, n_rbgs: int = None) -> None: # n_rbgs limits the scheduler to the first RBGs
+        start = time.perf_counter_ns()
         self.scheduler.schedule(
             slices=self.slices,
             users=self.users,
-            rbgs=self.rbgs
+            rbgs=self.rbgs if n_rbgs is None else self.rbgs[:n_rbgs]
         )
-        self.scheduler_elapsed_time.append(time.time() - start)
+        elapsed = time.perf_counter_ns() - start
+        if self.record_scheduler_times:
+            self.scheduler_elapsed_time.append(elapsed*1e-9) # s
+        self.scheduler_latency.record(elapsed)
+        if self.metrics_sink is not None:
+            self.metrics_sink.push(self.metrics_prefix + "scheduler_elapsed_time", elapsed*1e-9)
+        if self.profiler is None:
+            for s in self.slices.values():
+                s.schedule_rbgs()
+            return
+        self.profiler.add(self.id, None, "inter_schedule", elapsed)
         for s in self.slices.values():
+            start = time.perf_counter_ns()
             s.schedule_rbgs()
+            self.profiler.add(self.id, s.type, "intra_schedule", time.perf_counter_ns() - start)
 
     def calculate_reward(self) -> float:
         w_embb_thr = 0.2
@@ -3,9 +3,10 @@ from collections import deque
 import numpy as np 
 from abc import ABC, abstractmethod
 
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 from simulation.packet import Packet
 from simulation.jsonencoder import Encoder
+from simulation.history import get_spill_file, trim_history, remove_spill_file, load_history
 
 class BufferConfiguration:
     def __init__(
@@ -20,42 +21,146 @@ class BufferConfiguration:
         self.pkt_size = pkt_size
 
 class DiscreteBuffer():
+    hist_names = [ # Histories trimmed by the retention policy
+        "hist_dropp_max_lat_pkts",
+        "hist_dropp_buffer_full_pkts",
+        "hist_arriv_pkts",
+        "hist_sent_pkts",
+        "hist_buff_pkts",
+    ]
+    cum_names = [ # Prefix sums of the histories
+        "cum_dropp_max_lat_pkts",
+        "cum_dropp_buffer_full_pkts",
+        "cum_arriv_pkts",
+        "cum_sent_pkts",
+    ]
+
     def __init__(
         self,
         TTI: float, # s
         config: BufferConfiguration,
+        hist_retention: int = None, # TTIs of history kept in memory (None keeps the whole run)
+        spill_prefix: str = None, # Path prefix of the files receiving the discarded history
     ) -> None:
         self.TTI = TTI
+        self.hist_retention = hist_retention
+        self.spill_prefix = spill_prefix
         self.max_lat = config.max_lat 
         self.buffer_size = config.buffer_size 
         self.pkt_size = config.pkt_size 
         self.step = 0
+        self.head = 0 # Ring buffer index of the packets that arrived in the current TTI
         self.buff = [0]*self.max_lat
+        self.buff_pkts = 0
         self.sent = [0]*self.max_lat
+        # Packets accepted before each ring buffer slot started receiving arrivals
+        self.slot_in_pkts = [0]*self.max_lat
+        self.total_sent_pkts = 0
+        self.sum_sent_pkts_ttis_waited = 0 # Sum of the TTIs waited by every sent packet
         self.partial_pkt_bits = 0.0
+        self.hist_offset = 0 # Number of history entries discarded from memory
         self.hist_dropp_max_lat_pkts: List[int] = []
         self.hist_dropp_buffer_full_pkts: List[int] = []
         self.hist_arriv_pkts: List[int] = []
         self.hist_sent_pkts: List[int] = []
         self.hist_buff_pkts: List[int] = []
+        # Prefix sums of the histories above (entry k holds the sum of the first k TTIs)
+        self.cum_dropp_max_lat_pkts: List[int] = [0]
+        self.cum_dropp_buffer_full_pkts: List[int] = [0]
+        self.cum_arriv_pkts: List[int] = [0]
+        self.cum_sent_pkts: List[int] = [0]
+        for name in self.hist_names:
+            remove_spill_file(self.__get_spill_file(name))
     
     def reset(self) -> None:
         self.step = 0
+        self.head = 0 # Ring buffer index of the packets that arrived in the current TTI
         self.buff = [0]*self.max_lat
+        self.buff_pkts = 0
         self.sent = [0]*self.max_lat
+        # Packets accepted before each ring buffer slot started receiving arrivals
+        self.slot_in_pkts = [0]*self.max_lat
+        self.total_sent_pkts = 0
+        self.sum_sent_pkts_ttis_waited = 0 # Sum of the TTIs waited by every sent packet
         self.partial_pkt_bits = 0.0
+        self.hist_offset = 0 # Number of history entries discarded from memory
         self.hist_dropp_max_lat_pkts: List[int] = []
         self.hist_dropp_buffer_full_pkts: List[int] = []
         self.hist_arriv_pkts: List[int] = []
         self.hist_sent_pkts: List[int] = []
         self.hist_buff_pkts: List[int] = []
+        # Prefix sums of the histories above (entry k holds the sum of the first k TTIs)
+        self.cum_dropp_max_lat_pkts: List[int] = [0]
+        self.cum_dropp_buffer_full_pkts: List[int] = [0]
+        self.cum_arriv_pkts: List[int] = [0]
+        self.cum_sent_pkts: List[int] = [0]
+        for name in self.hist_names:
+            remove_spill_file(self.__get_spill_file(name))
+
+    def __get_spill_file(self, name: str) -> str:
+        if self.spill_prefix is None:
+            return None
+        return get_spill_file(self.spill_prefix, name)
+
+    def __trim_histories(self) -> None:
+        n = len(self.hist_sent_pkts) - self.hist_retention
+        for name in self.hist_names:
+            trim_history(getattr(self, name), n, self.__get_spill_file(name))
+        for name in self.cum_names:
+            del getattr(self, name)[:n]
+        self.hist_offset += n
+
+    def get_full_history(self, name: str) -> np.ndarray:
+        return load_history(getattr(self, name), self.__get_spill_file(name))
+
+    def snapshot(self, history_tail: int) -> Dict: # Keeps the last history_tail TTIs of history
+        n = max(0, len(self.hist_sent_pkts) - history_tail)
+        snapshot = {name: getattr(self, name)[n:] for name in self.hist_names + self.cum_names}
+        snapshot.update({
+            "step": self.step,
+            "head": self.head,
+            "buff": list(self.buff),
+            "buff_pkts": self.buff_pkts,
+            "sent": list(self.sent),
+            "slot_in_pkts": list(self.slot_in_pkts),
+            "total_sent_pkts": self.total_sent_pkts,
+            "sum_sent_pkts_ttis_waited": self.sum_sent_pkts_ttis_waited,
+            "partial_pkt_bits": self.partial_pkt_bits,
+            "hist_offset": self.hist_offset + n,
+        })
+        return snapshot
+
+    def restore(self, snapshot: Dict) -> None:
+        if len(snapshot["buff"]) != self.max_lat:
+            raise Exception("Snapshot buffer has max_lat {} instead of {}".format(len(snapshot["buff"]), self.max_lat))
+        for name in self.hist_names + self.cum_names:
+            setattr(self, name, list(snapshot[name]))
+        self.step = snapshot["step"]
+        self.head = snapshot["head"]
+        self.buff = list(snapshot["buff"])
+        self.buff_pkts = snapshot["buff_pkts"]
+        self.sent = list(snapshot["sent"])
+        self.slot_in_pkts = list(snapshot["slot_in_pkts"])
+        self.total_sent_pkts = snapshot["total_sent_pkts"]
+        self.sum_sent_pkts_ttis_waited = snapshot["sum_sent_pkts_ttis_waited"]
+        self.partial_pkt_bits = snapshot["partial_pkt_bits"]
+        self.hist_offset = snapshot["hist_offset"]
+        for name in self.hist_names: # The spilled entries do not belong to the restored run
+            remove_spill_file(self.__get_spill_file(name))
+
+    def get_hist_buff_pkts(self, step: int) -> int:
+        return self.hist_buff_pkts[step - self.hist_offset] if step >= 0 else self.hist_buff_pkts[step]
+
+    def _get_window_sum(self, cum: List[int], window: int) -> int:
+        # Same result as sum(hist[-window:]) for the history summed by cum
+        return cum[-1] - cum[max(0, len(cum) - 1 - window)]
 
     def get_arriv_pkts(self, window:int):
         if window < 1:
             raise Exception("window must be >= 1")
         if window > self.step + 1:  
             window = self.step + 1
-        return sum(self.hist_arriv_pkts[-window:])
+        return self._get_window_sum(self.cum_arriv_pkts, window)
     
     def get_arriv_pkts_bits(self, window:int):
         if window < 1:
@@ -69,29 +174,57 @@ class DiscreteBuffer():
             raise Exception("window must be >= 1")
         if window > self.step + 1:  
             window = self.step + 1
-        return sum(self.hist_sent_pkts[-window:]) * self.pkt_size
+        return self._get_window_sum(self.cum_sent_pkts, window) * self.pkt_size
 
     def get_buff_bits(self):
-        return sum(self.buff)*self.pkt_size
+        return self.buff_pkts*self.pkt_size
+
+    def get_n_buff_pkts_waited_i_TTIs(self, i:int) -> int:
+        return self.buff[(self.head + i) % self.max_lat]
+
+    def get_n_buff_pkts_waited_at_least_i_TTIs(self, i:int) -> int:
+        # Same as sum(get_n_buff_pkts_waited_i_TTIs(j) for j in range(i, max_lat)). Packets leave the buffer
+        # oldest first, so these are the ones still queued that were accepted before the slot of age i-1
+        if i <= 0:
+            return int(self.buff_pkts)
+        if i >= self.max_lat:
+            return 0
+        out_pkts = self.total_sent_pkts + self.cum_dropp_max_lat_pkts[-1] # Sent or expired
+        return int(max(0, self.slot_in_pkts[(self.head + i - 1) % self.max_lat] - out_pkts))
+
+    def get_in_pkts(self) -> int: # Packets accepted by the buffer so far
+        return self.cum_arriv_pkts[-1] - self.cum_dropp_buffer_full_pkts[-1]
+
+    def get_buffer_array(self) -> List[int]:
+        return self.buff[self.head:] + self.buff[:self.head]
 
     def arrive_pkts(self, n_pkts: int) -> None:
-        self.hist_buff_pkts.append(sum(self.buff))
+        self.hist_buff_pkts.append(self.buff_pkts)
         self.hist_arriv_pkts.append(n_pkts)
+        self.cum_arriv_pkts.append(self.cum_arriv_pkts[-1] + n_pkts)
         dropped_pkts = 0
         if n_pkts * self.pkt_size + self.get_buff_bits() > self.buffer_size:
             dropped_bits = n_pkts * self.pkt_size + self.get_buff_bits() - self.buffer_size
             dropped_pkts = int(np.ceil(dropped_bits/self.pkt_size))
         self.hist_dropp_buffer_full_pkts.append(dropped_pkts)
-        self.buff[0] += n_pkts - dropped_pkts
+        self.cum_dropp_buffer_full_pkts.append(self.cum_dropp_buffer_full_pkts[-1] + dropped_pkts)
+        self.buff[self.head] += n_pkts - dropped_pkts
+        self.buff_pkts += n_pkts - dropped_pkts
 
     def __advance_TTI(self):
-        self.hist_dropp_max_lat_pkts.append(self.buff[self.max_lat-1])
-        if self.buff[self.max_lat-1] > 0:
+        oldest = (self.head - 1) % self.max_lat
+        self.hist_dropp_max_lat_pkts.append(self.buff[oldest])
+        self.cum_dropp_max_lat_pkts.append(self.cum_dropp_max_lat_pkts[-1] + self.buff[oldest])
+        if self.buff[oldest] > 0:
             self.partial_pkt_bits = 0
-        for i in reversed(range(1, self.max_lat)): # Advancing the buffer
-            self.buff[i] = self.buff[i-1]
-        self.buff[0] = 0
+        self.buff_pkts -= self.buff[oldest]
+        self.buff[oldest] = 0
+        self.head = oldest # Advancing the buffer: the expired slot receives the next arrivals
+        self.slot_in_pkts[oldest] = self.get_in_pkts()
         self.step += 1
+        # Trimming only when twice the retention is reached keeps the cost amortized O(1)
+        if self.hist_retention is not None and len(self.hist_sent_pkts) >= 2*self.hist_retention:
+            self.__trim_histories()
     
     def transmit(self, throughput:float) -> None:
         n_bits = throughput*self.TTI + self.partial_pkt_bits
@@ -102,21 +235,27 @@ class DiscreteBuffer():
         self.sum_last_sent_pkts = 0
         self.sum_last_sent_TTIs = 0
         for i in reversed(range(self.max_lat)):
-            if int_pkts == 0:
+            if int_pkts == 0 or sent_pkts == self.buff_pkts:
                 break
-            elif self.buff[i] > int_pkts:
-                self.buff[i] -= int_pkts
+            j = (self.head + i) % self.max_lat
+            if self.buff[j] > int_pkts:
+                self.buff[j] -= int_pkts
                 self.sent[i] += int_pkts
                 sent_pkts += int_pkts
+                self.sum_sent_pkts_ttis_waited += int_pkts*i
                 self.sum_last_sent_TTIs += int_pkts*i
                 self.sum_last_sent_pkts += int_pkts
                 int_pkts = 0
             else:
-                int_pkts -= self.buff[i]
-                self.sent[i] += self.buff[i]
-                sent_pkts += self.buff[i]
-                self.buff[i] = 0
+                int_pkts -= self.buff[j]
+                self.sent[i] += self.buff[j]
+                sent_pkts += self.buff[j]
+                self.sum_sent_pkts_ttis_waited += self.buff[j]*i
+                self.buff[j] = 0
+        self.buff_pkts -= sent_pkts
+        self.total_sent_pkts += sent_pkts
         self.hist_sent_pkts.append(sent_pkts)
+        self.cum_sent_pkts.append(self.cum_sent_pkts[-1] + sent_pkts)
         self.__advance_TTI()
     
     def get_buffer_occupancy(self) -> float:
@@ -127,12 +266,12 @@ class DiscreteBuffer():
             return 0
         if window < 1:
             raise Exception("window must be >= 1")
-        return sum(self.hist_dropp_max_lat_pkts[-window:]) * self.pkt_size
+        return self._get_window_sum(self.cum_dropp_max_lat_pkts, window) * self.pkt_size
 
     def get_dropp_buffer_full_pkts_bits(self, window:int) -> int:
         if window < 1:
             raise Exception("window must be >= 1")
-        return sum(self.hist_dropp_buffer_full_pkts[-window:]) * self.pkt_size
+        return self._get_window_sum(self.cum_dropp_buffer_full_pkts, window) * self.pkt_size
     
     def get_dropp_pkts_bits(self, window:int) -> int:
         if window < 1:
@@ -171,11 +310,10 @@ class DiscreteBuffer():
 
     
     def _get_avg_buffer_TTI_latency(self) -> float: # Accumulated latency for sent packets
-        sum_sent = sum(self.sent)
-        if sum_sent == 0:
+        if self.total_sent_pkts == 0:
             return 0
         else:
-            return sum(self.sent[i]*i for i in range(self.max_lat))/(sum_sent)
+            return self.sum_sent_pkts_ttis_waited/self.total_sent_pkts
     
     """
     def _get_avg_buffer_TTI_latency(self) -> float: # Instantaneous latency for sent packets
@@ -185,9 +323,9 @@ class DiscreteBuffer():
     """
     """
     def _get_avg_buffer_TTI_latency(self) -> float: # Instantaneous latency for packets on the buffer
-        if sum(self.buff) == 0:
+        if self.buff_pkts == 0:
             return 0
-        return sum(self.buff[i]*i for i in range(self.max_lat))/sum(self.buff)
+        return sum(self.get_n_buff_pkts_waited_i_TTIs(i)*i for i in range(self.max_lat))/self.buff_pkts
     """
     def get_avg_buffer_latency(self) -> float:
         return self._get_avg_buffer_TTI_latency()*self.TTI
@@ -198,20 +336,17 @@ class DiscreteBuffer():
         if window > self.step + 1:
             window = self.step + 1
         dropp = self.get_dropp_pkts_bits(window)
-        total = self.get_arriv_pkts_bits(window) + self.hist_buff_pkts[self.step-window] * self.pkt_size
+        total = self.get_arriv_pkts_bits(window) + self.get_hist_buff_pkts(self.step-window) * self.pkt_size
         if total == 0:
             return 0
         else:
             return dropp/total
         
     def get_sum_sent_pkts_ttis_waited(self) -> int:
-        sum_ttis = 0
-        for i in range(self.max_lat):
-            sum_ttis += self.sent[i]*i
-        return sum_ttis
+        return self.sum_sent_pkts_ttis_waited
     
     def get_total_sent_pkts(self) -> int:
-        return sum(self.sent)
+        return self.total_sent_pkts
 
     def __str__(self) -> str:
         return json.dumps(self.__dict__, cls=Encoder, indent=2)
@@ -3,6 +3,10 @@ import numpy as np
 import stable_baselines3
 import gymnasium
 from itertools import product
+from collections import OrderedDict
+from copy import deepcopy
+import ctypes
+import multiprocessing
 from stable_baselines3.common.callbacks import BaseCallback
 from tqdm.auto import tqdm
 
@@ -10,6 +14,38 @@ from simulation.basestation import BaseStation
 from simulation.slice import Slice
 from simulation.user import User
 from simulation.rbg import RBG
+from simulation.sestore import SEStore
+
+# Columns of the slice metrics in the observation, in the order of Env.get_slice_obs_metrics
+metric_columns = ["se", "served_thr", "sent_thr", "buffer_occupancy", "pkt_loss", "arriv_thr", "avg_buff_lat", "long_term_thr", "fifth_perc_thr"]
+
+reward_weights = {
+    "eMBB": {"thr": 0.2, "lat": 0.05, "loss": 0.05},
+    "URLLC": {"thr": 0.1, "lat": 0.25, "loss": 0.25},
+    "BE": {"long": 0.05, "fifth": 0.05},
+}
+
+def get_rewards(slices: List[Slice], metrics: np.ndarray, TTI: float) -> np.ndarray:
+    # Rewards of N basestations with the same slices from their (N, n_slices, n_metrics) metrics,
+    # adding the terms in the same order as a loop over the slices of one basestation
+    rewards = np.zeros(metrics.shape[0])
+    for i, s in enumerate(slices):
+        m = {name: metrics[:, i, j] for j, name in enumerate(metric_columns)}
+        w = reward_weights.get(s.type)
+        if s.type == "eMBB" or s.type == "URLLC":
+            thr_req = s.requirements["throughput"]
+            lat_req = s.requirements["latency"] * TTI # TTI -> seconds
+            loss_req = s.requirements["pkt_loss"]
+            max_lat = s.user_config.buff_config.max_lat * TTI # TTI -> seconds
+            rewards += np.where(m["served_thr"] < thr_req, -w["thr"] * (thr_req - m["served_thr"])/thr_req, 0)
+            rewards += np.where(m["avg_buff_lat"] > lat_req, -w["lat"] * (m["avg_buff_lat"] - lat_req)/(max_lat-lat_req), 0)
+            rewards += np.where(m["pkt_loss"] > loss_req, -w["loss"] * (m["pkt_loss"] - loss_req)/(1-loss_req), 0)
+        elif s.type == "BE":
+            long_req = s.requirements["long_term_thr"]
+            fif_req = s.requirements["fifth_perc_thr"]
+            rewards += np.where(m["long_term_thr"] < long_req, -w["long"] * (long_req - m["long_term_thr"])/long_req, 0)
+            rewards += np.where(m["fifth_perc_thr"] < fif_req, -w["fifth"] * (fif_req - m["fifth_perc_thr"])/fif_req, 0)
+    return rewards
 
 class Env(gymnasium.Env):
     def __init__(
@@ -17,15 +53,27 @@ class Env(gymnasium.Env):
         bs: BaseStation,
         max_number_steps: int,
         SE_multipliers: Dict[int, float],
-        SE_file_base_string: str,
+        SE_file_base_string: str, # Packed into SE_store_file if it does not exist
         trials: List[int],
         window_max: int,
         TTI: float,
+        SE_store_file: str = "se/se_store.npy",
+        SE_sub_carrier: int = 2,
+        SE_cache_size: int = 16, # Trials kept in memory as contiguous arrays
     ) -> None:
         self.bs = bs
         self.max_number_steps = max_number_steps
         self.SE_file_base_string = SE_file_base_string
         self.SE_multipliers = SE_multipliers
+        self.SE_store_file = SE_store_file
+        self.SE_store = SEStore(
+            store_file=SE_store_file,
+            multipliers=SE_multipliers,
+            se_file_base_string=SE_file_base_string,
+        )
+        self.SE_sub_carrier = SE_sub_carrier
+        self.SE_cache_size = SE_cache_size
+        self.SE_cache: OrderedDict = OrderedDict() # trial -> (ue, tti) array, least recently used first
         self.trials = trials
         self.window_max = window_max
         self.TTI = TTI
@@ -51,6 +99,28 @@ class Env(gymnasium.Env):
         # Will be incremented by the reset when the training starts
         self.trial_index = -1 
 
+    def split(self, n_envs: int, seed: int) -> List["Env"]:
+        # Independent copies of the basestation, each with its own seed and trials
+        if n_envs > len(self.trials):
+            raise Exception("Cannot split {} trials into {} environments".format(len(self.trials), n_envs))
+        envs: List[Env] = []
+        for i in range(n_envs):
+            bs = deepcopy(self.bs)
+            bs.reseed(seed + i)
+            envs.append(Env(
+                bs=bs,
+                max_number_steps=self.max_number_steps,
+                SE_multipliers=self.SE_multipliers,
+                SE_file_base_string=self.SE_file_base_string,
+                trials=list(self.trials)[i::n_envs],
+                window_max=self.window_max,
+                TTI=self.TTI,
+                SE_store_file=self.SE_store_file,
+                SE_sub_carrier=self.SE_sub_carrier,
+                SE_cache_size=self.SE_cache_size,
+            ))
+        return envs
+
     def create_combinations(self, n_rbgs: int, n_slices: int) -> None:
         combinations = []
         combs = product(range(0, n_rbgs + 1), repeat=n_slices)
@@ -59,24 +129,32 @@ class Env(gymnasium.Env):
                 combinations.append(comb)
         return np.asarray(combinations)
     
-    def read_spectral_efficiency_files(self, trial:int) -> Dict[int, List[float]]:
-        self.SEs:Dict[int, List[float]] = dict()
-        for u in range(10):
-            SE_file_string = self.SE_file_base_string.format(trial, 2, u+1)
-            self.SEs[u] = list(np.load(SE_file_string)*self.SE_multipliers[u+1])
-
-    def set_users_spectral_efficiency(self, users:Dict[int, User], SEs: Dict[int, List[float]]):
-        for u in users.values():
-            u.set_spectral_efficiency(SEs[u.id][u.step])
-
-    def get_lim_obs_space_array(self) -> np.array:
-        lim_obs_space = []
-        for s in self.bs.slices.keys(): # Requirements
-            lim_obs_space.extend(self.get_slice_obs_requirements(s))
-        for s in self.bs.slices.keys(): # Slice metrics
-            lim_obs_space.extend(self.get_slice_obs_metrics(s))
-        # print ("Obs. space:",lim_obs_space)
-        return np.array(lim_obs_space)
+    def read_spectral_efficiency_files(self, trial:int) -> None:
+        if trial in self.SE_cache:
+            self.SE_cache.move_to_end(trial)
+        else:
+            self.SE_cache[trial] = self.SE_store.get_trial(trial, self.SE_sub_carrier).to_array()
+            if len(self.SE_cache) > self.SE_cache_size:
+                self.SE_cache.popitem(last=False)
+        self.SEs = self.SE_cache[trial]
+
+    def set_users_spectral_efficiency(self, users:Dict[int, User], SEs: np.ndarray):
+        user_list = list(users.values())
+        ids = np.fromiter((u.id for u in user_list), dtype=np.int64, count=len(user_list))
+        steps = np.fromiter((u.step for u in user_list), dtype=np.int64, count=len(user_list))
+        for u, se in zip(user_list, SEs[ids, steps].tolist()): # One gather for every user
+            u.set_spectral_efficiency(se)
+
+    def get_lim_obs_space_array(self, metrics: np.ndarray = None) -> np.array:
+        if metrics is None:
+            metrics = self.get_obs_metrics()
+        return np.concatenate([self.get_obs_requirements(), metrics.ravel()])
+
+    def get_obs_requirements(self) -> np.ndarray:
+        return np.concatenate([self.get_slice_obs_requirements(s) for s in self.bs.slices.keys()])
+
+    def get_obs_metrics(self) -> np.ndarray: # (n_slices, n_metrics)
+        return np.array([self.get_slice_obs_metrics(s) for s in self.bs.slices.keys()])
 
     def get_slice_obs_requirements(self, slice_id: int) -> np.array:
         s = self.bs.slices[slice_id]
@@ -107,6 +185,20 @@ class Env(gymnasium.Env):
         return np.array(metrics)
 
     def step(self, action: np.array) -> Tuple[np.ndarray, float, bool, Dict]:
+        self.apply_action(action)
+        metrics = self.get_obs_metrics()
+        return (
+            self.get_lim_obs_space_array(metrics),
+            self.calculate_reward(metrics),
+            self.is_done(),
+            False,
+            {}
+        )
+
+    def is_done(self) -> bool:
+        return self.step_number == (self.max_number_steps-1)
+
+    def apply_action(self, action: np.array) -> None: # Advances the basestation one TTI
         print("Action:",action)
         rbs_allocation = (
             ((action + 1) / np.sum(action + 1)) * len(self.bs.rbgs)
@@ -130,54 +222,11 @@ class Env(gymnasium.Env):
         if self.window > self.window_max:
             self.window = self.window_max
         self.set_users_spectral_efficiency(self.bs.users, self.SEs)
-        
-        return (
-            self.get_lim_obs_space_array(),
-            self.calculate_reward(),
-            self.step_number == (self.max_number_steps-1),
-            False,
-            {}
-        )
 
-    def calculate_reward(self) -> float:
-        w_embb_thr = 0.2
-        w_embb_lat = 0.05
-        w_embb_loss = 0.05
-        w_urllc_thr = 0.1
-        w_urllc_lat = 0.25
-        w_urllc_loss = 0.25
-        w_be_long = 0.05
-        w_be_fifth = 0.05
-        reward = 0.0
-        for s in self.bs.slices.values():
-            thr = s.get_served_thr()
-            lat = s.get_avg_buffer_latency()
-            loss = s.get_pkt_loss_rate(window=self.window)
-            long = s.get_long_term_thr(window=self.window)
-            fif = s.get_fifth_perc_thr(window=self.window)
-            if s.type == "eMBB":
-                thr_req = s.requirements["throughput"]
-                lat_req = s.requirements["latency"] * self.TTI # TTI -> seconds
-                loss_req = s.requirements["pkt_loss"]
-                max_lat = s.user_config.buff_config.max_lat * self.TTI # TTI -> seconds
-                reward += -w_embb_thr * (thr_req - thr)/thr_req if thr < thr_req else 0
-                reward += -w_embb_lat * (lat - lat_req)/(max_lat-lat_req) if lat > lat_req else 0
-                reward += -w_embb_loss * (loss - loss_req)/(1-loss_req) if loss > loss_req else 0
-            if s.type == "URLLC":
-                thr_req = s.requirements["throughput"]
-                lat_req = s.requirements["latency"] * self.TTI # TTI -> seconds
-                loss_req = s.requirements["pkt_loss"]
-                max_lat = s.user_config.buff_config.max_lat * self.TTI # TTI -> seconds
-                reward += -w_urllc_thr * (thr_req - thr)/thr_req if thr < thr_req else 0
-                reward += -w_urllc_lat * (lat - lat_req)/(max_lat-lat_req) if lat > lat_req else 0
-                reward += -w_urllc_loss * (loss - loss_req)/(1-loss_req) if loss > loss_req else 0
-            if s.type == "BE":
-                long_req = s.requirements["long_term_thr"]
-                fif_req = s.requirements["fifth_perc_thr"]
-                reward += -w_be_long * (long_req - long)/long_req if long < long_req else 0
-                reward += -w_be_fifth * (fif_req - fif)/fif_req if fif < fif_req else 0
-        # print("Reward:",reward)
-        return reward
+    def calculate_reward(self, metrics: np.ndarray = None) -> float:
+        if metrics is None:
+            metrics = self.get_obs_metrics()
+        return float(get_rewards(list(self.bs.slices.values()), metrics[np.newaxis], self.TTI)[0])
 
     def reset(self, initial_trial: int = -1, seed: int = None) -> np.ndarray:
         # print("Called reset on trial index",self.trial_index)
@@ -192,6 +241,184 @@ class Env(gymnasium.Env):
         self.bs.arrive_pkts()
         return (self.get_lim_obs_space_array(), {})
     
+class BatchEnv(stable_baselines3.common.vec_env.VecEnv):
+    # Steps several Env in one process and computes their observations, rewards and dones as
+    # (N, ...) arrays. The envs must have the same slices (e.g. made by Env.split)
+    def __init__(self, envs: List[Env]) -> None:
+        self.envs = envs
+        super().__init__(len(envs), envs[0].observation_space, envs[0].action_space)
+        self.slices = list(envs[0].bs.slices.values())
+        self.TTI = envs[0].TTI
+        self.requirements = np.array([env.get_obs_requirements() for env in envs]) # Constant
+        self.last_steps = np.array([env.max_number_steps - 1 for env in envs])
+        self.obs = np.zeros((self.num_envs,) + self.observation_space.shape, dtype=self.observation_space.dtype)
+        self.rewards = np.zeros(self.num_envs, dtype=np.float32)
+        self.dones = np.zeros(self.num_envs, dtype=bool)
+        self.reset_infos: List[Dict] = [{} for _ in range(self.num_envs)]
+        self.actions: np.ndarray = None
+
+    def reset(self) -> np.ndarray:
+        for i, env in enumerate(self.envs):
+            self.obs[i], self.reset_infos[i] = env.reset()
+        return self.obs.copy()
+
+    def step_async(self, actions: np.ndarray) -> None:
+        self.actions = actions
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[Dict]]:
+        for env, action in zip(self.envs, self.actions):
+            env.apply_action(action)
+        metrics = np.array([env.get_obs_metrics() for env in self.envs]) # (N, n_slices, n_metrics)
+        obs = np.concatenate([self.requirements, metrics.reshape(self.num_envs, -1)], axis=1)
+        self.rewards[:] = get_rewards(self.slices, metrics, self.TTI)
+        self.dones[:] = np.array([env.step_number for env in self.envs]) == self.last_steps
+        self.obs[:] = obs
+        infos: List[Dict] = [{"TimeLimit.truncated": False} for _ in range(self.num_envs)] # Env never truncates
+        for i in np.flatnonzero(self.dones): # Same automatic reset as DummyVecEnv
+            infos[i]["terminal_observation"] = obs[i]
+            self.obs[i], self.reset_infos[i] = self.envs[i].reset()
+        return self.obs.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+    def close(self) -> None:
+        pass
+
+    def get_attr(self, attr_name: str, indices=None) -> List:
+        return [getattr(self.envs[i], attr_name) for i in self._get_indices(indices)]
+
+    def set_attr(self, attr_name: str, value, indices=None) -> None:
+        for i in self._get_indices(indices):
+            setattr(self.envs[i], attr_name, value)
+
+    def env_method(self, method_name: str, *method_args, indices=None, **method_kwargs) -> List:
+        return [getattr(self.envs[i], method_name)(*method_args, **method_kwargs) for i in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None) -> List[bool]:
+        return [False for _ in self._get_indices(indices)]
+
+def _shared_memory_worker(remote, parent_remote, env: Env, index: int, buffers: Dict) -> None:
+    parent_remote.close()
+    arrays = {name: np.frombuffer(raw, dtype=dtype).reshape(shape) for name, (raw, dtype, shape) in buffers.items()}
+    while True:
+        try:
+            cmd, data = remote.recv()
+        except EOFError: # The parent closed its end of the pipe (or exited) without sending close
+            break
+        if cmd == "step":
+            obs, reward, terminated, truncated, _ = env.step(arrays["actions"][index])
+            arrays["rewards"][index] = reward
+            arrays["dones"][index] = terminated or truncated
+            arrays["truncated"][index] = truncated and not terminated
+            if terminated or truncated:
+                arrays["terminal_obs"][index] = obs
+                obs, _ = env.reset()
+            arrays["obs"][index] = obs
+            remote.send(None)
+        elif cmd == "reset":
+            arrays["obs"][index], _ = env.reset()
+            remote.send(None)
+        elif cmd == "get_attr":
+            remote.send(getattr(env, data))
+        elif cmd == "set_attr":
+            setattr(env, data[0], data[1])
+            remote.send(None)
+        elif cmd == "env_method":
+            remote.send(getattr(env, data[0])(*data[1], **data[2]))
+        elif cmd == "close":
+            remote.close()
+            break
+
+class SharedMemoryVecEnv(stable_baselines3.common.vec_env.VecEnv): # One worker process per Env
+    def __init__(self, envs: List[Env], start_method: str = None) -> None:
+        super().__init__(len(envs), envs[0].observation_space, envs[0].action_space)
+        if start_method is None: # Same default as SubprocVecEnv
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        ctx = multiprocessing.get_context(start_method)
+        # Observations and actions are exchanged through shared memory, the pipes only carry commands
+        shapes = {
+            "obs": ((self.num_envs,) + self.observation_space.shape, np.float32, ctypes.c_float),
+            "terminal_obs": ((self.num_envs,) + self.observation_space.shape, np.float32, ctypes.c_float),
+            "actions": ((self.num_envs,) + self.action_space.shape, np.float32, ctypes.c_float),
+            "rewards": ((self.num_envs,), np.float32, ctypes.c_float),
+            "dones": ((self.num_envs,), np.bool_, ctypes.c_bool),
+            "truncated": ((self.num_envs,), np.bool_, ctypes.c_bool),
+        }
+        buffers = {}
+        for name, (shape, dtype, ctype) in shapes.items():
+            raw = ctx.RawArray(ctype, int(np.prod(shape)))
+            buffers[name] = (raw, dtype, shape)
+            setattr(self, name, np.frombuffer(raw, dtype=dtype).reshape(shape))
+        self.remotes, self.work_remotes = zip(*[ctx.Pipe() for _ in range(self.num_envs)])
+        self.processes = []
+        for i, (work_remote, remote, env) in enumerate(zip(self.work_remotes, self.remotes, envs)):
+            process = ctx.Process(target=_shared_memory_worker, args=(work_remote, remote, env, i, buffers), daemon=True)
+            process.start()
+            self.processes.append(process)
+            work_remote.close()
+        self.waiting = False
+        self.closed = False
+
+    def reset(self) -> np.ndarray:
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.obs.copy()
+
+    def step_async(self, actions: np.ndarray) -> None:
+        self.actions[:] = actions
+        for remote in self.remotes:
+            remote.send(("step", None))
+        self.waiting = True
+
+    def step_wait(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[Dict]]:
+        for remote in self.remotes:
+            remote.recv()
+        self.waiting = False
+        infos: List[Dict] = []
+        for i in range(self.num_envs):
+            info = {"TimeLimit.truncated": bool(self.truncated[i])}
+            if self.dones[i]:
+                info["terminal_observation"] = self.terminal_obs[i].copy()
+            infos.append(info)
+        return self.obs.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+    def close(self, timeout: float = 10.0) -> None: # timeout (s) before a worker that does not exit is terminated
+        if self.closed:
+            return
+        if self.waiting: # A step is still running in the workers
+            for remote in self.remotes:
+                remote.recv()
+            self.waiting = False
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        for remote in self.remotes:
+            remote.close()
+        self.closed = True
+
+    def get_attr(self, attr_name: str, indices=None) -> List:
+        for i in self._get_indices(indices):
+            self.remotes[i].send(("get_attr", attr_name))
+        return [self.remotes[i].recv() for i in self._get_indices(indices)]
+
+    def set_attr(self, attr_name: str, value, indices=None) -> None:
+        for i in self._get_indices(indices):
+            self.remotes[i].send(("set_attr", (attr_name, value)))
+        for i in self._get_indices(indices):
+            self.remotes[i].recv()
+
+    def env_method(self, method_name: str, *method_args, indices=None, **method_kwargs) -> List:
+        for i in self._get_indices(indices):
+            self.remotes[i].send(("env_method", (method_name, method_args, method_kwargs)))
+        return [self.remotes[i].recv() for i in self._get_indices(indices)]
+
+    def env_is_wrapped(self, wrapper_class, indices=None) -> List[bool]:
+        return [False for _ in self._get_indices(indices)]
+
 class SACtrainer:
     def __init__(
         self,
@@ -199,19 +426,30 @@ class SACtrainer:
         rbs_per_rbg: int,
         window_max: int,
         env: Env,
-        seed: int
+        seed: int,
+        n_envs: int = 1, # Basestations stepped together, each with its own trials
+        subprocess: bool = False, # Steps each basestation in its own worker process
     ) -> None:
         self.rb_bandwidth = rb_bandwidth
         self.rbs_per_rbg = rbs_per_rbg
         self.window_max = window_max
         self.env = env
         self.seed = seed
+        self.n_envs = n_envs
+        self.subprocess = subprocess
         self.window = 1
         self.offset = 0
 
     def create_agent(self) -> None:
-        env = stable_baselines3.common.monitor.Monitor(self.env)
-        env = stable_baselines3.common.vec_env.DummyVecEnv([lambda: env])
+        if self.subprocess:
+            env = SharedMemoryVecEnv(self.env.split(self.n_envs, self.seed))
+            env = stable_baselines3.common.vec_env.VecMonitor(env)
+        elif self.n_envs > 1:
+            env = BatchEnv(self.env.split(self.n_envs, self.seed))
+            env = stable_baselines3.common.vec_env.VecMonitor(env)
+        else:
+            env = stable_baselines3.common.monitor.Monitor(self.env)
+            env = stable_baselines3.common.vec_env.DummyVecEnv([lambda: env])
         self.env = stable_baselines3.common.vec_env.VecNormalize(env)
         self.agent = stable_baselines3.SAC( # Using optimized hyperparameters from Cleverson's paper
             policy="MlpPolicy",
@@ -233,7 +471,7 @@ class SACtrainer:
     
     def train(self) -> None:
             callback_checkpoint = stable_baselines3.common.callbacks.CheckpointCallback(
-                save_freq=45*2000,
+                save_freq=max(45*2000//self.n_envs, 1), # Counted in calls to env.step
                 save_path="./agents/",
                 name_prefix="sac"
             )
@@ -242,7 +480,7 @@ class SACtrainer:
                 log_path="./evaluations/",
                 best_model_save_path="./best_sac/",
                 n_eval_episodes=5,
-                eval_freq=10000,
+                eval_freq=max(10000//self.n_envs, 1),
                 verbose=False,
                 warn=False,
             )
@@ -1,19 +1,53 @@
 import numpy as np
 import json
-from typing import List
+from typing import Dict, List
 
 from simulation.jsonencoder import Encoder
 
 class FlowConfiguration:
     def __init__(
         self,
-        type: str,
+        type: str, # "poisson", "on_off", "mmpp" or "trace"
         pkt_size: int, # bits
-        throughput: float, # bits/s
+        throughput: float, # bits/s (mean rate for "on_off")
+        block_size: int = 1, # TTIs of arrivals drawn from the rng at once
+        on_ttis: float = None, # "on_off": mean TTIs in the on state
+        off_ttis: float = None, # "on_off": mean TTIs in the off state
+        mmpp_rates: List[float] = None, # "mmpp": throughput multiplier of each state
+        mmpp_transitions: List[List[float]] = None, # "mmpp": per-TTI state transition probabilities
+        trace_file: str = None, # "trace": .npy with the bits arrived in each TTI
+        trace_offset: int = 0, # "trace": first TTI of the trace replayed
     ) -> None:
+        if block_size < 1:
+            raise Exception("block_size must be >= 1")
+        if type not in ["poisson", "on_off", "mmpp", "trace"]:
+            raise Exception("Flow type {} is not valid".format(type))
+        if type == "on_off":
+            if on_ttis is None or off_ttis is None or on_ttis < 1 or off_ttis < 1:
+                raise Exception("on_off flows need on_ttis >= 1 and off_ttis >= 1")
+            # An on/off flow is a two-state MMPP that keeps the mean throughput
+            mmpp_rates = [(on_ttis + off_ttis)/on_ttis, 0.0]
+            mmpp_transitions = [[1 - 1/on_ttis, 1/on_ttis], [1/off_ttis, 1 - 1/off_ttis]]
+        if type in ["on_off", "mmpp"]:
+            if mmpp_rates is None or mmpp_transitions is None:
+                raise Exception("mmpp flows need mmpp_rates and mmpp_transitions")
+            mmpp_transitions = np.array(mmpp_transitions, dtype=np.float64)
+            if mmpp_transitions.shape != (len(mmpp_rates), len(mmpp_rates)):
+                raise Exception("mmpp_transitions must be a square matrix with one row per rate")
+            if not np.allclose(mmpp_transitions.sum(axis=1), 1):
+                raise Exception("Each row of mmpp_transitions must sum to 1")
+        if type == "trace" and trace_file is None:
+            raise Exception("trace flows need a trace_file")
         self.type = type
         self.pkt_size = pkt_size
         self.throughput = throughput
+        self.block_size = block_size
+        self.on_ttis = on_ttis
+        self.off_ttis = off_ttis
+        self.mmpp_rates = np.array(mmpp_rates, dtype=np.float64) if mmpp_rates is not None else None
+        self.mmpp_transitions = mmpp_transitions
+        self.trace_file = trace_file
+        self.trace_offset = trace_offset
 
 class Flow:
     def __init__(
@@ -29,19 +63,109 @@ class Flow:
         self.step = 0
         self.rng = rng
         self.part_pkt_bits = 0.0
+        self.block_size = config.block_size
+        self.block: np.ndarray = None # Pre-drawn arrivals for the next TTIs
+        self.block_states: np.ndarray = None # MMPP states of the TTIs in block
+        self.block_index = 0
+        self.mmpp_rates = config.mmpp_rates
+        self.mmpp_transitions = config.mmpp_transitions
+        self.state = 0 # MMPP state (flows start in state 0)
+        self.state_ttis: int = None # TTIs left in the MMPP state (None before the first sojourn)
+        self.trace: np.ndarray = None
+        if self.type == "trace": # Memory-mapped, only the replayed pages are read
+            self.trace = np.load(config.trace_file, mmap_mode="r")
+            if self.trace.ndim != 1 or len(self.trace) == 0:
+                raise Exception("Trace {} must be a non-empty 1D array".format(config.trace_file))
+        self.trace_offset = config.trace_offset
+        self.trace_index = self.trace_offset % len(self.trace) if self.trace is not None else 0
 
     def reset(self) -> None:
         self.step = 0
         self.part_pkt_bits = 0.0
+        self.block = None
+        self.block_states = None
+        self.state = 0
+        self.state_ttis = None
+        self.trace_index = self.trace_offset % len(self.trace) if self.trace is not None else 0
+
+    def snapshot(self) -> Dict:
+        return {
+            "step": self.step,
+            "throughput": self.throughput,
+            "part_pkt_bits": self.part_pkt_bits,
+            "block": np.array(self.block) if self.block is not None else None, # Copied out of the trace memmap
+            "block_states": self.block_states.copy() if self.block_states is not None else None,
+            "block_index": self.block_index,
+            "state": self.state,
+            "state_ttis": self.state_ttis,
+            "trace_index": self.trace_index,
+        }
+
+    def restore(self, snapshot: Dict) -> None:
+        self.step = snapshot["step"]
+        self.throughput = snapshot["throughput"]
+        self.part_pkt_bits = snapshot["part_pkt_bits"]
+        self.block = np.array(snapshot["block"]) if snapshot["block"] is not None else None
+        self.block_states = snapshot["block_states"].copy() if snapshot["block_states"] is not None else None
+        self.block_index = snapshot["block_index"]
+        self.state = snapshot["state"]
+        self.state_ttis = snapshot["state_ttis"]
+        self.trace_index = snapshot["trace_index"]
 
     def __generate_bits(self, time_interval:float): # Returns function
         if self.type == "poisson":
             return self.__generate_poisson(time_interval=time_interval)
+        elif self.type in ["on_off", "mmpp"]:
+            return self.__generate_mmpp(time_interval=time_interval)
+        elif self.type == "trace":
+            return self.__generate_trace()
         else:
             raise Exception("Flow type not defined")
 
     def __generate_poisson(self, time_interval:float) -> float:
-        return self.rng.poisson(self.throughput)*time_interval
+        if self.block_size == 1:
+            return self.rng.poisson(self.throughput)*time_interval
+        if self.block is None or self.block_index == self.block_size:
+            self.block = self.rng.poisson(self.throughput, size=self.block_size)
+            self.block_index = 0
+        self.block_index += 1
+        return self.block[self.block_index-1]*time_interval
+
+    def __generate_mmpp_states(self, n: int) -> np.ndarray:
+        # Whole sojourns are drawn at once instead of one transition per TTI
+        states = np.empty(n, dtype=np.int64)
+        i = 0
+        while i < n:
+            if self.state_ttis is None or self.state_ttis == 0:
+                leave = self.mmpp_transitions[self.state].copy()
+                leave[self.state] = 0
+                if self.state_ttis == 0 and leave.sum() > 0: # Leaving the state (absorbing states are never left)
+                    self.state = self.rng.choice(len(leave), p=leave/leave.sum())
+                stay = self.mmpp_transitions[self.state][self.state]
+                self.state_ttis = self.rng.geometric(1 - stay) if stay < 1 else n - i
+            ttis = min(self.state_ttis, n - i)
+            states[i:i+ttis] = self.state
+            self.state_ttis -= ttis
+            i += ttis
+        return states
+
+    def __generate_mmpp(self, time_interval:float) -> float:
+        if self.block is None or self.block_index == self.block_size:
+            self.block_states = self.__generate_mmpp_states(self.block_size)
+            self.block = self.rng.poisson(self.throughput*self.mmpp_rates[self.block_states])
+            self.block_index = 0
+        self.block_index += 1
+        return self.block[self.block_index-1]*time_interval
+
+    def __generate_trace(self) -> float:
+        if self.block is None or self.block_index == len(self.block):
+            # Zero-copy view of the memory-mapped trace (wrapping at its end)
+            end = min(self.trace_index + self.block_size, len(self.trace))
+            self.block = self.trace[self.trace_index:end]
+            self.trace_index = end % len(self.trace)
+            self.block_index = 0
+        self.block_index += 1
+        return float(self.block[self.block_index-1])
     
     def n_arrive_pkts (self) -> int:
         bits = self.__generate_bits(self.TTI) + self.part_pkt_bits
@@ -49,8 +173,17 @@ class Flow:
         self.part_pkt_bits = bits - pkts*self.pkt_size
         return pkts
     
-    def set_throughput(self, throughput:float):
+    def set_throughput(self, throughput:float): # Trace flows replay the recorded bits
         self.throughput = throughput
+        if self.type == "poisson":
+            self.block = None # Arrivals drawn with the old throughput are discarded
+        elif self.type in ["on_off", "mmpp"] and self.block is not None:
+            # The drawn states are kept, so the Markov chain does not skip the rest of the block
+            remaining = self.block_states[self.block_index:]
+            self.block = np.concatenate([
+                self.block[:self.block_index],
+                self.rng.poisson(self.throughput*self.mmpp_rates[remaining]),
+            ])
 
     def generate_pkts (self) -> int:
         self.step += 1
@@ -66,4 +199,4 @@ class Flow:
     """
 
     def __str__(self) -> str:
-        return json.dumps(self.__dict__, cls=Encoder, indent=2)
\ No newline at end of file
+        return json.dumps(self.__dict__, cls=Encoder, indent=2)
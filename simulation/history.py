@@ -0,0 +1,40 @@
+import os
+import numpy as np
+from typing import List
+
+class HistoryConfiguration:
+    def __init__(
+        self,
+        retention: int = None, # TTIs kept in memory (None keeps the whole run)
+        spill_dir: str = None, # Directory where discarded entries are appended (None drops them)
+    ) -> None:
+        self.retention = retention
+        self.spill_dir = spill_dir
+
+    def for_subdir(self, name: str):
+        if self.spill_dir is None:
+            return HistoryConfiguration(retention=self.retention)
+        return HistoryConfiguration(
+            retention=self.retention,
+            spill_dir=os.path.join(self.spill_dir, name),
+        )
+
+def get_spill_file(spill_prefix: str, name: str) -> str:
+    return "{}_{}.bin".format(spill_prefix, name)
+
+def trim_history(hist: List[float], n: int, spill_file: str = None) -> None:
+    if spill_file is not None:
+        os.makedirs(os.path.dirname(spill_file), exist_ok=True)
+        with open(spill_file, "ab") as f:
+            np.asarray(hist[:n], dtype=np.float64).tofile(f)
+    del hist[:n]
+
+def remove_spill_file(spill_file: str) -> None:
+    if spill_file is not None and os.path.exists(spill_file):
+        os.remove(spill_file)
+
+def load_history(hist: List[float], spill_file: str = None) -> np.ndarray:
+    # Spilled entries (oldest) followed by the ones still in memory
+    if spill_file is None or not os.path.exists(spill_file):
+        return np.asarray(hist, dtype=np.float64)
+    return np.concatenate((np.fromfile(spill_file, dtype=np.float64), np.asarray(hist, dtype=np.float64)))
@@ -3,21 +3,34 @@ from typing import Dict, List
 import json
 import numpy as np
 from itertools import product
-import stable_baselines3
 import time
+from copy import copy
 
 from simulation.jsonencoder import Encoder
 from simulation.slice import Slice
 from simulation.user import User
+from simulation.userpool import UserPool, PooledUser
 from simulation.rbg import RBG
+from simulation.sacactor import SACActor
 #from simulation.optimalsched import optimize
 
 class InterSliceScheduler(ABC):
+    snapshot_names: List[str] = [] # Attributes changed by schedule, kept by snapshots
+
+    def snapshot(self) -> Dict:
+        return {name: copy(getattr(self, name)) for name in self.snapshot_names}
+
+    def restore(self, snapshot: Dict) -> None:
+        for name, value in snapshot.items():
+            setattr(self, name, copy(value))
+
     @abstractmethod
     def schedule(self, slices: Dict[int, Slice], users: Dict[int, User], rbgs: List[RBG]):
         raise Exception("Called abstract InterSliceScheduler method")
 
 class RoundRobin(InterSliceScheduler):
+    snapshot_names = ["offset"]
+
     def __init__(
         self,
         offset: int = 0
@@ -122,6 +135,9 @@ class RoundRobin(InterSliceScheduler):
 #             self.window = self.window_max
 
 class StepwiseOptimalAlgorithm(InterSliceScheduler):
+    snapshot_names = ["window", "offset"]
+    requirement_names = ["throughput", "latency", "long_term_thr", "fifth_perc_thr", "pkt_loss"]
+
     def __init__(
         self,
         rb_bandwidth: float,
@@ -136,34 +152,33 @@ class StepwiseOptimalAlgorithm(InterSliceScheduler):
         self.window = 1
         self.offset = 0
     
-    def _check_user_alloc_enough(self, ue_alloc_rbs: Dict[int, int], ue_min_rbs: Dict[int, int], slice: Slice) -> bool:
-        for u_id in slice.users.keys():
-            if ue_alloc_rbs[u_id] < ue_min_rbs[u_id]:
-                return False
-        return True
+    def _get_slice_min_rbs(self, user_prior: List[int], ue_min_rbs: Dict[int, int]) -> int:
+        # Handing out one RBG at a time in the round-robin order, the user at position p of the
+        # priority list has ceil((k-p)/n) RBGs after k RBGs, so it reaches m RBGs at k = n*(m-1) + p + 1
+        n_users = len(user_prior)
+        return max(
+            [n_users*(ue_min_rbs[u_id] - 1) + p + 1 for p, u_id in enumerate(user_prior) if ue_min_rbs[u_id] > 0],
+            default=0
+        )
 
     def schedule(self, slices: Dict[int, Slice], users: Dict[int, User], rbgs: List[RBG]) -> None:
         n_rbgs = len(rbgs)
         
-        ue_min_thr:Dict[int, float] = {}
-        ue_min_rbs:Dict[int, int] = {}
-        for u_id, u in users.items():
-            ue_min_thr[u_id] = self.get_min_ue_thr(u)
-            ue_min_rbs[u_id] = int(np.ceil((ue_min_thr[u_id] / (u.SE * self.rb_bandwidth * self.rbs_per_rbg))))
-            # if "long_term_thr" in u.requirements:
-            #     print ("Ue {} will have long term thr of {}".format(u_id, (sum(u.hist_allocated_throughput[-(u.window-1):] + ue_min_rbs[u_id]*u.SE*self.rb_bandwidth*self.rbs_per_rbg))/u.window/1e6))
-            #     print("UE {} historical thr: {}".format(u.id, np.array(u.hist_allocated_throughput[-(u.window-1):])/1e6))
-        ue_alloc_rbs:Dict[int, int] = {}
-        for u_id in users.keys():
-            ue_alloc_rbs[u_id] = 0
+        if len(users) > 0 and isinstance(next(iter(users.values())), PooledUser):
+            state = self.get_users_state(slices, users)
+            ue_min_thr = self.get_min_ue_thrs(state)
+            ue_min_rbs:Dict[int, int] = dict(zip(
+                state["ids"],
+                np.ceil(ue_min_thr / (state["SE"] * self.rb_bandwidth * self.rbs_per_rbg)).astype(np.int64).tolist()
+            ))
+        else: # Gathering the state of User objects costs more than the scalar path saves
+            ue_min_rbs = {
+                u_id: int(np.ceil(self.get_min_ue_thr(u) / (u.SE * self.rb_bandwidth * self.rbs_per_rbg)))
+                for u_id, u in users.items()
+            }
         slice_min_rbs:Dict[int, int] = {}
         for s_id, s in slices.items():
-            user_prior = s.get_round_robin_prior()
-            ue_offset = 0
-            while not self._check_user_alloc_enough(ue_alloc_rbs, ue_min_rbs, s):
-                ue_alloc_rbs[user_prior[ue_offset]] += 1
-                ue_offset = (ue_offset + 1) % len(user_prior)
-            slice_min_rbs[s_id] = sum(ue_alloc_rbs[u_id] for u_id in s.users)
+            slice_min_rbs[s_id] = self._get_slice_min_rbs(s.get_round_robin_prior(), ue_min_rbs)
         
         # DO NOT HAPPEN IN THE EVALUATION SCENARIO OF THE PAPER
         # If there are not enough resources for all slices,
@@ -197,6 +212,130 @@ class StepwiseOptimalAlgorithm(InterSliceScheduler):
             self.window = self.window_max
             
     
+    def get_users_state(self, slices: Dict[int, Slice], users: Dict[int, User]) -> Dict[str, np.ndarray]:
+        # What get_min_ue_thr reads from each user, as arrays with one entry per user in the order of "ids".
+        # schedule only uses it for pooled users, whose state is read from the UserPool matrices
+        if len(users) > 0 and isinstance(next(iter(users.values())), PooledUser):
+            state = self.__get_pool_state(next(iter(users.values())).pool, slices, users)
+        else:
+            state = self.__get_objects_state(slices, users)
+        if np.any(np.isnan(state["SE"]) | (state["SE"] == 0)):
+            raise Exception("Spectral Efficiency not defined or zero for some users")
+        for name in self.requirement_names:
+            state[name] = self.__get_slice_requirement(slices, state["slice_ids"], name)
+        return state
+
+    def __get_slice_requirement(self, slices: Dict[int, Slice], slice_ids: np.ndarray, name: str) -> np.ndarray:
+        # Requirement of the slice of each user (NaN when the slice does not have it)
+        table = np.full(max(slices.keys(), default=-1) + 1, np.nan)
+        for s_id, s in slices.items():
+            table[s_id] = s.requirements.get(name, np.nan)
+        return table[slice_ids]
+
+    def __get_pool_state(self, pool: UserPool, slices: Dict[int, Slice], users: Dict[int, User]) -> Dict[str, np.ndarray]:
+        if len(users) != pool.n_users: # The rows of the pool are the basestation users in order
+            raise Exception("Users do not match the {} users of their UserPool".format(pool.n_users))
+        window = self.window
+        buff_step = pool.step - window + 1
+        hist_buff_pkts = pool.hist_buff_pkts.get()
+        agg_thr = np.zeros(pool.n_users)
+        if window > 1:
+            for row in pool.hist_allocated_throughput.get()[-(window-1):]: # Sums in the same order as get_agg_thr
+                agg_thr = agg_thr + row
+        latency = self.__get_slice_requirement(slices, pool.slice_ids, "latency")
+        return {
+            "ids": list(users.keys()),
+            "slice_ids": pool.slice_ids,
+            "step": np.full(pool.n_users, pool.step),
+            "max_lat": np.full(pool.n_users, pool.max_lat),
+            "pkt_size": pool.pkt_size,
+            "TTI": np.full(pool.n_users, pool.TTI),
+            "SE": pool.SE,
+            "latency_pkts": pool.get_n_buff_pkts_waited_at_least_i_TTIs(np.where(np.isnan(latency), 0, latency)),
+            "oldest_pkts": pool.buff[:, (pool.head + pool.max_lat - 1) % pool.max_lat],
+            "buff_pkts": pool.buff_pkts,
+            "buffer_pkt_capacity": (pool.buffer_size/pool.pkt_size).astype(np.int64),
+            "last_arriv_pkts": pool.hist_arriv_pkts.get_last(),
+            "window_buff_pkts": hist_buff_pkts[buff_step - pool.hist_offset] if buff_step >= 0 else hist_buff_pkts[buff_step],
+            "window_arriv_pkts": self.__get_window_sum(pool.cum_arriv_pkts.get(), min(window, pool.step + 1)),
+            "window_dropp_max_lat_pkts": self.__get_window_sum(pool.cum_dropp_max_lat_pkts.get(), window - 1),
+            "window_dropp_buffer_full_pkts": self.__get_window_sum(pool.cum_dropp_buffer_full_pkts.get(), window),
+            "agg_thr": agg_thr,
+        }
+
+    def __get_objects_state(self, slices: Dict[int, Slice], users: Dict[int, User]) -> Dict[str, np.ndarray]:
+        window = self.window
+        user_slice = {u_id: s_id for s_id, s in slices.items() for u_id in s.users}
+        user_latency = {u_id: s.requirements.get("latency", 0) for s in slices.values() for u_id in s.users}
+        state = {"ids": list(users.keys())}
+        names = [
+            "slice_ids", "step", "max_lat", "pkt_size", "TTI", "SE", "latency_pkts", "oldest_pkts", "buff_pkts", "buffer_pkt_capacity",
+            "last_arriv_pkts", "window_buff_pkts", "window_arriv_pkts", "window_dropp_max_lat_pkts", "window_dropp_buffer_full_pkts", "agg_thr",
+        ]
+        rows = [( # In the order of names
+            user_slice[u_id],
+            u.buff.step,
+            u.get_max_lat(),
+            u.get_pkt_size(),
+            u.TTI,
+            u.SE if u.SE is not None else np.nan,
+            u.get_n_buff_pkts_waited_at_least_i_TTIs(user_latency[u_id]),
+            u.get_n_buff_pkts_waited_i_TTIs(u.get_max_lat()-1),
+            u.get_buff_pkts_now(),
+            u.get_buffer_pkt_capacity(),
+            u.get_last_arriv_pkts(),
+            u.get_buff_pkts(u.step-window+1),
+            u.get_arriv_pkts(window),
+            self.__get_window_sum(u.buff.cum_dropp_max_lat_pkts, window - 1),
+            self.__get_window_sum(u.buff.cum_dropp_buffer_full_pkts, window),
+            u.get_agg_thr(window-1) if window > 1 else 0,
+        ) for u_id, u in users.items()]
+        columns = zip(*rows) if len(rows) > 0 else [[]]*len(names)
+        for name, values in zip(names, columns):
+            state[name] = np.array(values, dtype=np.float64 if name in ["pkt_size", "TTI", "SE", "agg_thr"] else np.int64)
+        return state
+
+    def __get_window_sum(self, cum, window: int):
+        # Sum of the last window TTIs of the history summed by cum (0 when window < 1)
+        if window < 1:
+            return cum[-1] - cum[-1]
+        return cum[-1] - cum[max(0, len(cum) - 1 - window)]
+
+    def get_min_ue_thrs(self, state: Dict[str, np.ndarray]) -> np.ndarray:
+        # Same as get_min_ue_thr for every user of state (from get_users_state) at once
+        TTI = state["TTI"]
+        n_users = len(state["ids"])
+        min_thr = np.zeros(n_users)
+        has = ~np.isnan(state["throughput"])
+        if np.any(has):
+            min_thr = np.where(has, np.maximum(state["throughput"], min_thr), min_thr)
+        has = ~np.isnan(state["latency"])
+        if np.any(has):
+            latency_thr = state["latency_pkts"]*state["pkt_size"]/TTI
+            min_thr = np.where(has, np.maximum(latency_thr, min_thr), min_thr)
+        has = ~np.isnan(state["long_term_thr"])
+        if np.any(has):
+            long_term_thr = state["long_term_thr"]*self.window - state["agg_thr"]
+            min_thr = np.where(has, np.maximum(long_term_thr, min_thr), min_thr)
+        has = ~np.isnan(state["fifth_perc_thr"])
+        if np.any(has):
+            min_thr = np.where(has, np.maximum(state["fifth_perc_thr"], min_thr), min_thr)
+        has = ~np.isnan(state["pkt_loss"])
+        if np.any(has):
+            if self.window - 1 < 1 and np.any(has & (state["step"] >= state["max_lat"])):
+                raise Exception("window must be >= 1")
+            delta = state["oldest_pkts"]
+            gamma = np.maximum(0, (state["last_arriv_pkts"] + state["buff_pkts"]) - state["buffer_pkt_capacity"])
+            theta = state["last_arriv_pkts"] + state["window_buff_pkts"] + state["window_arriv_pkts"]
+            dropp_lat_sum = np.where(state["step"] < state["max_lat"], 0, state["window_dropp_max_lat_pkts"]).astype(np.float64)
+            dropp_arr_sum = state["window_dropp_buffer_full_pkts"].astype(np.float64)
+            throughput = state["pkt_size"] * np.maximum(
+                0,
+                dropp_lat_sum + dropp_arr_sum + np.maximum(gamma, delta) - np.where(has, state["pkt_loss"], 0)*theta
+            )/TTI
+            min_thr = np.where(has, np.maximum(throughput, min_thr), min_thr)
+        return min_thr
+
     def get_min_ue_thr(self, user: User) -> float:
         # print("Requirements (thr) for User {}".format(user.id))
         min_thr = 0
@@ -205,7 +344,7 @@ class StepwiseOptimalAlgorithm(InterSliceScheduler):
             # print("throughput req: {:.2f}".format(user.requirements["throughput"]/1e6))
         if "latency" in user.requirements:
             min_thr = max(
-                sum(user.get_n_buff_pkts_waited_i_TTIs(i) for i in range(user.requirements["latency"], user.get_max_lat()))*user.get_pkt_size()/user.TTI,
+                user.get_n_buff_pkts_waited_at_least_i_TTIs(user.requirements["latency"])*user.get_pkt_size()/user.TTI,
                 min_thr
             )
             # print("latency req: {:.2f}".format(sum(user.get_n_buff_pkts_waited_i_TTIs(i) for i in range(user.requirements["latency"], user.get_max_lat()))*user.get_pkt_size()/user.TTI/1e6))
@@ -257,6 +396,8 @@ class StepwiseOptimalAlgorithm(InterSliceScheduler):
         return min_thr
 
 class DummyScheduler(InterSliceScheduler): # Used for training the RL agent
+    snapshot_names = ["allocation"]
+
     def __init__(self,) -> None:
         self.allocation = None
     
@@ -272,19 +413,42 @@ class DummyScheduler(InterSliceScheduler): # Used for training the RL agent
                 rbg_index += 1
 
 class SAC(InterSliceScheduler):
+    snapshot_names = ["window", "action_set", "raw_action_set"]
+
     def __init__(
         self,
         window_max: int,
         TTI: float,
         best_model_zip_path: str,
+        agent = None, # Reuses an agent already loaded from best_model_zip_path (SACActor or stable_baselines3.SAC)
+        inference: str = "numpy", # numpy (SACActor, without torch) or torch (stable_baselines3), used when agent is None
     ) -> None:
         self.window_max = window_max
         self.TTI = TTI
-        self.agent = stable_baselines3.SAC.load(best_model_zip_path, None, verbose=0)
+        self.best_model_zip_path = best_model_zip_path
+        if inference not in ["numpy", "torch"]:
+            raise Exception("Inference {} is not valid (must be numpy or torch)".format(inference))
+        self.inference = inference
+        self.agent = agent if agent is not None else self.load_agent()
         self.action_space_options = None
         self.window = 1
         self.action_set = set()
         self.raw_action_set = set()
+
+    def __getstate__(self) -> Dict: # The agent is reloaded from the zip instead of being pickled
+        state = self.__dict__.copy()
+        del state["agent"]
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self.agent = self.load_agent()
+
+    def load_agent(self):
+        if self.inference == "numpy":
+            return SACActor.load(self.best_model_zip_path)
+        import stable_baselines3
+        return stable_baselines3.SAC.load(self.best_model_zip_path, None, verbose=0)
         
     def create_combinations(self, n_rbgs: int, n_slices: int) -> None:
         combinations = []
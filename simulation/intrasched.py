@@ -1,17 +1,29 @@
 from abc import ABC, abstractmethod
 from typing import Dict, List
 import json
+from copy import copy
 
 from simulation.jsonencoder import Encoder
 from simulation.rbg import RBG
 from simulation.user import User
 
 class IntraSliceScheduler(ABC):
+    snapshot_names: List[str] = [] # Attributes changed by schedule, kept by snapshots
+
+    def snapshot(self) -> Dict:
+        return {name: copy(getattr(self, name)) for name in self.snapshot_names}
+
+    def restore(self, snapshot: Dict) -> None:
+        for name, value in snapshot.items():
+            setattr(self, name, copy(value))
+
     @abstractmethod
     def schedule(self, rbgs:List[RBG], users=Dict[int, User]):
         raise Exception("Called abstract IntraSliceScheduler method")
 
 class RoundRobin(IntraSliceScheduler):
+    snapshot_names = ["offset"]
+
     def __init__(
         self,
         offset: int = 0
@@ -0,0 +1,135 @@
+import numpy as np
+from typing import Dict, List
+
+class LatencyHistogram:
+    # HDR-style histogram: values below 2**(significant_bits+1) ns have their own bucket and larger
+    # values share buckets 2**-significant_bits wide relative to their magnitude, so the memory
+    # is fixed whatever the number of recorded values
+    def __init__(
+        self,
+        deadline: float = None, # s (values above it count as deadline misses)
+        significant_bits: int = 7, # Relative error below 2**-significant_bits
+        max_exponent: int = 36, # Values up to 2**max_exponent ns (larger ones go to the last bucket)
+    ) -> None:
+        self.deadline = deadline
+        self.deadline_ns = int(round(deadline*1e9)) if deadline is not None else None
+        self.significant_bits = significant_bits
+        self.max_exponent = max_exponent
+        self.half_count = 2**significant_bits
+        self.counts = np.zeros(self.half_count*(max_exponent - significant_bits + 1), dtype=np.int64)
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns: int = None
+        self.max_ns: int = None
+        self.deadline_misses = 0
+
+    def __get_index(self, ns: int) -> int:
+        e = max(0, ns.bit_length() - self.significant_bits - 1)
+        return min(self.half_count*e + (ns >> e), len(self.counts) - 1)
+
+    def __get_upper(self, index: int) -> int: # Highest value of a bucket
+        e = max(0, index//self.half_count - 1)
+        sub = index - self.half_count*e
+        return ((sub + 1) << e) - 1
+
+    def record(self, ns: int) -> None:
+        ns = max(0, int(ns))
+        self.counts[self.__get_index(ns)] += 1
+        self.count += 1
+        self.total_ns += ns
+        self.min_ns = ns if self.min_ns is None else min(self.min_ns, ns)
+        self.max_ns = ns if self.max_ns is None else max(self.max_ns, ns)
+        if self.deadline_ns is not None and ns > self.deadline_ns:
+            self.deadline_misses += 1
+
+    def record_many(self, ns: np.ndarray) -> None:
+        ns = np.maximum(0, np.asarray(ns, dtype=np.int64))
+        if len(ns) == 0:
+            return
+        bit_length = np.frexp(ns.astype(np.float64))[1] # Exact for values below 2**53
+        e = np.maximum(0, bit_length - self.significant_bits - 1)
+        indexes = np.minimum(self.half_count*e + (ns >> e), len(self.counts) - 1)
+        self.counts += np.bincount(indexes, minlength=len(self.counts))
+        self.count += len(ns)
+        self.total_ns += int(ns.sum())
+        self.min_ns = int(ns.min()) if self.min_ns is None else min(self.min_ns, int(ns.min()))
+        self.max_ns = int(ns.max()) if self.max_ns is None else max(self.max_ns, int(ns.max()))
+        if self.deadline_ns is not None:
+            self.deadline_misses += int(np.sum(ns > self.deadline_ns))
+
+    def add(self, other) -> None: # Merges the values recorded by another histogram with the same layout
+        if len(other.counts) != len(self.counts) or other.significant_bits != self.significant_bits:
+            raise Exception("Cannot merge latency histograms with different layouts")
+        if other.count == 0:
+            return
+        self.counts += other.counts
+        self.count += other.count
+        self.total_ns += other.total_ns
+        self.min_ns = other.min_ns if self.min_ns is None else min(self.min_ns, other.min_ns)
+        self.max_ns = other.max_ns if self.max_ns is None else max(self.max_ns, other.max_ns)
+        self.deadline_misses += other.deadline_misses
+
+    def get_percentile(self, q: float) -> int: # ns, within the bucket precision
+        if self.count == 0:
+            raise Exception("Cannot calculate the percentile of an empty histogram")
+        target = max(1, int(np.ceil(q/100*self.count)))
+        index = int(np.searchsorted(np.cumsum(self.counts), target))
+        return min(max(self.__get_upper(index), self.min_ns), self.max_ns)
+
+    def get_mean(self) -> float: # ns
+        return self.total_ns/self.count if self.count > 0 else 0.0
+
+    def get_summary(self, percentiles: List[float] = [50, 90, 99, 99.9]) -> Dict:
+        summary = {
+            "count": self.count,
+            "min_ms": self.min_ns/1e6 if self.count > 0 else 0.0,
+            "mean_ms": self.get_mean()/1e6,
+        }
+        for q in percentiles:
+            summary["p{}_ms".format(q)] = self.get_percentile(q)/1e6 if self.count > 0 else 0.0
+        summary["max_ms"] = self.max_ns/1e6 if self.count > 0 else 0.0
+        summary["deadline_ms"] = self.deadline_ns/1e6 if self.deadline_ns is not None else None
+        summary["deadline_misses"] = self.deadline_misses
+        summary["deadline_miss_ratio"] = self.deadline_misses/self.count if self.count > 0 else 0.0
+        return summary
+
+    def get_state(self) -> Dict: # Everything but the counts, which are stored as an array
+        return {
+            "deadline": self.deadline,
+            "significant_bits": self.significant_bits,
+            "max_exponent": self.max_exponent,
+            "count": self.count,
+            "total_ns": self.total_ns,
+            "min_ns": self.min_ns,
+            "max_ns": self.max_ns,
+            "deadline_misses": self.deadline_misses,
+        }
+
+    def snapshot(self) -> Dict: # Only the non-empty buckets
+        indexes = np.flatnonzero(self.counts)
+        return {"state": self.get_state(), "indexes": indexes, "counts": self.counts[indexes]}
+
+    def restore(self, snapshot: Dict) -> None:
+        if snapshot["state"]["significant_bits"] != self.significant_bits or snapshot["state"]["max_exponent"] != self.max_exponent:
+            raise Exception("Cannot restore a latency histogram with a different layout")
+        self.counts = np.zeros_like(self.counts)
+        self.counts[snapshot["indexes"]] = snapshot["counts"]
+        self.__set_state(snapshot["state"])
+
+    def __set_state(self, state: Dict) -> None:
+        self.count = state["count"]
+        self.total_ns = state["total_ns"]
+        self.min_ns = state["min_ns"]
+        self.max_ns = state["max_ns"]
+        self.deadline_misses = state["deadline_misses"]
+
+    @staticmethod
+    def from_state(state: Dict, counts: np.ndarray):
+        hist = LatencyHistogram(
+            deadline=state["deadline"],
+            significant_bits=state["significant_bits"],
+            max_exponent=state["max_exponent"],
+        )
+        hist.counts = np.array(counts, dtype=np.int64)
+        hist.__set_state(state)
+        return hist
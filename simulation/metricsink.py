@@ -0,0 +1,100 @@
+import os
+import queue
+import struct
+import threading
+import numpy as np
+from typing import Dict, List
+
+class MetricsSink:
+    def __init__(
+        self,
+        path: str, # Append-only file with the records of every column
+        chunk_size: int = 128, # Values of a column buffered before being written (at most this many TTIs are lost on a crash)
+        max_pending_chunks: int = 256, # Bounds the memory used when the disk is slower than the simulation
+    ) -> None:
+        if chunk_size < 1:
+            raise Exception("chunk_size must be >= 1")
+        self.path = path
+        self.chunk_size = chunk_size
+        self.chunks: Dict[str, List] = {} # column -> [chunk, number of values in the chunk]
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending_chunks)
+        self.error: Exception = None
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "ab")
+        self.closed = False
+        self.thread = threading.Thread(target=self.__write_loop, daemon=True)
+        self.thread.start()
+
+    def __getstate__(self):
+        raise Exception("MetricsSink cannot be pickled (detach it before sending the simulation to other processes)")
+
+    def push(self, column: str, value: float) -> None:
+        entry = self.chunks.get(column)
+        if entry is None:
+            entry = self.chunks[column] = [np.empty(self.chunk_size), 0]
+        entry[0][entry[1]] = value
+        entry[1] += 1
+        if entry[1] == self.chunk_size: # The full chunk now belongs to the writer thread
+            self.__put(column, entry[0])
+            entry[0] = np.empty(self.chunk_size)
+            entry[1] = 0
+
+    def push_many(self, column: str, values: np.ndarray) -> None:
+        for value in values:
+            self.push(column, value)
+
+    def flush(self) -> None: # Writes the partial chunks and waits until everything is on disk
+        for column, entry in self.chunks.items():
+            if entry[1] > 0:
+                self.__put(column, entry[0][:entry[1]].copy())
+                entry[1] = 0
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.closed = True
+
+    def __put(self, column: str, values: np.ndarray) -> None:
+        if self.error is not None:
+            raise self.error
+        self.queue.put((column, values))
+
+    def __write_loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            try:
+                column, values = item
+                name = column.encode()
+                # Record: name length, number of values, name, float64 values
+                self.file.write(struct.pack("<II", len(name), len(values)) + name + values.astype(np.float64).tobytes())
+                self.file.flush()
+            except Exception as e:
+                self.error = e
+            self.queue.task_done()
+
+def read_metrics(path: str) -> Dict[str, np.ndarray]:
+    # Concatenates the records of each column, ignoring a record cut by an interrupted run
+    parts: Dict[str, List[np.ndarray]] = {}
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + 8 <= len(data):
+        name_len, n_values = struct.unpack_from("<II", data, pos)
+        end = pos + 8 + name_len + 8*n_values
+        if end > len(data):
+            break
+        name = data[pos+8:pos+8+name_len].decode()
+        parts.setdefault(name, []).append(np.frombuffer(data, dtype=np.float64, count=n_values, offset=pos+8+name_len))
+        pos = end
+    return {name: np.concatenate(values) for name, values in parts.items()}
@@ -0,0 +1,46 @@
+import json
+from bisect import bisect_left, insort
+from typing import List
+
+from simulation.jsonencoder import Encoder
+
+class SlidingPercentile:
+    # Sorted list of the window: insert and evict find the position with O(log w) comparisons but
+    # move O(w) list entries (a memmove, cheap for windows of a few hundred TTIs), and the
+    # percentile is read in O(1)
+    def __init__(
+        self,
+        q: float, # Percentile in [0, 100]
+    ) -> None:
+        self.q = q
+        self.values: List[float] = [] # Kept sorted
+
+    def reset(self) -> None:
+        self.values: List[float] = []
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def insert(self, value: float) -> None:
+        insort(self.values, value)
+
+    def evict(self, value: float) -> None:
+        i = bisect_left(self.values, value)
+        if i == len(self.values) or self.values[i] != value:
+            raise Exception("Value {} is not in the window".format(value))
+        del self.values[i]
+
+    def get_percentile(self) -> float: # Same linear interpolation as np.percentile
+        if len(self.values) == 0:
+            raise Exception("Cannot calculate the percentile of an empty window")
+        index = (len(self.values) - 1) * (self.q / 100)
+        below = int(index)
+        above = min(below + 1, len(self.values) - 1)
+        weight = index - below
+        diff = self.values[above] - self.values[below]
+        if weight >= 0.5:
+            return self.values[above] - diff * (1 - weight)
+        return self.values[below] + diff * weight
+
+    def __str__(self) -> str:
+        return json.dumps(self.__dict__, cls=Encoder, indent=2)
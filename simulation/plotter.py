@@ -8,6 +8,7 @@ from simulation.simulation import Simulation
 from simulation.slice import Slice
 from simulation.basestation import BaseStation
 from simulation.user import User
+from simulation.sestore import SEStore
 
 class Plotter:
     def __init__(self, sim: Simulation) -> None:
@@ -661,9 +662,10 @@ class Plotter:
             return basestation.hist_agent_reward_cumulative
     
     def calculate_se_metric(self, plot: str, trial, users:List[int], multipliers:Dict[int, float]) -> np.array:
-        ue_se:Dict[int, List[float]] = {}
+        se = SEStore(multipliers=multipliers).get_trial(trial, 2)
+        ue_se:Dict[int, np.ndarray] = {}
         for ue in users:
-            ue_se[ue] = np.load("./se/trial{}_f2_ue{}.npy".format(trial, ue+1)) * multipliers[ue+1]
+            ue_se[ue] = se.get_ue(ue)
         if plot == "slice_se":
             return np.average([ue_se[u] for u in users], axis=0)
         elif plot == "slice_se_worst":
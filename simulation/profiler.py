@@ -0,0 +1,107 @@
+import numpy as np
+from typing import Dict, List, Tuple
+
+class PhaseProfiler:
+    phases = [ # Non-overlapping parts of a TTI, in the order they run
+        "arrive_pkts",
+        "inter_schedule",
+        "intra_schedule",
+        "transmit",
+        "user_hist_update",
+        "slice_hist_update",
+        "calculate_reward",
+        "bs_hist_update",
+    ]
+
+    def __init__(self) -> None:
+        self.current: Dict[int, Dict[Tuple[str, str], int]] = {} # bs_id -> (slice_type, phase) -> ns in the current TTI
+        self.series: Dict[Tuple[int, str, str], List[int]] = {} # (bs_id, slice_type, phase) -> ns per TTI
+        self.n_ttis: Dict[int, int] = {} # bs_id -> TTIs ended
+
+    def __getstate__(self):
+        raise Exception("PhaseProfiler cannot be pickled (detach it before sending the simulation to other processes)")
+
+    def add(self, bs_id: int, slice_type: str, phase: str, ns: int) -> None: # slice_type is None for whole-basestation phases
+        current = self.current.setdefault(bs_id, {})
+        current[(slice_type, phase)] = current.get((slice_type, phase), 0) + ns
+
+    def end_tti(self, bs_id: int) -> None:
+        n_ttis = self.n_ttis.get(bs_id, 0)
+        current = self.current.get(bs_id, {})
+        for (slice_type, phase), ns in current.items():
+            key = (bs_id, slice_type, phase)
+            if key not in self.series: # Phases first seen now took no time in the previous TTIs
+                self.series[key] = [0]*n_ttis
+        for key, values in self.series.items():
+            if key[0] == bs_id:
+                values.append(current.get(key[1:], 0))
+        self.current[bs_id] = {}
+        self.n_ttis[bs_id] = n_ttis + 1
+
+    def get_series(self, bs_id: int, slice_type: str = None, phase: str = None) -> np.ndarray:
+        # ns per TTI of one phase (summed over slice types when slice_type is None) or of the whole TTI
+        values = [
+            v for (b, s, p), v in self.series.items()
+            if b == bs_id and (slice_type is None or s == slice_type) and (phase is None or p == phase)
+        ]
+        if len(values) == 0:
+            return np.zeros(self.n_ttis.get(bs_id, 0), dtype=np.int64)
+        return np.sum(np.array(values, dtype=np.int64), axis=0)
+
+    def get_histogram(self, bs_id: int, slice_type: str = None, phase: str = None, bins: int = 50) -> Tuple[np.ndarray, np.ndarray]:
+        # Log-spaced bins, since TTI times have a long tail
+        values = self.get_series(bs_id, slice_type, phase)
+        values = values[values > 0]
+        if len(values) == 0:
+            return np.zeros(bins, dtype=np.int64), np.zeros(bins + 1)
+        edges = np.geomspace(values.min(), values.max() + 1, bins + 1)
+        counts, edges = np.histogram(values, bins=edges)
+        return counts, edges
+
+    def __get_row(self, bs_id: int, slice_type: str, phase: str, values: np.ndarray, total: np.ndarray, percentiles: List[float]) -> Dict:
+        row = {
+            "basestation": bs_id,
+            "slice_type": slice_type if slice_type is not None else "-",
+            "phase": phase,
+            "mean_us": np.mean(values)/1e3,
+            "share": np.sum(values)/np.sum(total) if np.sum(total) > 0 else 0.0, # Of the basestation TTI time
+        }
+        for q in percentiles:
+            row["p{}_us".format(q)] = np.percentile(values, q)/1e3
+        row["max_us"] = np.max(values)/1e3
+        return row
+
+    def get_summary(self, percentiles: List[float] = [50, 90, 99]) -> List[Dict]:
+        rows = []
+        for bs_id in sorted(self.n_ttis):
+            if self.n_ttis[bs_id] == 0:
+                continue
+            total = self.get_series(bs_id)
+            keys = sorted(
+                (k for k in self.series if k[0] == bs_id),
+                key=lambda k: (self.phases.index(k[2]) if k[2] in self.phases else len(self.phases), k[1] or ""),
+            )
+            for _, slice_type, phase in keys:
+                values = np.array(self.series[(bs_id, slice_type, phase)], dtype=np.int64)
+                rows.append(self.__get_row(bs_id, slice_type, phase, values, total, percentiles))
+            rows.append(self.__get_row(bs_id, None, "total", total, total, percentiles))
+        return rows
+
+    def print_summary(self, percentiles: List[float] = [50, 90, 99]) -> None:
+        rows = self.get_summary(percentiles)
+        if len(rows) == 0:
+            print("No TTI was profiled")
+            return
+        columns = list(rows[0].keys())
+        print(" ".join("{:>18}".format(c) for c in columns))
+        for row in rows:
+            print(" ".join(
+                "{:>18.3f}".format(row[c]) if isinstance(row[c], float) else "{:>18}".format(row[c])
+                for c in columns
+            ))
+
+    def save(self, path: str) -> None: # One ns-per-TTI column per basestation, slice type and phase
+        np.savez(path, **{
+            "bs{}/{}/{}".format(bs_id, slice_type if slice_type is not None else "all", phase): np.array(values, dtype=np.int64)
+            for (bs_id, slice_type, phase), values in self.series.items()
+        })
@@ -0,0 +1,185 @@
+import json
+import struct
+import zipfile
+import numpy as np
+from typing import Dict, List
+
+from simulation.simulation import Simulation
+from simulation.user import User
+from simulation.latency import LatencyHistogram
+
+basestation_hist_names = [
+    "hist_n_allocated_RBGs",
+    "scheduler_elapsed_time",
+    "hist_agent_reward",
+    "hist_agent_reward_cumulative",
+]
+slice_hist_names = [
+    "hist_n_allocated_RBGs",
+    "hist_allocated_throughput",
+]
+
+def get_column_name(bs_id: int, metric: str, slice_id: int = None, user_id: int = None) -> str:
+    name = "bs{}".format(bs_id)
+    if slice_id is not None:
+        name += "/slice{}".format(slice_id)
+    if user_id is not None:
+        name += "/user{}".format(user_id)
+    return name + "/" + metric
+
+def _to_json(o):
+    if isinstance(o, (set, tuple)):
+        return sorted(list(o)) if isinstance(o, set) else list(o)
+    if isinstance(o, np.generic):
+        return o.item()
+    raise TypeError("{} is not JSON serializable".format(type(o)))
+
+def export_results(sim: Simulation, path: str) -> None:
+    # Uncompressed .npz, so the reader can memory-map each column inside the zip
+    columns: Dict[str, np.ndarray] = {}
+    meta = {
+        "experiment_name": sim.experiment_name,
+        "option_5g": sim.option_5g,
+        "rbs_per_rbg": sim.rbs_per_rbg,
+        "TTI": sim.TTI,
+        "rb_bandwidth": sim.rb_bandwidth,
+        "step": sim.step,
+        "basestations": [],
+    }
+    for bs_id, bs in sim.basestations.items():
+        bs_meta = {
+            "id": bs_id,
+            "name": bs.name,
+            "n_rbgs": len(bs.rbgs),
+            "action_set": getattr(bs, "action_set", None),
+            "raw_action_set": getattr(bs, "raw_action_set", None),
+            "scheduler_latency": bs.scheduler_latency.get_state(),
+            "slices": [],
+        }
+        for name in basestation_hist_names:
+            columns[get_column_name(bs_id, name)] = np.asarray(getattr(bs, name))
+        columns[get_column_name(bs_id, "scheduler_latency_counts")] = bs.scheduler_latency.counts
+        for slice_id, s in bs.slices.items():
+            bs_meta["slices"].append({
+                "id": slice_id,
+                "type": s.type,
+                "requirements": s.requirements,
+                "max_lat": s.user_config.buff_config.max_lat,
+                "users": list(s.users.keys()),
+            })
+            for name in slice_hist_names:
+                columns[get_column_name(bs_id, name, slice_id)] = np.asarray(getattr(s, name))
+            for user_id, u in s.users.items():
+                for name in User.hist_names:
+                    columns[get_column_name(bs_id, name, slice_id, user_id)] = np.asarray(u.get_full_history(name))
+        meta["basestations"].append(bs_meta)
+    columns["meta"] = np.frombuffer(json.dumps(meta, default=_to_json).encode(), dtype=np.uint8)
+    with open(path, "wb") as f:
+        np.savez(f, **columns)
+
+class ResultReader:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.columns: Dict[str, tuple] = {} # name -> (offset, dtype, shape, fortran_order)
+        with zipfile.ZipFile(path) as z, open(path, "rb") as f:
+            for info in z.infolist():
+                if info.compress_type != zipfile.ZIP_STORED:
+                    raise Exception("Column {} of {} is compressed and cannot be memory-mapped".format(info.filename, path))
+                f.seek(info.header_offset)
+                local_header = struct.unpack("<4s5H3L2H", f.read(30))
+                f.seek(info.header_offset + 30 + local_header[9] + local_header[10])
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+                self.columns[info.filename[:-len(".npy")]] = (f.tell(), dtype, shape, fortran_order)
+        self.meta = json.loads(self.get_column("meta").tobytes())
+
+    def get_column(self, name: str) -> np.ndarray:
+        if name not in self.columns:
+            raise Exception("Column {} does not exist in {}".format(name, self.path))
+        offset, dtype, shape, fortran_order = self.columns[name]
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode="r", offset=offset, shape=shape, order="F" if fortran_order else "C")
+
+    def get(self, bs_id: int, metric: str, slice_id: int = None, user_id: int = None) -> np.ndarray:
+        return self.get_column(get_column_name(bs_id, metric, slice_id, user_id))
+
+# Views with the attributes of Simulation, BaseStation, Slice and User used by the plots,
+# whose histories are only read from the file when accessed
+class _ColumnView:
+    def __init__(self, reader: ResultReader, bs_id: int, slice_id: int = None, user_id: int = None) -> None:
+        self._reader = reader
+        self._bs_id = bs_id
+        self._slice_id = slice_id
+        self._user_id = user_id
+
+    def __getattr__(self, name: str):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        column = get_column_name(self._bs_id, name, self._slice_id, self._user_id)
+        if column not in self._reader.columns:
+            raise AttributeError(name)
+        value = self._reader.get_column(column)
+        setattr(self, name, value)
+        return value
+
+class ResultUser(_ColumnView):
+    def __init__(self, reader: ResultReader, bs_id: int, slice_id: int, user_id: int) -> None:
+        super().__init__(reader, bs_id, slice_id, user_id)
+        self.id = user_id
+
+class ResultSlice(_ColumnView):
+    def __init__(self, reader: ResultReader, bs_id: int, meta: Dict) -> None:
+        super().__init__(reader, bs_id, meta["id"])
+        self.id = meta["id"]
+        self.type = meta["type"]
+        self.requirements = meta["requirements"]
+        self.max_lat = meta["max_lat"]
+        self.users: Dict[int, ResultUser] = {u: ResultUser(reader, bs_id, self.id, u) for u in meta["users"]}
+
+    @property
+    def step(self) -> int:
+        return len(self.hist_allocated_throughput)
+
+class ResultBaseStation(_ColumnView):
+    def __init__(self, reader: ResultReader, meta: Dict) -> None:
+        super().__init__(reader, meta["id"])
+        self.id = meta["id"]
+        self.name = meta["name"]
+        self.rbgs = range(meta["n_rbgs"]) # Only its length is stored
+        self.action_set = set(tuple(a) for a in meta["action_set"]) if meta["action_set"] is not None else None
+        self.raw_action_set = set(tuple(a) for a in meta["raw_action_set"]) if meta["raw_action_set"] is not None else None
+        self._scheduler_latency_state = meta.get("scheduler_latency") # Missing in files saved before it was recorded
+        self._TTI = reader.meta["TTI"]
+        self.slices: Dict[int, ResultSlice] = {}
+        self.users: Dict[int, ResultUser] = {}
+        for slice_meta in meta["slices"]:
+            self.slices[slice_meta["id"]] = ResultSlice(reader, self.id, slice_meta)
+            self.users.update(self.slices[slice_meta["id"]].users)
+
+    @property
+    def scheduler_latency(self) -> LatencyHistogram:
+        if self._scheduler_latency_state is not None:
+            return LatencyHistogram.from_state(self._scheduler_latency_state, self.scheduler_latency_counts)
+        hist = LatencyHistogram(deadline=self._TTI)
+        hist.record_many(np.round(np.asarray(self.scheduler_elapsed_time)*1e9))
+        return hist
+
+class ResultSimulation:
+    def __init__(self, reader: ResultReader) -> None:
+        self.reader = reader
+        self.experiment_name = reader.meta["experiment_name"]
+        self.option_5g = reader.meta["option_5g"]
+        self.rbs_per_rbg = reader.meta["rbs_per_rbg"]
+        self.TTI = reader.meta["TTI"]
+        self.rb_bandwidth = reader.meta["rb_bandwidth"]
+        self.step = reader.meta["step"]
+        self.basestations: Dict[int, ResultBaseStation] = {
+            bs_meta["id"]: ResultBaseStation(reader, bs_meta) for bs_meta in reader.meta["basestations"]
+        }
+
+def load_results(path: str) -> ResultSimulation:
+    return ResultSimulation(ResultReader(path))
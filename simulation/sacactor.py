@@ -0,0 +1,160 @@
+import base64
+import io
+import json
+import os
+import pickle
+import zipfile
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+# Storage types of the torch zip format, saved as raw little-endian arrays
+storage_dtypes = {
+    "FloatStorage": np.float32,
+    "DoubleStorage": np.float64,
+    "HalfStorage": np.float16,
+    "LongStorage": np.int64,
+    "IntStorage": np.int32,
+    "BoolStorage": np.bool_,
+}
+
+class Placeholder: # Keeps the attributes of gymnasium, stable_baselines3 and torch objects without importing them
+    def __init__(self, *args, **kwargs) -> None:
+        self.args = args
+
+    def __setstate__(self, state) -> None:
+        self.__dict__.update(state if isinstance(state, dict) else {"state": state})
+
+class PlaceholderUnpickler(pickle.Unpickler):
+    def find_class(self, module: str, name: str):
+        if module.split(".")[0] in ["gymnasium", "gym", "stable_baselines3", "torch"]:
+            return type(name, (Placeholder,), {})
+        return super().find_class(module, name)
+
+def rebuild_tensor(storage: np.ndarray, offset: int, size: Tuple, stride: Tuple, *args) -> np.ndarray:
+    return np.lib.stride_tricks.as_strided(
+        storage[offset:],
+        shape=size,
+        strides=[s*storage.itemsize for s in stride],
+    ).copy()
+
+class TorchUnpickler(pickle.Unpickler): # Reads a state dict saved by torch.save as NumPy arrays
+    def __init__(self, file: io.BytesIO, archive: zipfile.ZipFile, prefix: str) -> None:
+        super().__init__(file)
+        self.archive = archive
+        self.prefix = prefix
+
+    def find_class(self, module: str, name: str):
+        if module == "torch._utils" and name == "_rebuild_tensor_v2":
+            return rebuild_tensor
+        elif module == "torch" and name in storage_dtypes:
+            return name
+        elif module == "collections" and name == "OrderedDict":
+            return OrderedDict
+        raise pickle.UnpicklingError("{}.{} is not supported".format(module, name))
+
+    def persistent_load(self, pid: Tuple) -> np.ndarray:
+        _, storage_type, key, _, _ = pid # ("storage", type, key, location, numel)
+        data = self.archive.read("{}data/{}".format(self.prefix, key))
+        return np.frombuffer(data, dtype=np.dtype(storage_dtypes[storage_type]).newbyteorder("<"))
+
+def load_state_dict(data: bytes) -> Dict[str, np.ndarray]:
+    archive = zipfile.ZipFile(io.BytesIO(data))
+    pkl_names = [n for n in archive.namelist() if n.endswith("data.pkl")]
+    if len(pkl_names) != 1:
+        raise Exception("Only the zip format of torch.save (torch >= 1.6) is supported")
+    prefix = pkl_names[0][:-len("data.pkl")]
+    return TorchUnpickler(io.BytesIO(archive.read(pkl_names[0])), archive, prefix).load()
+
+def load_serialized(item: Dict):
+    return PlaceholderUnpickler(io.BytesIO(base64.b64decode(item[":serialized:"]))).load()
+
+class SACActor:
+    # Deterministic actor of a stable_baselines3 SAC agent in NumPy, so evaluating the agent does
+    # not need torch. predict follows SAC.predict(obs, deterministic=True): the observation is
+    # cast to float32, goes through the latent_pi MLP and mu, and tanh(mu) is rescaled to the
+    # action space
+    def __init__(
+        self,
+        weights: List[np.ndarray],
+        biases: List[np.ndarray],
+        activation: str, # relu or tanh
+        action_low: np.ndarray,
+        action_high: np.ndarray,
+        obs_mean: np.ndarray = None, # VecNormalize statistics (None does not normalize)
+        obs_var: np.ndarray = None,
+        clip_obs: float = 10.0,
+        epsilon: float = 1e-8,
+    ) -> None:
+        self.weights_t = [np.ascontiguousarray(w.T, dtype=np.float32) for w in weights]
+        self.biases = [np.asarray(b, dtype=np.float32) for b in biases]
+        self.activation = activation
+        self.action_low = np.asarray(action_low, dtype=np.float32)
+        self.action_high = np.asarray(action_high, dtype=np.float32)
+        self.obs_mean = obs_mean
+        self.obs_std = np.sqrt(obs_var + epsilon) if obs_mean is not None else None
+        self.clip_obs = clip_obs
+
+    @staticmethod
+    def load(best_model_zip_path: str, vec_normalize_path: str = None) -> "SACActor":
+        # vec_normalize_path defaults to vec_normalize.pkl next to the zip, used only if it exists
+        with zipfile.ZipFile(best_model_zip_path) as f:
+            data = json.loads(f.read("data"))
+            state_dict = load_state_dict(f.read("policy.pth"))
+        policy_kwargs = data.get("policy_kwargs", {})
+        if ":serialized:" in policy_kwargs: # Saved with cloudpickle when it has classes (e.g. activation_fn)
+            policy_kwargs = load_serialized(policy_kwargs)
+        if policy_kwargs.get("use_sde", False):
+            raise Exception("SAC agents with gSDE are not supported")
+        activation = "relu"
+        if "activation_fn" in policy_kwargs:
+            activation = policy_kwargs["activation_fn"].__name__.lower()
+            if activation not in ["relu", "tanh"]:
+                raise Exception("Activation {} is not supported".format(activation))
+        layers = sorted(
+            int(k.split(".")[2]) for k in state_dict.keys()
+            if k.startswith("actor.latent_pi.") and k.endswith(".weight")
+        )
+        weights = [state_dict["actor.latent_pi.{}.weight".format(i)] for i in layers]
+        biases = [state_dict["actor.latent_pi.{}.bias".format(i)] for i in layers]
+        weights.append(state_dict["actor.mu.weight"])
+        biases.append(state_dict["actor.mu.bias"])
+        action_space = load_serialized(data["action_space"])
+
+        if vec_normalize_path is None:
+            vec_normalize_path = os.path.join(os.path.dirname(best_model_zip_path), "vec_normalize.pkl")
+        obs_mean, obs_var, clip_obs, epsilon = None, None, 10.0, 1e-8
+        if os.path.exists(vec_normalize_path):
+            with open(vec_normalize_path, "rb") as f:
+                vec_normalize = PlaceholderUnpickler(f).load()
+            if vec_normalize.norm_obs:
+                obs_mean, obs_var = vec_normalize.obs_rms.mean, vec_normalize.obs_rms.var
+                clip_obs, epsilon = vec_normalize.clip_obs, vec_normalize.epsilon
+        return SACActor(
+            weights=weights,
+            biases=biases,
+            activation=activation,
+            action_low=action_space.low,
+            action_high=action_space.high,
+            obs_mean=obs_mean,
+            obs_var=obs_var,
+            clip_obs=clip_obs,
+            epsilon=epsilon,
+        )
+
+    def predict(self, obs: np.ndarray, deterministic: bool = True) -> Tuple[np.ndarray, None]:
+        # Same signature and outputs as stable_baselines3.SAC.predict, so it replaces the agent
+        if not deterministic:
+            raise Exception("SACActor only predicts deterministic actions")
+        obs = np.asarray(obs)
+        if self.obs_mean is not None: # Same as VecNormalize.normalize_obs
+            obs = np.clip((obs - self.obs_mean)/self.obs_std, -self.clip_obs, self.clip_obs)
+        x = obs.astype(np.float32).reshape(-1, self.weights_t[0].shape[0])
+        for w, b in zip(self.weights_t[:-1], self.biases[:-1]):
+            x = x @ w + b
+            x = np.maximum(x, np.float32(0)) if self.activation == "relu" else np.tanh(x)
+        actions = np.tanh(x @ self.weights_t[-1] + self.biases[-1])
+        actions = self.action_low + (np.float32(0.5)*(actions + np.float32(1.0))*(self.action_high - self.action_low))
+        if obs.ndim == 1:
+            actions = actions[0]
+        return actions, None
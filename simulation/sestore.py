@@ -0,0 +1,100 @@
+import os
+import tempfile
+import numpy as np
+from typing import Dict
+
+class SETrial:
+    def __init__(
+        self,
+        se: np.ndarray, # (ue, tti) view of the store
+        multipliers: np.ndarray, # (ue,)
+    ) -> None:
+        self.se = se
+        self.multipliers = multipliers
+
+    def get(self, ue: int, step: int) -> float: # ue starts at 0, like the user ids
+        return float(self.se[ue, step]*self.multipliers[ue])
+
+    def get_ue(self, ue: int) -> np.ndarray:
+        return self.se[ue]*self.multipliers[ue]
+
+    def get_step(self, step: int) -> np.ndarray: # SE of every ue in the step
+        return self.se[:, step]*self.multipliers
+
+    def to_array(self) -> np.ndarray: # Contiguous (ue, tti) copy with the multipliers applied
+        return np.ascontiguousarray(self.se*self.multipliers[:, None])
+
+class SEStore:
+    def __init__(
+        self,
+        store_file: str = "se/se_store.npy", # (trial, subcarrier, ue, tti) array
+        multipliers: Dict[int, float] = None, # ue (starting at 1) -> multiplier
+        se_file_base_string: str = "se/trial{}_f{}_ue{}.npy", # Packed into store_file if it does not exist
+        n_trials: int = 50,
+        n_sub_carriers: int = 2,
+        n_ues: int = 10,
+    ) -> None:
+        if not os.path.exists(store_file):
+            SEStore.pack(store_file, se_file_base_string, n_trials, n_sub_carriers, n_ues)
+        self.store_file = store_file
+        self.se = np.load(store_file, mmap_mode="r")
+        if self.se.ndim != 4:
+            raise Exception("SE store {} must have shape (trial, subcarrier, ue, tti)".format(store_file))
+        self.multipliers = np.ones(self.se.shape[2])
+        if multipliers is not None:
+            for ue, multiplier in multipliers.items():
+                self.multipliers[ue-1] = multiplier
+
+    def __getstate__(self) -> Dict: # Worker processes reopen the file instead of copying it
+        state = self.__dict__.copy()
+        del state["se"]
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self.se = np.load(self.store_file, mmap_mode="r")
+
+    @staticmethod
+    def pack(
+        store_file: str,
+        se_file_base_string: str = "se/trial{}_f{}_ue{}.npy",
+        n_trials: int = 50,
+        n_sub_carriers: int = 2,
+        n_ues: int = 10,
+    ) -> None:
+        n_ttis = len(np.load(se_file_base_string.format(1, 1, 1), mmap_mode="r"))
+        # Written to a temporary file so an interrupted pack is never opened as a store. Each
+        # process packs into its own file, so several processes can create the store at once
+        fd, temp_file = tempfile.mkstemp(
+            suffix=".tmp.npy",
+            prefix=os.path.basename(store_file) + ".",
+            dir=os.path.dirname(os.path.abspath(store_file)),
+        )
+        os.close(fd)
+        try:
+            store = np.lib.format.open_memmap(
+                temp_file,
+                mode="w+",
+                dtype=np.float64,
+                shape=(n_trials, n_sub_carriers, n_ues, n_ttis),
+            )
+            for trial in range(n_trials):
+                for sub_carrier in range(n_sub_carriers):
+                    for ue in range(n_ues):
+                        store[trial, sub_carrier, ue] = np.load(se_file_base_string.format(trial+1, sub_carrier+1, ue+1))
+            store.flush()
+            del store
+            if os.path.exists(store_file): # Already created by another process
+                os.remove(temp_file)
+            else:
+                # mkstemp creates the file readable only by its owner
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(temp_file, 0o666 & ~umask)
+                os.replace(temp_file, store_file)
+        except BaseException:
+            os.remove(temp_file)
+            raise
+
+    def get_trial(self, trial: int, sub_carrier: int) -> SETrial: # trial and sub_carrier start at 1
+        return SETrial(self.se[trial-1, sub_carrier-1], self.multipliers)
@@ -1,6 +1,8 @@
 import numpy as np
 from typing import Dict, List
 import json
+import multiprocessing
+import threading
 
 from simulation.jsonencoder import Encoder
 import simulation.intersched as intersched
@@ -8,6 +10,41 @@ from simulation.basestation import BaseStation
 from simulation.slice import SliceConfiguration, Slice
 from simulation.user import User
 from simulation.intrasched import IntraSliceScheduler
+from simulation.history import HistoryConfiguration
+from simulation.sestore import SETrial
+from simulation.metricsink import MetricsSink
+from simulation.profiler import PhaseProfiler
+
+def _run_basestation_worker(
+    bs: BaseStation,
+    TTIs: int,
+    SEs: SETrial,
+    limiting_basestation_id: int,
+    n_lim_rbgs, # Shared array with the RBGs used by the limiting basestation in each TTI
+    barrier,
+    conn,
+) -> None:
+    try:
+        for step in range(TTIs):
+            for u in bs.users.values():
+                u.set_spectral_efficiency(SEs.get(u.id, u.step))
+            bs.arrive_pkts()
+            if limiting_basestation_id is None:
+                bs.schedule_rbgs()
+            elif bs.id == limiting_basestation_id:
+                bs.schedule_rbgs()
+                n_lim_rbgs[step] = sum(len(s.rbgs) for s in bs.slices.values())
+                barrier.wait()
+            else:
+                barrier.wait()
+                bs.schedule_rbgs(n_rbgs=n_lim_rbgs[step])
+            bs.transmit()
+        conn.send(bs)
+    except Exception as e:
+        if barrier is not None:
+            barrier.abort() # Releases the workers waiting for this one
+        conn.send(e)
+    conn.close()
 
 class Simulation:
     def __init__(
@@ -36,6 +73,10 @@ class Simulation:
         name: str,
         window_max: int,
         seed: int = None,
+        history_config: HistoryConfiguration = None,
+        engine: str = "object", # "object" or "pool"
+        per_user_rng: bool = False, # Independent rng stream per user, spawned from the seed
+        record_scheduler_times: bool = False, # Keeps every scheduling time besides the latency histogram
     ) -> int:
         self.basestations[self.basestation_id] = BaseStation(
             id=self.basestation_id,
@@ -45,6 +86,10 @@ class Simulation:
             scheduler=inter_scheduler,
             rng=np.random.default_rng(seed=seed),
             window_max=window_max,
+            history_config=history_config,
+            engine=engine,
+            user_seed_sequence=np.random.SeedSequence(seed) if per_user_rng else None,
+            record_scheduler_times=record_scheduler_times,
         )
         n_rbs = int(bandwidth/self.rb_bandwidth)
         n_rbgs = int(n_rbs/rbs_per_rbg)
@@ -96,5 +141,83 @@ class Simulation:
             bs.transmit()
         self.step += 1
     
+    def set_metrics_sink(self, sink: MetricsSink) -> None:
+        for bs in self.basestations.values():
+            bs.set_metrics_sink(sink)
+
+    def remove_metrics_sink(self) -> None:
+        for bs in self.basestations.values():
+            bs.remove_metrics_sink()
+
+    def set_profiler(self, profiler: PhaseProfiler) -> None:
+        for bs in self.basestations.values():
+            bs.set_profiler(profiler)
+
+    def remove_profiler(self) -> None:
+        for bs in self.basestations.values():
+            bs.remove_profiler()
+
+    def snapshot(self, history_tail: int = None) -> Dict: # Between TTIs
+        # Only the state that changes while running: restored into a simulation built with the same setup
+        return {
+            "experiment_name": self.experiment_name,
+            "step": self.step,
+            "basestations": {id: bs.snapshot(history_tail) for id, bs in self.basestations.items()},
+        }
+
+    def restore(self, snapshot: Dict) -> None:
+        if set(snapshot["basestations"]) != set(self.basestations):
+            raise Exception("Snapshot basestations {} do not match the simulation basestations {}".format(
+                sorted(snapshot["basestations"]), sorted(self.basestations)))
+        for id, bs in self.basestations.items():
+            bs.restore(snapshot["basestations"][id])
+        self.step = snapshot["step"]
+
+    def run_parallel(
+        self,
+        TTIs: int,
+        SEs: SETrial,
+        limiting_basestation_id: int = None, # The other basestations use only the RBGs it allocated
+        start_method: str = None,
+    ) -> None:
+        # Each basestation runs the whole TTIs loop in its own process and is sent back at the end
+        if any(bs.metrics_sink is not None for bs in self.basestations.values()):
+            raise Exception("run_parallel does not support metrics sinks")
+        if any(bs.profiler is not None for bs in self.basestations.values()):
+            raise Exception("run_parallel does not support profilers")
+        ctx = multiprocessing.get_context(start_method)
+        barrier = None
+        n_lim_rbgs = None
+        if limiting_basestation_id is not None:
+            if limiting_basestation_id not in self.basestations:
+                raise Exception("Basestation {} does not exist".format(limiting_basestation_id))
+            barrier = ctx.Barrier(len(self.basestations))
+            n_lim_rbgs = ctx.RawArray("i", TTIs)
+        conns = {}
+        processes = []
+        for bs_id, bs in self.basestations.items():
+            conn, worker_conn = ctx.Pipe(duplex=False)
+            process = ctx.Process(
+                target=_run_basestation_worker,
+                args=(bs, TTIs, SEs, limiting_basestation_id, n_lim_rbgs, barrier, worker_conn),
+            )
+            process.start()
+            worker_conn.close()
+            conns[bs_id] = conn
+            processes.append(process)
+        results = {bs_id: conn.recv() for bs_id, conn in conns.items()}
+        for process in processes:
+            process.join()
+        # The worker that failed first is reported instead of the ones released by the aborted barrier
+        errors = sorted(
+            (r for r in results.values() if isinstance(r, Exception)),
+            key=lambda e: isinstance(e, threading.BrokenBarrierError),
+        )
+        if len(errors) > 0:
+            raise errors[0]
+        for bs_id, result in results.items():
+            self.basestations[bs_id] = result
+        self.step += TTIs
+
     def __str__(self) -> str:
         return json.dumps(self.__dict__, cls=Encoder, indent=2)
\ No newline at end of file
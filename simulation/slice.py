@@ -2,11 +2,16 @@ import numpy as np
 from typing import Dict
 from typing import List
 import json
+import time
 
 from simulation.jsonencoder import Encoder
 from simulation.rbg import RBG
 from simulation.user import User, UserConfiguration
 from simulation.intrasched import IntraSliceScheduler, RoundRobin
+from simulation.history import HistoryConfiguration
+from simulation.userpool import UserPool, PooledUser
+from simulation.metricsink import MetricsSink
+from simulation.profiler import PhaseProfiler
 
 class SliceConfiguration:
     def __init__(
@@ -20,6 +25,11 @@ class SliceConfiguration:
         self.user_config = user_config
 
 class Slice:
+    hist_names = [
+        "hist_n_allocated_RBGs",
+        "hist_allocated_throughput",
+    ]
+
     def __init__(
         self,
         id: int,
@@ -28,6 +38,9 @@ class Slice:
         TTI:float, # s
         rng: np.random.BitGenerator,
         window_max: int,
+        history_config: HistoryConfiguration = None,
+        pool: UserPool = None, # Users are stored in the basestation UserPool when given
+        user_seed_sequence: np.random.SeedSequence = None, # Gives each user its own rng stream when given
     ) -> None:
         self.id = id
         self.type = config.type
@@ -36,13 +49,21 @@ class Slice:
         self.scheduler = scheduler
         self.TTI = TTI
         self.rng = rng
+        self.user_seed_sequence = user_seed_sequence
         self.window_max = window_max
+        self.history_config = history_config
+        self.pool = pool
+        self.pool_indexes = np.zeros(0, dtype=np.int64) # UserPool rows of the slice users
         self.step = 0
         self.window = 1
         self.users: Dict[int, User] = dict()
         self.rbgs: List[RBG] = []
         self.hist_n_allocated_RBGs: List[RBG] =[]
         self.hist_allocated_throughput:List[float] = []
+        self.metrics_sink: MetricsSink = None
+        self.metrics_prefix: str = None
+        self.profiler: PhaseProfiler = None
+        self.profiler_bs_id: int = None
 
     def reset(self) -> None:
         self.step = 0
@@ -52,25 +73,67 @@ class Slice:
         self.hist_allocated_throughput:List[float] = []
 
     def __hist_update_after_transmit(self) -> None:
+        if self.pool is not None:
+            self.hist_n_allocated_RBGs.append(int(self.pool.hist_n_allocated_RBGs.get_last()[self.pool_indexes].sum()))
+            self.hist_allocated_throughput.append(np.mean(self.pool.hist_allocated_throughput.get_last()[self.pool_indexes]))
+            return
         self.hist_n_allocated_RBGs.append(sum(u.hist_n_allocated_RBGs[-1] for u in self.users.values()))
         self.hist_allocated_throughput.append(np.mean([u.hist_allocated_throughput[-1] for u in self.users.values()]))
     
+    def get_user_rng(self, user_id: int) -> np.random.Generator:
+        if self.user_seed_sequence is None:
+            return self.rng
+        # Same stream as the child user_id of SeedSequence.spawn, independent of the order users are added
+        return np.random.default_rng(np.random.SeedSequence(
+            entropy=self.user_seed_sequence.entropy,
+            spawn_key=self.user_seed_sequence.spawn_key + (user_id,),
+        ))
+
     def generate_and_add_users(self, user_ids: List[int]) -> None:
+        if self.pool is not None: # Adding all users to the pool at once
+            pool_indexes = self.pool.add_users(
+                n_users=len(user_ids),
+                config=self.user_config,
+                slice_id=self.id,
+                rngs=[self.get_user_rng(id) for id in user_ids] if self.user_seed_sequence is not None else None,
+            )
+            for id, pool_index in zip(user_ids, pool_indexes):
+                self.add_user(user_id=id, pool_index=pool_index)
+            return
         for id in user_ids:
             self.add_user(user_id=id)
 
-    def add_user(self, user_id: int, user_config: UserConfiguration = None) -> None:
+    def add_user(self, user_id: int, user_config: UserConfiguration = None, pool_index: int = None) -> None:
         if user_id in self.users.values():
             raise Exception("User {} is already assigned to slice {}".format(user_id, self.id))
         if user_config is None:
             user_config = self.user_config
-        self.users[user_id] = User(
-            id=user_id,
-            TTI=self.TTI,
-            config=user_config,
-            rng=self.rng,
-            window_max=self.window_max,
-        )
+        if self.pool is not None:
+            if pool_index is None:
+                pool_index = self.pool.add_users(
+                    n_users=1,
+                    config=user_config,
+                    slice_id=self.id,
+                    rngs=[self.get_user_rng(user_id)] if self.user_seed_sequence is not None else None,
+                )[0]
+            self.users[user_id] = PooledUser(
+                id=user_id,
+                TTI=self.TTI,
+                config=user_config,
+                window_max=self.window_max,
+                pool=self.pool,
+                index=pool_index,
+            )
+            self.pool_indexes = np.append(self.pool_indexes, pool_index)
+        else:
+            self.users[user_id] = User(
+                id=user_id,
+                TTI=self.TTI,
+                config=user_config,
+                rng=self.get_user_rng(user_id),
+                window_max=self.window_max,
+                history_config=self.history_config,
+            )
         self.users[user_id].set_requirements(requirements=self.requirements)
 
     def update_user_requirements(self) -> None:
@@ -82,17 +145,84 @@ class Slice:
             u.set_demand_throughput(throughput=throughput)
     
     def arrive_pkts(self) -> None:
+        if self.pool is not None:
+            raise Exception("Pooled users receive packets through their basestation UserPool")
+        if self.profiler is not None:
+            start = time.perf_counter_ns()
         for u in self.users.values():
             u.arrive_pkts()
+        if self.profiler is not None:
+            self.profiler.add(self.profiler_bs_id, self.type, "arrive_pkts", time.perf_counter_ns() - start)
     
-    def transmit(self) -> None:
-        for u in self.users.values():
-            u.transmit()
+    def transmit(self) -> None: # Pooled users must be transmitted by the UserPool before
+        if self.pool is None:
+            for u in self.users.values():
+                u.transmit()
+        if self.profiler is not None:
+            start = time.perf_counter_ns()
+        if self.pool is not None and self.metrics_sink is not None:
+            self.__push_pool_metrics()
         self.step += 1
         self.window += 1
         if self.window > self.window_max:
             self.window = self.window_max
         self.__hist_update_after_transmit()
+        if self.metrics_sink is not None:
+            self.metrics_sink.push(self.metrics_prefix + "hist_n_allocated_RBGs", self.hist_n_allocated_RBGs[-1])
+            self.metrics_sink.push(self.metrics_prefix + "hist_allocated_throughput", self.hist_allocated_throughput[-1])
+        if self.profiler is not None:
+            self.profiler.add(self.profiler_bs_id, self.type, "slice_hist_update", time.perf_counter_ns() - start)
+
+    def set_metrics_sink(self, sink: MetricsSink, prefix: str) -> None:
+        self.metrics_sink = sink
+        self.metrics_prefix = prefix
+        for name in self.hist_names:
+            sink.push_many(prefix + name, getattr(self, name))
+        for u in self.users.values():
+            u.set_metrics_sink(sink, prefix + "user{}/".format(u.id))
+
+    def snapshot(self, history_tail: int) -> Dict: # Pooled users are kept by the UserPool snapshot
+        snapshot = {name: getattr(self, name)[-history_tail:] for name in self.hist_names}
+        snapshot.update({
+            "step": self.step,
+            "window": self.window,
+            "scheduler": self.scheduler.snapshot(),
+            "users": {id: u.snapshot(history_tail) for id, u in self.users.items()} if self.pool is None else None,
+            # Users with their own stream; the shared rng is kept by the basestation
+            "user_rngs": {id: u.rng.bit_generator.state for id, u in self.users.items()}
+                if self.pool is None and self.user_seed_sequence is not None else None,
+        })
+        return snapshot
+
+    def restore(self, snapshot: Dict) -> None:
+        if snapshot["users"] is not None and set(snapshot["users"]) != set(self.users):
+            raise Exception("Snapshot users {} do not match the users {} of slice {}".format(
+                sorted(snapshot["users"]), sorted(self.users), self.id))
+        for name in self.hist_names:
+            setattr(self, name, list(snapshot[name]))
+        self.step = snapshot["step"]
+        self.window = snapshot["window"]
+        self.scheduler.restore(snapshot["scheduler"])
+        self.clear_rbg_allocation()
+        for id, u in self.users.items():
+            if snapshot["users"] is not None:
+                u.restore(snapshot["users"][id])
+            else:
+                u.clear_rbg_allocation()
+            if snapshot["user_rngs"] is not None:
+                u.rng.bit_generator.state = snapshot["user_rngs"][id]
+
+    def set_profiler(self, profiler: PhaseProfiler, bs_id: int) -> None:
+        self.profiler = profiler
+        self.profiler_bs_id = bs_id
+        for u in self.users.values():
+            u.set_profiler(profiler, bs_id, self.type)
+
+    def __push_pool_metrics(self) -> None: # Last entries of the pooled users, read from the UserPool
+        for name in User.hist_names:
+            last = getattr(self.pool, name).get_last()
+            for u in self.users.values():
+                self.metrics_sink.push(u.metrics_prefix + name, last[u.index])
     
     def allocate_rbg(self, rbg:RBG) -> None:
         self.rbgs.append(rbg)
@@ -104,6 +234,8 @@ class Slice:
         self.scheduler.schedule(rbgs=self.rbgs, users=self.users)
 
     def get_avg_se(self) -> float:
+        if self.pool is not None:
+            return np.mean(self.pool.SE[self.pool_indexes])
         return np.mean([u.SE for u in self.users.values()])
         # if len(self.users) == 0:
         #     return 0
@@ -113,6 +245,8 @@ class Slice:
         # return result/len(self.users)
 
     def get_served_thr(self) -> float:
+        if self.pool is not None:
+            return np.mean((self.pool.bandwidth * self.pool.SE)[self.pool_indexes])
         return np.mean([u.get_actual_throughput() for u in self.users.values()])
         # if len(self.users) == 0 or self.step == 0:
         #     return 0
@@ -122,6 +256,8 @@ class Slice:
         # return result/len(self.users)
 
     def get_buffer_occupancy(self) -> float:
+        if self.pool is not None:
+            return np.mean((self.pool.buff_pkts*self.pool.pkt_size/self.pool.buffer_size)[self.pool_indexes])
         return np.mean([u.get_buffer_occupancy() for u in self.users.values()])
         # if len(self.users) == 0:
         #     return 0
@@ -133,6 +269,8 @@ class Slice:
     def get_avg_buffer_latency(self) -> float:
         if self.step == 0:
             return 0
+        if self.pool is not None:
+            return np.mean(self.pool.hist_avg_buff_lat.get_last()[self.pool_indexes])
         return np.mean([user.hist_avg_buff_lat[-1] for user in self.users.values()])
         # if len(self.users) == 0:
         #     return 0
@@ -144,6 +282,8 @@ class Slice:
     def get_pkt_loss_rate(self, window:int) -> float:
         if self.step == 0:
             return 0
+        if self.pool is not None:
+            return np.mean(self.pool.hist_pkt_loss.get_last()[self.pool_indexes])
         return np.mean([u.hist_pkt_loss[-1] for u in self.users.values()])
         # if len(self.users) == 0:
         #     return 0
@@ -155,6 +295,8 @@ class Slice:
     def get_sent_thr(self, window:int) -> float:
         if self.step == 0:
             return 0
+        if self.pool is not None:
+            return np.mean(self.pool.hist_sent_pkt_bits.get_last()[self.pool_indexes]/self.TTI)
         return np.mean([u.hist_sent_pkt_bits[-1]/self.TTI for u in self.users.values()])
         # if len(self.users) == 0 or self.step == 0:
         #     return 0
@@ -164,6 +306,8 @@ class Slice:
         # return result/len(self.users)
 
     def get_arriv_thr(self, window:int) -> float:
+        if self.pool is not None:
+            return np.mean(self.pool.hist_arriv_pkt_bits.get_last()[self.pool_indexes]/self.TTI)
         return np.mean([u.hist_arriv_pkt_bits[-1]/self.TTI for u in self.users.values()])
         # if len(self.users) == 0:
         #     return 0
@@ -175,6 +319,8 @@ class Slice:
     def get_long_term_thr(self, window:int) -> float:
         if self.step == 0:
             return 0
+        if self.pool is not None:
+            return np.mean(self.pool.hist_long_term_thr.get_last()[self.pool_indexes])
         return np.mean([u.hist_long_term_thr[-1] for u in self.users.values()])
         # if len(self.users) == 0 or self.step == 0:
         #     return 0
@@ -186,6 +332,8 @@ class Slice:
     def get_fifth_perc_thr(self, window:int) -> float:
         if self.step == 0:
             return 0
+        if self.pool is not None:
+            return np.mean(self.pool.hist_fifth_perc_thr.get_last()[self.pool_indexes])
         return np.mean([u.hist_fifth_perc_thr[-1] for u in self.users.values()])
         # if len(self.users) == 0 or self.step == 0:
         #     return 0
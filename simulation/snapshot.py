@@ -0,0 +1,17 @@
+import os
+import pickle
+
+from simulation.simulation import Simulation
+
+def save_snapshot(sim: Simulation, path: str, history_tail: int = None) -> None:
+    # Written to a temporary file first, so a run preempted while saving keeps the previous snapshot
+    if os.path.dirname(path) != "":
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(sim.snapshot(history_tail), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def load_snapshot(sim: Simulation, path: str) -> None: # sim must be built with the same setup as the saved one
+    with open(path, "rb") as f:
+        sim.restore(pickle.load(f))
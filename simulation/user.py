@@ -1,13 +1,18 @@
 import numpy as np
 from typing import List, Dict, Tuple
 import json
-from copy import copy
+import os
+import time
 
 from simulation.jsonencoder import Encoder
 from simulation.rbg import RBG
 from simulation.buffer import BufferConfiguration, DiscreteBuffer
 from simulation.flow import Flow, FlowConfiguration
 from simulation.packet import Packet
+from simulation.percentile import SlidingPercentile
+from simulation.history import HistoryConfiguration, get_spill_file, trim_history, remove_spill_file, load_history
+from simulation.metricsink import MetricsSink
+from simulation.profiler import PhaseProfiler
 
 class UserConfiguration:
     def __init__(
@@ -15,8 +20,15 @@ class UserConfiguration:
         max_lat: int, # TTIs
         buffer_size: int, # bits
         pkt_size: int, # bits
-        flow_type: str, # "poisson"
+        flow_type: str, # "poisson", "on_off", "mmpp" or "trace"
         flow_throughput: float, # bits/s
+        flow_block_size: int = 1, # TTIs of arrivals drawn at once
+        flow_on_ttis: float = None, # "on_off"
+        flow_off_ttis: float = None, # "on_off"
+        flow_mmpp_rates: List[float] = None, # "mmpp"
+        flow_mmpp_transitions: List[List[float]] = None, # "mmpp"
+        flow_trace_file: str = None, # "trace"
+        flow_trace_offset: int = 0, # "trace"
     ) -> None:
         self.buff_config = BufferConfiguration(
             max_lat=max_lat,
@@ -26,11 +38,31 @@ class UserConfiguration:
         self.flow_config = FlowConfiguration(
             type=flow_type,
             pkt_size=pkt_size,
-            throughput=flow_throughput
-        
+            throughput=flow_throughput,
+            block_size=flow_block_size,
+            on_ttis=flow_on_ttis,
+            off_ttis=flow_off_ttis,
+            mmpp_rates=flow_mmpp_rates,
+            mmpp_transitions=flow_mmpp_transitions,
+            trace_file=flow_trace_file,
+            trace_offset=flow_trace_offset,
         )
 
 class User:
+    hist_names = [ # Histories trimmed by the retention policy
+        "hist_allocated_throughput",
+        "hist_n_allocated_RBGs",
+        "hist_spectral_efficiency",
+        "hist_avg_buff_lat",
+        "hist_dropp_pkt_bits",
+        "hist_arriv_pkt_bits",
+        "hist_buff_pkt_bits",
+        "hist_fifth_perc_thr",
+        "hist_long_term_thr",
+        "hist_pkt_loss",
+        "hist_sent_pkt_bits",
+    ]
+
     def __init__(
         self,
         id: int,
@@ -38,6 +70,7 @@ class User:
         config: UserConfiguration,
         rng: np.random.BitGenerator,
         window_max: int,
+        history_config: HistoryConfiguration = None,
     ) -> None:
         self.id = id
         self.config = config
@@ -46,7 +79,25 @@ class User:
         self.step = 0
         self.window = 1
         self.TTI = TTI
-        self.buff = DiscreteBuffer(TTI=TTI, config=config.buff_config)
+        self.hist_retention = None
+        self.spill_prefix = None
+        if history_config is not None and history_config.retention is not None:
+            # Windowed metrics look back at most window_max+1 entries
+            self.hist_retention = max(history_config.retention, window_max + 1)
+            if history_config.spill_dir is not None:
+                self.spill_prefix = os.path.join(history_config.spill_dir, "user{}".format(id))
+        self.hist_offset = 0 # Number of history entries discarded from memory
+        self.metrics_sink: MetricsSink = None
+        self.metrics_prefix: str = None # Column prefix of the user in the metrics sink
+        self.profiler: PhaseProfiler = None
+        self.profiler_bs_id: int = None
+        self.profiler_slice_type: str = None
+        self.buff = DiscreteBuffer(
+            TTI=TTI,
+            config=config.buff_config,
+            hist_retention=self.hist_retention,
+            spill_prefix=self.spill_prefix + "_buff" if self.spill_prefix is not None else None,
+        )
         self.flow = Flow(TTI=TTI, config=config.flow_config, rng=self.rng)
         self.SE = None # bits/s.Hz
         self.requirements = None
@@ -59,9 +110,12 @@ class User:
         self.hist_arriv_pkt_bits:List[float] = []
         self.hist_buff_pkt_bits:List[float] = [0.0]
         self.hist_fifth_perc_thr:List[float] = []
+        self.fifth_perc_thr_window = SlidingPercentile(q=5) # Throughputs of the current window
         self.hist_long_term_thr:List[float] = []
         self.hist_pkt_loss:List[float] = []
         self.hist_sent_pkt_bits:List[float] = []
+        for name in self.hist_names:
+            remove_spill_file(self.__get_spill_file(name))
 
     def reset(self) -> None:
         self.step = 0
@@ -76,22 +130,88 @@ class User:
         self.hist_arriv_pkt_bits:List[float] = []
         self.hist_buff_pkt_bits:List[float] = [0.0]
         self.hist_fifth_perc_thr:List[float] = []
+        self.fifth_perc_thr_window.reset()
         self.hist_long_term_thr:List[float] = []
         self.hist_pkt_loss:List[float] = []
         self.hist_sent_pkt_bits:List[float] = []
+        self.hist_offset = 0
+        for name in self.hist_names:
+            remove_spill_file(self.__get_spill_file(name))
         self.buff.reset()
         self.flow.reset()
 
+    def __get_spill_file(self, name: str) -> str:
+        if self.spill_prefix is None:
+            return None
+        return get_spill_file(self.spill_prefix, name)
+
+    def __trim_histories(self) -> None:
+        n = len(self.hist_allocated_throughput) - self.hist_retention
+        for name in self.hist_names:
+            trim_history(getattr(self, name), n, self.__get_spill_file(name))
+        self.hist_offset += n
+
+    def get_full_history(self, name: str) -> np.ndarray:
+        return load_history(getattr(self, name), self.__get_spill_file(name))
+
+    def snapshot(self, history_tail: int) -> Dict: # Between TTIs, keeping the last history_tail TTIs of history
+        if len(self.hist_spectral_efficiency) != len(self.hist_allocated_throughput):
+            raise Exception("User {} can only be snapshotted between TTIs".format(self.id))
+        n = max(0, len(self.hist_allocated_throughput) - history_tail)
+        snapshot = {name: getattr(self, name)[n:] for name in self.hist_names}
+        snapshot.update({
+            "step": self.step,
+            "window": self.window,
+            "SE": self.SE,
+            "hist_offset": self.hist_offset + n,
+            "fifth_perc_thr_window": list(self.fifth_perc_thr_window.values),
+            "buff": self.buff.snapshot(history_tail),
+            "flow": self.flow.snapshot(),
+        })
+        return snapshot
+
+    def restore(self, snapshot: Dict) -> None:
+        for name in self.hist_names:
+            setattr(self, name, list(snapshot[name]))
+        self.step = snapshot["step"]
+        self.window = snapshot["window"]
+        self.SE = snapshot["SE"]
+        self.hist_offset = snapshot["hist_offset"]
+        self.fifth_perc_thr_window.values = list(snapshot["fifth_perc_thr_window"])
+        self.clear_rbg_allocation()
+        for name in self.hist_names: # The spilled entries do not belong to the restored run
+            remove_spill_file(self.__get_spill_file(name))
+        self.buff.restore(snapshot["buff"])
+        self.flow.restore(snapshot["flow"])
+
+    def set_metrics_sink(self, sink: MetricsSink, prefix: str) -> None: # Between TTIs
+        self.metrics_sink = sink
+        self.metrics_prefix = prefix
+        for name in self.hist_names: # Entries recorded before the sink was set
+            sink.push_many(prefix + name, self.get_full_history(name))
+
+    def set_profiler(self, profiler: PhaseProfiler, bs_id: int, slice_type: str) -> None:
+        self.profiler = profiler
+        self.profiler_bs_id = bs_id
+        self.profiler_slice_type = slice_type
+
+    def push_metrics(self) -> None:
+        for name in self.hist_names:
+            self.metrics_sink.push(self.metrics_prefix + name, getattr(self, name)[-1])
+
     def __hist_update_after_transmit(self) -> None:
         self.hist_allocated_throughput.append(self.get_actual_throughput())
+        self.fifth_perc_thr_window.insert(self.hist_allocated_throughput[-1])
+        while len(self.fifth_perc_thr_window) > self.window:
+            self.fifth_perc_thr_window.evict(self.hist_allocated_throughput[-len(self.fifth_perc_thr_window)])
         self.hist_n_allocated_RBGs.append(len(self.rbgs))
         self.hist_avg_buff_lat.append(self.get_avg_buffer_latency())
         self.hist_dropp_pkt_bits.append(self.buff.get_dropp_pkts_bits(window=1))
-        self.hist_fifth_perc_thr.append(np.percentile(self.hist_allocated_throughput[-self.window:], 5))
+        self.hist_fifth_perc_thr.append(self.fifth_perc_thr_window.get_percentile())
         self.hist_long_term_thr.append(np.mean(self.hist_allocated_throughput[-self.window:]))
         self.hist_sent_pkt_bits.append(self.buff.get_sent_pkts_bits(window=1))
         numerator = int(sum(self.hist_dropp_pkt_bits[-self.window:]))
-        denominator = int(sum(self.hist_arriv_pkt_bits[-self.window:]) + self.hist_buff_pkt_bits[self.step-self.window+1])
+        denominator = int(sum(self.hist_arriv_pkt_bits[-self.window:]) + self.hist_buff_pkt_bits[self.step-self.window+1-self.hist_offset])
         if denominator == 0:
             self.hist_pkt_loss.append(0)
         else:
@@ -115,12 +235,24 @@ class User:
         self.__hist_update_after_arrive()
 
     def transmit(self):
+        if self.profiler is not None:
+            start = time.perf_counter_ns()
         self.buff.transmit(throughput=self.get_actual_throughput())
+        if self.profiler is not None:
+            transmitted = time.perf_counter_ns()
+            self.profiler.add(self.profiler_bs_id, self.profiler_slice_type, "transmit", transmitted - start)
         self.__hist_update_after_transmit()
+        if self.metrics_sink is not None:
+            self.push_metrics()
         self.step += 1
         self.window += 1
         if self.window > self.window_max:
             self.window = self.window_max
+        # Trimming only when twice the retention is reached keeps the cost amortized O(1)
+        if self.hist_retention is not None and len(self.hist_allocated_throughput) >= 2*self.hist_retention:
+            self.__trim_histories()
+        if self.profiler is not None:
+            self.profiler.add(self.profiler_bs_id, self.profiler_slice_type, "user_hist_update", time.perf_counter_ns() - transmitted)
 
     def set_spectral_efficiency(self, SE: float) -> None:
         self.SE = SE
@@ -147,13 +279,16 @@ class User:
         return self.buff.hist_arriv_pkts[-1]
     
     def get_n_buff_pkts_waited_i_TTIs(self, i:int) -> int:
-        return self.buff.buff[i]
+        return self.buff.get_n_buff_pkts_waited_i_TTIs(i)
+
+    def get_n_buff_pkts_waited_at_least_i_TTIs(self, i:int) -> int:
+        return self.buff.get_n_buff_pkts_waited_at_least_i_TTIs(i)
 
     def get_max_lat(self) -> int:
         return self.buff.max_lat
     
     def get_buff_pkts(self, step: int) -> int:
-        return self.buff.hist_buff_pkts[step]
+        return self.buff.get_hist_buff_pkts(step)
     
     def get_arriv_pkts(self, window:int):
         return self.buff.get_arriv_pkts(window)
@@ -199,7 +334,7 @@ class User:
         return self.buff.get_arriv_thr(window)
     
     def get_buffer_array(self):
-        return copy(self.buff.buff)
+        return self.buff.get_buffer_array()
     
     def get_last_sent_pkts(self):
         return self.buff.hist_sent_pkts[-1]
@@ -212,6 +347,8 @@ class User:
     def get_fifth_perc_thr(self, window:int) -> float:
         if window < 1:
             raise Exception("window must be >= 1")
+        if window == len(self.fifth_perc_thr_window):
+            return self.fifth_perc_thr_window.get_percentile()
         return np.percentile(self.hist_allocated_throughput[-window:], 5)
 
     def __str__(self) -> str:
@@ -0,0 +1,453 @@
+import json
+import time
+import numpy as np
+from typing import Dict, List
+
+from simulation.jsonencoder import Encoder
+from simulation.rbg import RBG
+from simulation.buffer import BufferConfiguration, DiscreteBuffer
+from simulation.user import User, UserConfiguration
+from simulation.profiler import PhaseProfiler
+
+class HistoryMatrix:
+    def __init__(
+        self,
+        n_cols: int,
+        dtype: type = np.float64,
+        first_row: np.ndarray = None,
+    ) -> None:
+        self.data = np.zeros((16, n_cols), dtype=dtype)
+        self.n_rows = 0
+        if first_row is not None:
+            self.append(first_row)
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def append(self, row: np.ndarray) -> None:
+        if self.n_rows == self.data.shape[0]: # Doubling the capacity keeps appends amortized O(1)
+            self.data = np.concatenate((self.data, np.zeros_like(self.data)))
+        self.data[self.n_rows] = row
+        self.n_rows += 1
+
+    def get(self) -> np.ndarray:
+        return self.data[:self.n_rows]
+
+    def get_column(self, col: int) -> np.ndarray:
+        return self.data[:self.n_rows, col]
+
+    def get_last(self) -> np.ndarray:
+        return self.data[self.n_rows-1]
+
+    def get_window(self, window: int) -> np.ndarray:
+        return self.data[max(0, self.n_rows-window):self.n_rows]
+
+    def set(self, rows: np.ndarray) -> None:
+        self.data = np.zeros((max(16, 2*len(rows)), self.data.shape[1]), dtype=self.data.dtype)
+        self.data[:len(rows)] = rows
+        self.n_rows = len(rows)
+
+class UserPool:
+    buff_hist_names = [
+        "hist_dropp_max_lat_pkts",
+        "hist_dropp_buffer_full_pkts",
+        "hist_arriv_pkts",
+        "hist_sent_pkts",
+        "hist_buff_pkts",
+    ]
+    buff_cum_names = [
+        "cum_dropp_max_lat_pkts",
+        "cum_dropp_buffer_full_pkts",
+        "cum_arriv_pkts",
+        "cum_sent_pkts",
+    ]
+    snapshot_array_names = [ # Per-user state kept by snapshots besides the histories
+        "SE",
+        "flow_throughput",
+        "flow_part_pkt_bits",
+        "buff",
+        "buff_pkts",
+        "slot_in_pkts",
+        "partial_pkt_bits",
+        "total_sent_pkts",
+        "sum_sent_pkts_ttis_waited",
+    ]
+
+    def __init__(
+        self,
+        TTI: float, # s
+        rng: np.random.BitGenerator,
+        window_max: int,
+    ) -> None:
+        self.TTI = TTI
+        self.rng = rng
+        self.window_max = window_max
+        self.n_users = 0
+        self.max_lat = None
+        self.slice_ids = np.zeros(0, dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64) # Iteration order of the object engine (by slice)
+        self.pkt_size = np.zeros(0)
+        self.buffer_size = np.zeros(0)
+        self.flow_throughput = np.zeros(0)
+        self.flow_block_size = None
+        self.user_rngs: List[np.random.Generator] = None # Per-user streams (None uses the shared rng)
+        self.SE = np.zeros(0)
+        self.bandwidth = np.zeros(0)
+        self.n_rbgs = np.zeros(0, dtype=np.int64)
+        self.profiler: PhaseProfiler = None
+        self.profiler_bs_id: int = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.step = 0
+        self.window = 1
+        self.head = 0 # Ring buffer column of the packets that arrived in the current TTI
+        self.hist_offset = 0 # Number of history rows discarded from memory
+        self.SE = np.full(self.n_users, np.nan)
+        self.bandwidth = np.zeros(self.n_users)
+        self.n_rbgs = np.zeros(self.n_users, dtype=np.int64)
+        self.flow_part_pkt_bits = np.zeros(self.n_users)
+        self.flow_block: np.ndarray = None # Pre-drawn arrivals (n_users, flow_block_size)
+        self.flow_block_index = 0
+        self.buff = np.zeros((self.n_users, self.max_lat if self.max_lat is not None else 0), dtype=np.int64)
+        self.buff_pkts = np.zeros(self.n_users, dtype=np.int64)
+        # Packets accepted before each ring buffer column started receiving arrivals
+        self.slot_in_pkts = np.zeros_like(self.buff)
+        self.partial_pkt_bits = np.zeros(self.n_users)
+        self.total_sent_pkts = np.zeros(self.n_users, dtype=np.int64)
+        self.sum_sent_pkts_ttis_waited = np.zeros(self.n_users, dtype=np.int64)
+        for name in self.buff_hist_names:
+            setattr(self, name, HistoryMatrix(self.n_users, dtype=np.int64))
+        for name in self.buff_cum_names:
+            setattr(self, name, HistoryMatrix(self.n_users, dtype=np.int64, first_row=np.zeros(self.n_users)))
+        for name in User.hist_names:
+            setattr(self, name, HistoryMatrix(self.n_users, dtype=np.int64 if name == "hist_n_allocated_RBGs" else np.float64))
+        self.hist_buff_pkt_bits.append(np.zeros(self.n_users))
+
+    def add_users(
+        self,
+        n_users: int,
+        config: UserConfiguration,
+        slice_id: int,
+        rngs: List[np.random.Generator] = None,
+    ) -> List[int]:
+        if self.step > 0 or len(self.hist_arriv_pkts) > 0:
+            raise Exception("Cannot add users to a UserPool that already started")
+        if (rngs is None) != (self.user_rngs is None) and self.n_users > 0:
+            raise Exception("Users of a UserPool must all share the rng or all have their own")
+        if config.flow_config.type != "poisson":
+            raise Exception("UserPool does not support {} flows".format(config.flow_config.type))
+        if self.max_lat is not None and config.buff_config.max_lat != self.max_lat:
+            raise Exception("Every user of a UserPool must have the same max_lat")
+        if self.flow_block_size is not None and config.flow_config.block_size != self.flow_block_size:
+            raise Exception("Every user of a UserPool must have the same flow block_size")
+        self.max_lat = config.buff_config.max_lat
+        self.flow_block_size = config.flow_config.block_size
+        if rngs is not None:
+            self.user_rngs = (self.user_rngs or []) + list(rngs)
+        indexes = list(range(self.n_users, self.n_users + n_users))
+        self.n_users += n_users
+        self.slice_ids = np.concatenate((self.slice_ids, np.full(n_users, slice_id, dtype=np.int64)))
+        self.order = np.argsort(self.slice_ids, kind="stable")
+        self.pkt_size = np.concatenate((self.pkt_size, np.full(n_users, config.buff_config.pkt_size, dtype=np.float64)))
+        self.buffer_size = np.concatenate((self.buffer_size, np.full(n_users, config.buff_config.buffer_size, dtype=np.float64)))
+        self.flow_throughput = np.concatenate((self.flow_throughput, np.full(n_users, config.flow_config.throughput, dtype=np.float64)))
+        self.reset()
+        return indexes
+
+    def __generate_pkts(self) -> np.ndarray:
+        if self.user_rngs is not None:
+            return self.__generate_pkts_per_user()
+        # Drawing in the object engine order consumes the rng exactly like one Flow per user
+        if self.flow_block_size == 1:
+            n_arrivals = np.empty(self.n_users, dtype=np.int64)
+            n_arrivals[self.order] = self.rng.poisson(self.flow_throughput[self.order])
+        else:
+            if self.flow_block is None or self.flow_block_index == self.flow_block_size:
+                self.flow_block = np.empty((self.n_users, self.flow_block_size), dtype=np.int64)
+                self.flow_block[self.order] = self.rng.poisson(
+                    self.flow_throughput[self.order][:, None],
+                    size=(self.n_users, self.flow_block_size),
+                )
+                self.flow_block_index = 0
+            n_arrivals = self.flow_block[:, self.flow_block_index]
+            self.flow_block_index += 1
+        return self.__arrivals_to_pkts(n_arrivals)
+
+    def __generate_pkts_per_user(self) -> np.ndarray:
+        # Each user draws from its own stream, so the order of the draws does not matter
+        if self.flow_block is None or self.flow_block_index == self.flow_block_size:
+            self.flow_block = np.empty((self.n_users, self.flow_block_size), dtype=np.int64)
+            for i, rng in enumerate(self.user_rngs):
+                if self.flow_block_size == 1:
+                    self.flow_block[i, 0] = rng.poisson(self.flow_throughput[i])
+                else:
+                    self.flow_block[i] = rng.poisson(self.flow_throughput[i], size=self.flow_block_size)
+            self.flow_block_index = 0
+        n_arrivals = self.flow_block[:, self.flow_block_index]
+        self.flow_block_index += 1
+        return self.__arrivals_to_pkts(n_arrivals)
+
+    def __arrivals_to_pkts(self, n_arrivals: np.ndarray) -> np.ndarray:
+        bits = n_arrivals*self.TTI + self.flow_part_pkt_bits
+        pkts = (bits/self.pkt_size).astype(np.int64)
+        self.flow_part_pkt_bits = bits - pkts*self.pkt_size
+        return pkts
+
+    def arrive_pkts(self) -> None:
+        n_pkts = self.__generate_pkts()
+        self.hist_buff_pkts.append(self.buff_pkts)
+        self.hist_arriv_pkts.append(n_pkts)
+        self.cum_arriv_pkts.append(self.cum_arriv_pkts.get_last() + n_pkts)
+        excess_bits = n_pkts*self.pkt_size + self.buff_pkts*self.pkt_size - self.buffer_size
+        dropped_pkts = np.where(excess_bits > 0, np.ceil(excess_bits/self.pkt_size), 0).astype(np.int64)
+        self.hist_dropp_buffer_full_pkts.append(dropped_pkts)
+        self.cum_dropp_buffer_full_pkts.append(self.cum_dropp_buffer_full_pkts.get_last() + dropped_pkts)
+        self.buff[:, self.head] += n_pkts - dropped_pkts
+        self.buff_pkts += n_pkts - dropped_pkts
+        self.hist_spectral_efficiency.append(self.SE)
+        self.hist_arriv_pkt_bits.append(n_pkts*self.pkt_size)
+
+    def __transmit_buffers(self, throughput: np.ndarray) -> None:
+        n_bits = throughput*self.TTI + self.partial_pkt_bits
+        real_pkts = n_bits/self.pkt_size
+        int_pkts = real_pkts.astype(np.int64)
+        self.partial_pkt_bits = (real_pkts - int_pkts)*self.pkt_size
+        ages = np.arange(self.max_lat)[::-1] # Oldest packets are sent first
+        slots = (self.head + ages) % self.max_lat
+        queued = self.buff[:, slots]
+        queued_before = np.cumsum(queued, axis=1) - queued
+        sent = np.minimum(queued, np.maximum(int_pkts[:, None] - queued_before, 0))
+        self.buff[:, slots] -= sent
+        sent_pkts = sent.sum(axis=1)
+        self.buff_pkts -= sent_pkts
+        self.total_sent_pkts += sent_pkts
+        self.sum_sent_pkts_ttis_waited += sent @ ages
+        self.hist_sent_pkts.append(sent_pkts)
+        self.cum_sent_pkts.append(self.cum_sent_pkts.get_last() + sent_pkts)
+
+        # Advancing the buffers
+        oldest = (self.head - 1) % self.max_lat
+        expired = self.buff[:, oldest].copy()
+        self.hist_dropp_max_lat_pkts.append(expired)
+        self.cum_dropp_max_lat_pkts.append(self.cum_dropp_max_lat_pkts.get_last() + expired)
+        self.partial_pkt_bits[expired > 0] = 0
+        self.buff_pkts -= expired
+        self.buff[:, oldest] = 0
+        self.head = oldest
+        self.slot_in_pkts[:, oldest] = self.cum_arriv_pkts.get_last() - self.cum_dropp_buffer_full_pkts.get_last()
+
+    def get_n_buff_pkts_waited_at_least_i_TTIs(self, i: np.ndarray) -> np.ndarray:
+        # DiscreteBuffer.get_n_buff_pkts_waited_at_least_i_TTIs of every user, with one i per user
+        i = np.asarray(i, dtype=np.int64)
+        rows = np.arange(self.n_users)
+        out_pkts = self.total_sent_pkts + self.cum_dropp_max_lat_pkts.get_last() # Sent or expired
+        older = np.maximum(0, self.slot_in_pkts[rows, (self.head + np.maximum(i, 1) - 1) % self.max_lat] - out_pkts)
+        return np.where(i <= 0, self.buff_pkts, np.where(i >= self.max_lat, 0, older))
+
+    def transmit(self) -> None:
+        if np.isnan(self.SE).any():
+            raise Exception("Spectral Efficiency not defined for every user of the pool")
+        throughput = self.bandwidth * self.SE
+        if self.profiler is not None:
+            start = time.perf_counter_ns()
+        self.__transmit_buffers(throughput)
+        if self.profiler is not None:
+            transmitted = time.perf_counter_ns()
+            self.profiler.add(self.profiler_bs_id, None, "transmit", transmitted - start)
+
+        self.hist_allocated_throughput.append(throughput)
+        self.hist_n_allocated_RBGs.append(self.n_rbgs)
+        latency = np.divide(self.sum_sent_pkts_ttis_waited, self.total_sent_pkts, out=np.zeros(self.n_users), where=self.total_sent_pkts > 0)
+        self.hist_avg_buff_lat.append(latency*self.TTI)
+        dropp_max_lat_pkts = self.hist_dropp_max_lat_pkts.get_last() if self.step + 1 >= self.max_lat else 0
+        self.hist_dropp_pkt_bits.append((dropp_max_lat_pkts + self.hist_dropp_buffer_full_pkts.get_last())*self.pkt_size)
+        thr_window = self.hist_allocated_throughput.get_window(self.window)
+        self.hist_fifth_perc_thr.append(np.percentile(thr_window, 5, axis=0))
+        # Contiguous rows make np.mean sum in the same order as for a single user's list
+        self.hist_long_term_thr.append(np.mean(thr_window.T.copy(), axis=1))
+        self.hist_sent_pkt_bits.append(self.hist_sent_pkts.get_last()*self.pkt_size)
+        numerator = self.hist_dropp_pkt_bits.get_window(self.window).sum(axis=0)
+        denominator = self.hist_arriv_pkt_bits.get_window(self.window).sum(axis=0) + self.hist_buff_pkt_bits.get()[self.step-self.window+1-self.hist_offset]
+        self.hist_pkt_loss.append(np.divide(numerator, denominator, out=np.zeros(self.n_users), where=denominator != 0))
+        self.hist_buff_pkt_bits.append(self.buff_pkts*self.pkt_size)
+
+        self.step += 1
+        self.window += 1
+        if self.window > self.window_max:
+            self.window = self.window_max
+        if self.profiler is not None:
+            self.profiler.add(self.profiler_bs_id, None, "user_hist_update", time.perf_counter_ns() - transmitted)
+
+    def snapshot(self, history_tail: int) -> Dict: # Between TTIs, keeping the last history_tail TTIs of history
+        if len(self.hist_arriv_pkts) + self.hist_offset != self.step:
+            raise Exception("UserPool can only be snapshotted between TTIs")
+        n = max(0, len(self.hist_arriv_pkts) - history_tail)
+        snapshot = {
+            name: getattr(self, name).get()[n:].copy()
+            for name in self.buff_hist_names + self.buff_cum_names + User.hist_names
+        }
+        for name in self.snapshot_array_names:
+            snapshot[name] = getattr(self, name).copy()
+        snapshot.update({
+            "step": self.step,
+            "window": self.window,
+            "head": self.head,
+            "hist_offset": self.hist_offset + n,
+            "flow_block": self.flow_block.copy() if self.flow_block is not None else None,
+            "flow_block_index": self.flow_block_index,
+            "user_rngs": [rng.bit_generator.state for rng in self.user_rngs] if self.user_rngs is not None else None,
+        })
+        return snapshot
+
+    def restore(self, snapshot: Dict) -> None:
+        if snapshot["buff"].shape != self.buff.shape:
+            raise Exception("Snapshot has {} pooled users with max_lat {} instead of {} with max_lat {}".format(
+                snapshot["buff"].shape[0], snapshot["buff"].shape[1], self.n_users, self.max_lat))
+        for name in self.buff_hist_names + self.buff_cum_names + User.hist_names:
+            getattr(self, name).set(snapshot[name])
+        for name in self.snapshot_array_names:
+            setattr(self, name, snapshot[name].copy())
+        self.step = snapshot["step"]
+        self.window = snapshot["window"]
+        self.head = snapshot["head"]
+        self.hist_offset = snapshot["hist_offset"]
+        self.flow_block = snapshot["flow_block"].copy() if snapshot["flow_block"] is not None else None
+        self.flow_block_index = snapshot["flow_block_index"]
+        if snapshot["user_rngs"] is not None:
+            for rng, state in zip(self.user_rngs, snapshot["user_rngs"]):
+                rng.bit_generator.state = state
+
+    def __str__(self) -> str:
+        return json.dumps(self.__dict__, cls=Encoder, indent=2)
+
+class PooledBuffer(DiscreteBuffer): # DiscreteBuffer getters over one row of a UserPool
+    def __init__(
+        self,
+        pool: UserPool,
+        index: int,
+        TTI: float, # s
+        config: BufferConfiguration,
+    ) -> None:
+        self.pool = pool
+        self.index = index
+        self.TTI = TTI
+        self.max_lat = config.max_lat
+        self.buffer_size = config.buffer_size
+        self.pkt_size = config.pkt_size
+        self.hist_retention = None
+        self.spill_prefix = None
+
+    step = property(lambda self: self.pool.step)
+    head = property(lambda self: self.pool.head)
+    hist_offset = property(lambda self: self.pool.hist_offset)
+    buff = property(lambda self: self.pool.buff[self.index])
+    buff_pkts = property(lambda self: int(self.pool.buff_pkts[self.index]))
+    slot_in_pkts = property(lambda self: self.pool.slot_in_pkts[self.index])
+    partial_pkt_bits = property(lambda self: float(self.pool.partial_pkt_bits[self.index]))
+    total_sent_pkts = property(lambda self: int(self.pool.total_sent_pkts[self.index]))
+    sum_sent_pkts_ttis_waited = property(lambda self: int(self.pool.sum_sent_pkts_ttis_waited[self.index]))
+    hist_dropp_max_lat_pkts = property(lambda self: self.pool.hist_dropp_max_lat_pkts.get_column(self.index))
+    hist_dropp_buffer_full_pkts = property(lambda self: self.pool.hist_dropp_buffer_full_pkts.get_column(self.index))
+    hist_arriv_pkts = property(lambda self: self.pool.hist_arriv_pkts.get_column(self.index))
+    hist_sent_pkts = property(lambda self: self.pool.hist_sent_pkts.get_column(self.index))
+    hist_buff_pkts = property(lambda self: self.pool.hist_buff_pkts.get_column(self.index))
+    cum_dropp_max_lat_pkts = property(lambda self: self.pool.cum_dropp_max_lat_pkts.get_column(self.index))
+    cum_dropp_buffer_full_pkts = property(lambda self: self.pool.cum_dropp_buffer_full_pkts.get_column(self.index))
+    cum_arriv_pkts = property(lambda self: self.pool.cum_arriv_pkts.get_column(self.index))
+    cum_sent_pkts = property(lambda self: self.pool.cum_sent_pkts.get_column(self.index))
+
+    def reset(self) -> None:
+        raise Exception("Pooled buffers are reset by their UserPool")
+
+    def arrive_pkts(self, n_pkts: int) -> None:
+        raise Exception("Pooled buffers are updated by their UserPool")
+
+    def transmit(self, throughput: float) -> None:
+        raise Exception("Pooled buffers are updated by their UserPool")
+
+    def get_n_buff_pkts_waited_i_TTIs(self, i: int) -> int:
+        return int(self.pool.buff[self.index, (self.pool.head + i) % self.max_lat])
+
+    def get_buffer_array(self) -> List[int]:
+        return np.roll(self.pool.buff[self.index], -self.pool.head).tolist()
+
+class PooledUser(User): # User getters over one row of a UserPool
+    def __init__(
+        self,
+        id: int,
+        TTI: float, # s
+        config: UserConfiguration,
+        window_max: int,
+        pool: UserPool,
+        index: int,
+    ) -> None:
+        self.id = id
+        self.config = config
+        self.rng = pool.user_rngs[index] if pool.user_rngs is not None else pool.rng
+        self.window_max = window_max
+        self.TTI = TTI
+        self.pool = pool
+        self.index = index
+        self.hist_retention = None
+        self.spill_prefix = None
+        self.hist_offset = 0
+        self.metrics_sink = None
+        self.metrics_prefix = None
+        self.profiler = None # The UserPool is profiled instead
+        self.profiler_bs_id = None
+        self.profiler_slice_type = None
+        self.buff = PooledBuffer(pool=pool, index=index, TTI=TTI, config=config.buff_config)
+        self.requirements = None
+        self.rbgs: List[RBG] = []
+
+    step = property(lambda self: self.pool.step)
+    window = property(lambda self: self.pool.window)
+    SE = property(lambda self: None if np.isnan(self.pool.SE[self.index]) else float(self.pool.SE[self.index]))
+    hist_allocated_throughput = property(lambda self: self.pool.hist_allocated_throughput.get_column(self.index))
+    hist_n_allocated_RBGs = property(lambda self: self.pool.hist_n_allocated_RBGs.get_column(self.index))
+    hist_spectral_efficiency = property(lambda self: self.pool.hist_spectral_efficiency.get_column(self.index))
+    hist_avg_buff_lat = property(lambda self: self.pool.hist_avg_buff_lat.get_column(self.index))
+    hist_dropp_pkt_bits = property(lambda self: self.pool.hist_dropp_pkt_bits.get_column(self.index))
+    hist_arriv_pkt_bits = property(lambda self: self.pool.hist_arriv_pkt_bits.get_column(self.index))
+    hist_buff_pkt_bits = property(lambda self: self.pool.hist_buff_pkt_bits.get_column(self.index))
+    hist_fifth_perc_thr = property(lambda self: self.pool.hist_fifth_perc_thr.get_column(self.index))
+    hist_long_term_thr = property(lambda self: self.pool.hist_long_term_thr.get_column(self.index))
+    hist_pkt_loss = property(lambda self: self.pool.hist_pkt_loss.get_column(self.index))
+    hist_sent_pkt_bits = property(lambda self: self.pool.hist_sent_pkt_bits.get_column(self.index))
+
+    def reset(self) -> None: # The histories are reset by the UserPool
+        self.clear_rbg_allocation()
+
+    def arrive_pkts(self):
+        raise Exception("Pooled users are updated by their UserPool")
+
+    def transmit(self):
+        raise Exception("Pooled users are updated by their UserPool")
+
+    def get_actual_throughput(self) -> float:
+        if self.SE is None:
+            raise Exception("Spectral Efficiency not defined for User {}".format(self.id))
+        return float(self.pool.bandwidth[self.index] * self.pool.SE[self.index])
+
+    def set_spectral_efficiency(self, SE: float) -> None:
+        self.pool.SE[self.index] = SE
+
+    def set_flow_throughput(self, throughput:float): # Discards the pre-drawn arrivals of the whole pool
+        self.pool.flow_throughput[self.index] = throughput
+        self.pool.flow_block = None
+
+    def allocate_rbg(self, rbg:RBG) -> None:
+        self.rbgs.append(rbg)
+        self.pool.bandwidth[self.index] += rbg.bandwidth
+        self.pool.n_rbgs[self.index] += 1
+
+    def clear_rbg_allocation(self) -> None:
+        self.rbgs: List[RBG] = []
+        self.pool.bandwidth[self.index] = 0.0
+        self.pool.n_rbgs[self.index] = 0
+
+    def get_fifth_perc_thr(self, window:int) -> float:
+        if window < 1:
+            raise Exception("window must be >= 1")
+        return np.percentile(self.hist_allocated_throughput[-window:], 5)
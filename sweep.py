@@ -0,0 +1,179 @@
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+import numpy as np
+from itertools import product
+from tqdm import tqdm
+from typing import Dict, List, Tuple
+
+from simulation.simulation import Simulation
+from simulation.sestore import SEStore
+from simulation.sacactor import SACActor
+from main import create_simulation, run_experiment
+from benchmark import positive_int
+
+SE_multipliers = {
+    1: 1.0,
+    2: 1.0,
+    3: 1.0,
+    4: 2.0,
+    5: 2.0,
+    6: 2.0,
+    7: 2.0,
+    8: 2.0,
+    9: 2.0,
+    10: 2.0,
+}
+
+job_columns = ["experiment", "trial", "seed", "load_multiplier"]
+metric_columns = [
+    "avg_rbg_alloc", # ratio of the basestation RBGs
+    "avg_serv_thr", # bits/s
+    "avg_buff_lat", # s
+    "avg_pkt_loss", # ratio
+    "avg_long_term_thr", # bits/s
+    "avg_fifth_perc_thr", # bits/s
+    "disr_serv_thr", # (step, user) pairs not meeting the requirement
+    "disr_buff_lat",
+    "disr_pkt_loss",
+    "disr_long_term_thr",
+    "disr_fifth_perc_thr",
+]
+columns = job_columns + ["basestation", "slice"] + metric_columns
+
+# Loaded once per worker process
+worker_agent = None
+worker_se_store: SEStore = None
+
+def init_worker(best_model_zip_path: str) -> None:
+    global worker_agent, worker_se_store
+    worker_agent = SACActor.load(best_model_zip_path)
+    worker_se_store = SEStore(multipliers=SE_multipliers)
+
+def get_summary(sim: Simulation) -> List[Dict]:
+    rows = []
+    for bs in sim.basestations.values():
+        for s in bs.slices.values():
+            users = list(s.users.values())
+            thr = np.array([u.hist_allocated_throughput for u in users])
+            lat = np.array([u.hist_avg_buff_lat for u in users])
+            loss = np.array([u.hist_pkt_loss for u in users])
+            long = np.array([u.hist_long_term_thr for u in users])
+            fifth = np.array([u.hist_fifth_perc_thr for u in users])
+            row = {
+                "basestation": bs.name,
+                "slice": s.type,
+                "avg_rbg_alloc": np.mean(s.hist_n_allocated_RBGs)/len(bs.rbgs),
+                "avg_serv_thr": np.mean(thr),
+                "avg_buff_lat": np.mean(lat),
+                "avg_pkt_loss": np.mean(loss),
+                "avg_long_term_thr": np.mean(long),
+                "avg_fifth_perc_thr": np.mean(fifth),
+            }
+            # Same requirements counted by Plotter.plot_disrespected_steps
+            if s.type in ["eMBB", "URLLC"]:
+                row["disr_serv_thr"] = int(np.sum(thr < s.requirements["throughput"]))
+                row["disr_buff_lat"] = int(np.sum(lat > s.requirements["latency"]*sim.TTI))
+                row["disr_pkt_loss"] = int(np.sum(loss > s.requirements["pkt_loss"]))
+            elif s.type == "BE":
+                row["disr_long_term_thr"] = int(np.sum(long < s.requirements["long_term_thr"]))
+                row["disr_fifth_perc_thr"] = int(np.sum(fifth < s.requirements["fifth_perc_thr"]))
+            rows.append(row)
+    return rows
+
+def run_job(job: Tuple[str, int, int, float], TTIs: int) -> List[Dict]:
+    experiment, trial, seed, load_multiplier = job
+    sim, bs_ids = create_simulation(
+        experiment_name=experiment,
+        seed=seed,
+        load_multiplier=load_multiplier,
+        sac_agent=worker_agent,
+    )
+    SEs = worker_se_store.get_trial(trial, 2)
+    run_experiment(sim, bs_ids, SEs, TTIs=TTIs, progress=False)
+    rows = get_summary(sim)
+    for row in rows:
+        row.update(dict(zip(job_columns, job)))
+    return rows
+
+def run_job_star(args: Tuple) -> List[Dict]:
+    return run_job(*args)
+
+def get_job_key(row: Dict) -> Tuple[str, int, int, float]:
+    return (row["experiment"], int(row["trial"]), int(row["seed"]), float(row["load_multiplier"]))
+
+def has_job_key(row: Dict) -> bool: # False for rows cut before the key columns
+    return all(row.get(c) not in [None, ""] for c in job_columns + ["basestation", "slice"])
+
+def get_n_job_rows(experiment: str, sac_agent) -> int: # One row per basestation and slice
+    sim, _ = create_simulation(experiment_name=experiment, sac_agent=sac_agent)
+    return sum(len(bs.slices) for bs in sim.basestations.values())
+
+def read_done_jobs(results_file: str, n_job_rows: Dict[str, int]) -> set:
+    # A job is done once all of its rows are in the file. The rows of unfinished jobs and an
+    # unfinished last line (from an interrupted sweep) are removed, so the jobs run again
+    if not os.path.exists(results_file):
+        return set()
+    with open(results_file, newline="") as f:
+        text = f.read()
+    complete_text = text[:text.rfind("\n") + 1]
+    reader = csv.DictReader(io.StringIO(complete_text))
+    rows = list(reader)
+    job_rows: Dict[Tuple, set] = {}
+    for row in rows:
+        if has_job_key(row):
+            job_rows.setdefault(get_job_key(row), set()).add((row["basestation"], row["slice"]))
+    done = set(key for key, pairs in job_rows.items() if len(pairs) == n_job_rows.get(key[0]))
+    kept = [row for row in rows if has_job_key(row) and get_job_key(row) in done]
+    if complete_text != text or len(kept) != len(rows):
+        temp_file = results_file + ".tmp"
+        with open(temp_file, "w", newline="") as f:
+            if reader.fieldnames is not None:
+                writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
+                writer.writeheader()
+                writer.writerows(kept)
+        os.replace(temp_file, results_file)
+    return done
+
+def parse_range(value: str) -> List[int]: # "1-50" or "1,7,46"
+    if "-" in value:
+        start, end = value.split("-")
+        return list(range(int(start), int(end)+1))
+    return [int(v) for v in value.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the experiments over a grid of SE trials, seeds and loads")
+    parser.add_argument("--experiments", nargs="+", default=["standard", "minimum"], choices=["standard", "minimum", "full"])
+    parser.add_argument("--trials", type=parse_range, default=parse_range("1-50"), help="1-50 or 1,7,46")
+    parser.add_argument("--seeds", type=parse_range, default=[1], help="1-5 or 1,2")
+    parser.add_argument("--load-multipliers", type=float, nargs="+", default=[1.0])
+    parser.add_argument("--TTIs", type=positive_int, default=2000)
+    parser.add_argument("--workers", type=positive_int, default=os.cpu_count())
+    parser.add_argument("--output", default="./experiment_data/sweep_results.csv")
+    parser.add_argument("--best-model", default="./best_sac/best_model.zip")
+    args = parser.parse_args()
+
+    jobs = list(product(args.experiments, args.trials, args.seeds, args.load_multipliers))
+    sac_agent = SACActor.load(args.best_model)
+    n_job_rows = {experiment: get_n_job_rows(experiment, sac_agent) for experiment in ["standard", "minimum", "full"]}
+    done = read_done_jobs(args.output, n_job_rows)
+    pending = [job for job in jobs if get_job_key(dict(zip(job_columns, job))) not in done]
+    print("{} jobs, {} already done, running {}".format(len(jobs), len(jobs) - len(pending), len(pending)))
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    write_header = not os.path.exists(args.output) or os.path.getsize(args.output) == 0
+    SEStore() # Packs the SE store once before the workers open it
+    with open(args.output, "a", newline="") as f, multiprocessing.Pool(
+        processes=args.workers,
+        initializer=init_worker,
+        initargs=(args.best_model,),
+    ) as pool:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        if write_header:
+            writer.writeheader()
+        for rows in tqdm(pool.imap_unordered(run_job_star, [(job, args.TTIs) for job in pending]), total=len(pending), desc="Jobs"):
+            writer.writerows(rows) # Flushed after each job so an interrupted sweep can resume
+            f.flush()
+    print("Results saved in {}".format(args.output))
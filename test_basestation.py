@@ -0,0 +1,17 @@
+import pytest
+
+from test_snapshot import create_simulation, run_ttis, get_tails
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+@pytest.mark.parametrize("per_user_rng", [False, True])
+def test_reseed(engine: str, per_user_rng: bool) -> None: # Same arrivals as basestations created with the new seeds
+    reference = create_simulation(engine, seeds=(5, 6), per_user_rng=per_user_rng)
+    sim = create_simulation(engine, seeds=(1, 2), per_user_rng=per_user_rng)
+    for bs, seed in zip(sim.basestations.values(), [5, 6]):
+        bs.reseed(seed)
+    run_ttis(reference, 100)
+    run_ttis(sim, 100)
+    assert get_tails(sim, 100) == get_tails(reference, 100)
+    original = create_simulation(engine, seeds=(1, 2), per_user_rng=per_user_rng)
+    run_ttis(original, 100)
+    assert get_tails(sim, 100) != get_tails(original, 100)
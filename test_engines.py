@@ -0,0 +1,207 @@
+import numpy as np
+import pytest
+from typing import Dict, List
+
+from simulation.buffer import DiscreteBuffer, BufferConfiguration
+from simulation.history import HistoryConfiguration
+from simulation.simulation import Simulation
+from simulation import intersched
+from test_snapshot import create_simulation, run_ttis, get_tails
+
+# Low SE, so the buffers fill and packets expire
+overload_SE = np.random.default_rng(3).uniform(0.01, 0.3, size=(10, 1000))
+
+class BaselineBuffer: # The list-shifting DiscreteBuffer the ring buffer and the pool engine replaced
+    def __init__(self, TTI: float, config: BufferConfiguration) -> None:
+        self.TTI = TTI
+        self.max_lat = config.max_lat
+        self.buffer_size = config.buffer_size
+        self.pkt_size = config.pkt_size
+        self.step = 0
+        self.buff = [0]*self.max_lat
+        self.sent = [0]*self.max_lat
+        self.partial_pkt_bits = 0.0
+        self.hist_dropp_max_lat_pkts: List[int] = []
+        self.hist_dropp_buffer_full_pkts: List[int] = []
+        self.hist_arriv_pkts: List[int] = []
+        self.hist_sent_pkts: List[int] = []
+        self.hist_buff_pkts: List[int] = []
+
+    def arrive_pkts(self, n_pkts: int) -> None:
+        self.hist_buff_pkts.append(sum(self.buff))
+        self.hist_arriv_pkts.append(n_pkts)
+        dropped_pkts = 0
+        if n_pkts*self.pkt_size + sum(self.buff)*self.pkt_size > self.buffer_size:
+            dropped_bits = n_pkts*self.pkt_size + sum(self.buff)*self.pkt_size - self.buffer_size
+            dropped_pkts = int(np.ceil(dropped_bits/self.pkt_size))
+        self.hist_dropp_buffer_full_pkts.append(dropped_pkts)
+        self.buff[0] += n_pkts - dropped_pkts
+
+    def transmit(self, throughput: float) -> None:
+        n_bits = throughput*self.TTI + self.partial_pkt_bits
+        real_pkts = n_bits/self.pkt_size
+        int_pkts = int(real_pkts)
+        self.partial_pkt_bits = (real_pkts - int_pkts)*self.pkt_size
+        sent_pkts = 0
+        for i in reversed(range(self.max_lat)):
+            if int_pkts == 0:
+                break
+            elif self.buff[i] > int_pkts:
+                self.buff[i] -= int_pkts
+                self.sent[i] += int_pkts
+                sent_pkts += int_pkts
+                int_pkts = 0
+            else:
+                int_pkts -= self.buff[i]
+                self.sent[i] += self.buff[i]
+                sent_pkts += self.buff[i]
+                self.buff[i] = 0
+        self.hist_sent_pkts.append(sent_pkts)
+        self.hist_dropp_max_lat_pkts.append(self.buff[self.max_lat-1])
+        if self.buff[self.max_lat-1] > 0:
+            self.partial_pkt_bits = 0
+        for i in reversed(range(1, self.max_lat)):
+            self.buff[i] = self.buff[i-1]
+        self.buff[0] = 0
+        self.step += 1
+
+    def get_window(self, window: int) -> int:
+        return min(window, self.step + 1)
+
+    def get_arriv_thr(self, window: int) -> float:
+        window = self.get_window(window)
+        return sum(self.hist_arriv_pkts[-window:])*self.pkt_size/(window*self.TTI)
+
+    def get_sent_thr(self, window: int) -> float:
+        window = self.get_window(window)
+        return sum(self.hist_sent_pkts[-window:])*self.pkt_size/(window*self.TTI)
+
+    def get_dropp_pkts_bits(self, window: int) -> int:
+        window = self.get_window(window)
+        max_lat_bits = sum(self.hist_dropp_max_lat_pkts[-window:])*self.pkt_size if self.step >= self.max_lat else 0
+        return max_lat_bits + sum(self.hist_dropp_buffer_full_pkts[-window:])*self.pkt_size
+
+    def get_pkt_loss_rate(self, window: int) -> float:
+        window = self.get_window(window)
+        dropp = self.get_dropp_pkts_bits(window)
+        total = sum(self.hist_arriv_pkts[-window:])*self.pkt_size + self.hist_buff_pkts[self.step-window]*self.pkt_size
+        return 0 if total == 0 else dropp/total
+
+    def get_avg_buffer_latency(self) -> float:
+        sum_sent = sum(self.sent)
+        if sum_sent == 0:
+            return 0
+        return sum(self.sent[i]*i for i in range(self.max_lat))/sum_sent*self.TTI
+
+    def get_buffer_occupancy(self) -> float:
+        return sum(self.buff)*self.pkt_size/self.buffer_size
+
+def get_buffer_metrics(buff) -> Dict:
+    metrics = {
+        "buffer": list(buff.get_buffer_array()) if isinstance(buff, DiscreteBuffer) else list(buff.buff),
+        "latency": buff.get_avg_buffer_latency(),
+        "occupancy": buff.get_buffer_occupancy(),
+    }
+    for window in [1, 5, 10]:
+        metrics.update({
+            ("arriv_thr", window): buff.get_arriv_thr(window),
+            ("sent_thr", window): buff.get_sent_thr(window),
+            ("dropp_bits", window): buff.get_dropp_pkts_bits(window),
+            ("pkt_loss", window): buff.get_pkt_loss_rate(window),
+        })
+    return metrics
+
+def test_buffer_matches_baseline() -> None:
+    config = BufferConfiguration(max_lat=10, buffer_size=64*1500*8, pkt_size=1500*8)
+    buff = DiscreteBuffer(TTI=1e-3, config=config)
+    baseline = BaselineBuffer(TTI=1e-3, config=config)
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        n_pkts = int(rng.poisson(8))
+        buff.arrive_pkts(n_pkts)
+        baseline.arrive_pkts(n_pkts)
+        throughput = float(rng.uniform(0, 2*8*1500*8/1e-3))
+        buff.transmit(throughput)
+        baseline.transmit(throughput)
+        assert get_buffer_metrics(buff) == get_buffer_metrics(baseline)
+
+@pytest.mark.parametrize("per_user_rng", [False, True])
+def test_pool_engine_matches_object_engine(per_user_rng: bool) -> None:
+    sims = [create_simulation(engine, per_user_rng=per_user_rng, max_lat=20) for engine in ["object", "pool"]]
+    for sim in sims:
+        run_ttis(sim, 300, overload_SE)
+    assert get_tails(sims[0], 300) == get_tails(sims[1], 300)
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_engines_match_baseline_buffer(engine: str) -> None: # Replays each user's arrivals and throughputs
+    sim = create_simulation(engine, max_lat=20)
+    run_ttis(sim, 300, overload_SE)
+    for bs in sim.basestations.values():
+        for u in bs.users.values():
+            baseline = BaselineBuffer(TTI=sim.TTI, config=u.config.buff_config)
+            arriv_pkts = u.buff.get_full_history("hist_arriv_pkts")
+            throughputs = u.get_full_history("hist_allocated_throughput")
+            for n_pkts, throughput in zip(arriv_pkts, throughputs):
+                baseline.arrive_pkts(int(n_pkts))
+                baseline.transmit(float(throughput))
+            for name in u.buff.hist_names:
+                assert list(u.buff.get_full_history(name)) == getattr(baseline, name)
+            assert list(u.buff.get_buffer_array()) == baseline.buff
+
+def get_slice_min_rbs_loop(user_prior: List[int], ue_min_rbs: Dict[int, int]) -> int:
+    # Hands out one RBG at a time in the round-robin order until every user has its minimum
+    ue_alloc_rbs = {u_id: 0 for u_id in user_prior}
+    ue_offset = 0
+    while any(ue_alloc_rbs[u_id] < ue_min_rbs[u_id] for u_id in user_prior):
+        ue_alloc_rbs[user_prior[ue_offset]] += 1
+        ue_offset = (ue_offset + 1) % len(user_prior)
+    return sum(ue_alloc_rbs.values())
+
+def test_slice_min_rbs_matches_loop() -> None:
+    scheduler = intersched.StepwiseOptimalAlgorithm(rb_bandwidth=180e3, rbs_per_rbg=4, window_max=10)
+    rng = np.random.default_rng(0)
+    for _ in range(2000):
+        user_prior = [int(u) for u in rng.permutation(int(rng.integers(1, 8)))]
+        ue_min_rbs = {u_id: int(rng.integers(0, 7)) for u_id in user_prior}
+        assert scheduler._get_slice_min_rbs(user_prior, ue_min_rbs) == get_slice_min_rbs_loop(user_prior, ue_min_rbs)
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_min_ue_thrs_match_scalar(engine: str) -> None: # Batched SOA requirements against get_min_ue_thr
+    sim = create_simulation(engine, max_lat=20)
+    bs = sim.basestations[0]
+    scheduler: intersched.StepwiseOptimalAlgorithm = bs.scheduler
+    for _ in range(200):
+        for u in bs.users.values():
+            u.set_spectral_efficiency(float(overload_SE[u.id][u.step]))
+        bs.arrive_pkts()
+        state = scheduler.get_users_state(bs.slices, bs.users)
+        min_thrs = scheduler.get_min_ue_thrs(state)
+        assert list(min_thrs) == [scheduler.get_min_ue_thr(bs.users[id]) for id in state["ids"]]
+        bs.schedule_rbgs()
+        bs.transmit()
+
+def check_waited_at_least(sim: Simulation) -> None:
+    for bs in sim.basestations.values():
+        for u in bs.users.values():
+            max_lat = u.get_max_lat()
+            for i in range(-1, max_lat + 2):
+                ages = range(max(i, 0), max_lat)
+                assert u.get_n_buff_pkts_waited_at_least_i_TTIs(i) == sum(u.get_n_buff_pkts_waited_i_TTIs(j) for j in ages)
+        if bs.pool is not None:
+            for i in [0, 1, 5, 19, 20, 25]:
+                pooled = bs.pool.get_n_buff_pkts_waited_at_least_i_TTIs(np.full(bs.pool.n_users, i))
+                assert [pooled[u.index] for u in bs.users.values()] == [u.get_n_buff_pkts_waited_at_least_i_TTIs(i) for u in bs.users.values()]
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_waited_at_least_matches_sum(engine: str) -> None:
+    sim = create_simulation(engine, max_lat=20)
+    for _ in range(150):
+        run_ttis(sim, 1, overload_SE)
+        check_waited_at_least(sim)
+
+def test_retention_matches_full_history(tmp_path) -> None:
+    full = create_simulation("object", max_lat=20)
+    retained = create_simulation("object", max_lat=20, history_config=HistoryConfiguration(retention=20, spill_dir=str(tmp_path)))
+    for sim in [full, retained]:
+        run_ttis(sim, 300, overload_SE)
+    assert get_tails(retained, 300) == get_tails(full, 300)
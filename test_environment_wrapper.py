@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("gymnasium")
+pytest.importorskip("stable_baselines3")
+
+from simulation.environment_wrapper import Env, BatchEnv, SharedMemoryVecEnv
+from simulation.simulation import Simulation
+from simulation.slice import SliceConfiguration
+from simulation.user import UserConfiguration
+from simulation import intersched, intrasched
+
+max_number_steps = 40 # Short episodes, so the automatic resets are checked too
+
+def create_env(store_file: str, engine: str) -> Env:
+    sim = Simulation(option_5g=0, rbs_per_rbg=4, experiment_name="test")
+    bs_id = sim.add_basestation(intersched.DummyScheduler(), 100e6, 4, "DRL", 10, seed=1, engine=engine)
+    slice_configs = [
+        ("eMBB", {"latency": 20, "throughput": 10e6, "pkt_loss": 0.2}, 1500*8, 15e6, 3),
+        ("URLLC", {"latency": 1, "throughput": 1e6, "pkt_loss": 1e-5}, 500*8, 1e6, 3),
+        ("BE", {"long_term_thr": 5e6, "fifth_perc_thr": 2e6}, 1500*8, 15e6, 4),
+    ]
+    for type, requirements, pkt_size, flow_throughput, n_users in slice_configs:
+        user_config = UserConfiguration(max_lat=100, buffer_size=32*1024*8, pkt_size=pkt_size, flow_type="poisson", flow_throughput=flow_throughput)
+        slice_id = sim.add_slice(bs_id, SliceConfiguration(type, requirements, user_config), intrasched.RoundRobin())
+        sim.add_users(bs_id, slice_id, n_users)
+    return Env(
+        bs=sim.basestations[bs_id],
+        max_number_steps=max_number_steps,
+        SE_multipliers={},
+        SE_file_base_string="",
+        trials=[1, 2, 3, 4],
+        window_max=10,
+        TTI=sim.TTI,
+        SE_store_file=store_file,
+    )
+
+@pytest.fixture
+def store_file(tmp_path) -> str:
+    store_file = str(tmp_path / "se_store.npy")
+    np.save(store_file, np.random.default_rng(0).uniform(0.1, 3.0, size=(4, 2, 10, 100)))
+    return store_file
+
+def run_independent_envs(envs: list, actions: np.ndarray) -> list: # Steps each Env like DummyVecEnv
+    steps = [(np.array([env.reset()[0] for env in envs], dtype=np.float32), None, None, None)]
+    for action in actions:
+        obs, rewards, dones, terminal_obs = [], [], [], []
+        for env, a in zip(envs, action):
+            o, r, done, _, _ = env.step(a)
+            terminal_obs.append(o if done else None)
+            if done:
+                o, _ = env.reset()
+            obs.append(o)
+            rewards.append(r)
+            dones.append(done)
+        steps.append((np.array(obs, dtype=np.float32), np.array(rewards, dtype=np.float32), dones, terminal_obs))
+    return steps
+
+def check_vec_env(vec_env, steps: list, actions: np.ndarray) -> None:
+    assert np.array_equal(vec_env.reset(), steps[0][0])
+    for action, (obs, rewards, dones, terminal_obs) in zip(actions, steps[1:]):
+        vec_obs, vec_rewards, vec_dones, infos = vec_env.step(action)
+        assert np.array_equal(vec_obs, obs)
+        assert np.array_equal(vec_rewards.astype(np.float32), rewards)
+        assert list(vec_dones) == dones
+        for info, o in zip(infos, terminal_obs):
+            if o is not None:
+                assert np.array_equal(np.asarray(info["terminal_observation"], dtype=np.float32), o.astype(np.float32))
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_batch_env_matches_envs(store_file: str, engine: str) -> None:
+    actions = np.random.default_rng(1).uniform(-1, 1, size=(100, 2, 3)).astype(np.float32)
+    steps = run_independent_envs(create_env(store_file, engine).split(2, seed=7), actions)
+    vec_env = BatchEnv(create_env(store_file, engine).split(2, seed=7))
+    check_vec_env(vec_env, steps, actions)
+    vec_env.close()
+
+def test_shared_memory_vec_env_matches_envs(store_file: str) -> None:
+    actions = np.random.default_rng(1).uniform(-1, 1, size=(100, 2, 3)).astype(np.float32)
+    steps = run_independent_envs(create_env(store_file, "object").split(2, seed=7), actions)
+    vec_env = SharedMemoryVecEnv(create_env(store_file, "object").split(2, seed=7))
+    try:
+        check_vec_env(vec_env, steps, actions)
+    finally:
+        vec_env.close()
+    assert not any(process.is_alive() for process in vec_env.processes)
+    vec_env.close() # Closing again does nothing
+
+def test_shared_memory_vec_env_closes_during_step(store_file: str) -> None:
+    vec_env = SharedMemoryVecEnv(create_env(store_file, "object").split(2, seed=7))
+    vec_env.reset()
+    vec_env.step_async(np.zeros((2, 3), dtype=np.float32))
+    vec_env.close()
+    assert not any(process.is_alive() for process in vec_env.processes)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from simulation.flow import Flow, FlowConfiguration
+
+@pytest.mark.parametrize("block_size", [1, 16])
+@pytest.mark.parametrize("rates,transitions", [
+    ([1.0], [[1.0]]),
+    ([0.5, 2.0], [[0.9, 0.1], [0.0, 1.0]]), # State 1 is absorbing
+])
+def test_mmpp_absorbing_state(block_size: int, rates: list, transitions: list) -> None:
+    flow = Flow(
+        TTI=1e-3,
+        config=FlowConfiguration(
+            type="mmpp",
+            pkt_size=1500*8,
+            throughput=15e6,
+            block_size=block_size,
+            mmpp_rates=rates,
+            mmpp_transitions=transitions,
+        ),
+        rng=np.random.default_rng(1),
+    )
+    pkts = [flow.generate_pkts() for _ in range(1000)]
+    assert all(p >= 0 for p in pkts)
+    assert flow.state == len(rates) - 1 # Reached the absorbing state and never left it
+
+def get_mmpp_flow(block_size: int) -> Flow:
+    return Flow(
+        TTI=1e-3,
+        config=FlowConfiguration(
+            type="on_off",
+            pkt_size=1500*8,
+            throughput=15e6,
+            block_size=block_size,
+            on_ttis=20,
+            off_ttis=20,
+        ),
+        rng=np.random.default_rng(1),
+    )
+
+def test_set_throughput_keeps_mmpp_states() -> None:
+    flow = get_mmpp_flow(block_size=1000)
+    for _ in range(10):
+        flow.generate_pkts()
+    states = flow.block_states.copy()
+    state, state_ttis = flow.state, flow.state_ttis
+    flow.set_throughput(30e6)
+    assert np.array_equal(flow.block_states, states)
+    assert (flow.state, flow.state_ttis) == (state, state_ttis)
+    for _ in range(990):
+        flow.generate_pkts()
+    assert np.array_equal(flow.block[10:] == 0, states[10:] == 1) # No arrivals only in the off state
+
+def test_set_throughput_keeps_sojourn_lengths() -> None:
+    flow = get_mmpp_flow(block_size=16)
+    states = []
+    for _ in range(20000):
+        flow.set_throughput(15e6) # Every TTI, as when the load changes often
+        flow.generate_pkts()
+        states.append(flow.block_states[flow.block_index-1])
+    n_sojourns = 1 + np.count_nonzero(np.diff(states))
+    assert 15 < len(states)/n_sojourns < 25 # Mean of 20 TTIs in each state
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from simulation.latency import LatencyHistogram
+from test_snapshot import create_simulation, run_ttis
+
+values = np.random.default_rng(0).lognormal(mean=12, sigma=1.5, size=5000).astype(np.int64) # ns
+
+@pytest.mark.parametrize("q", [0.1, 50, 90, 99, 99.9, 100])
+def test_percentile_within_bucket_precision(q: float) -> None:
+    hist = LatencyHistogram()
+    hist.record_many(values)
+    exact = np.sort(values)[max(1, int(np.ceil(q/100*len(values)))) - 1] # Nearest rank
+    assert abs(hist.get_percentile(q) - exact) <= exact*2**-hist.significant_bits
+
+def test_small_values_are_exact() -> None:
+    hist = LatencyHistogram()
+    hist.record_many(np.arange(1, 101))
+    assert [hist.get_percentile(q) for q in [1, 50, 99, 100]] == [1, 50, 99, 100]
+
+def test_deadline_misses() -> None:
+    hist = LatencyHistogram(deadline=1e-3)
+    hist.record_many([999_999, 1_000_000, 1_000_001, 5_000_000])
+    hist.record(2_000_000)
+    assert hist.deadline_misses == 3
+    assert hist.get_summary()["deadline_miss_ratio"] == 3/5
+
+def test_record_matches_record_many() -> None:
+    single, batched = LatencyHistogram(deadline=1e-3), LatencyHistogram(deadline=1e-3)
+    for ns in values:
+        single.record(ns)
+    batched.record_many(values)
+    assert list(single.counts) == list(batched.counts)
+    assert single.get_state() == batched.get_state()
+
+def test_merge_matches_single_histogram() -> None:
+    whole, first, second = LatencyHistogram(deadline=1e-3), LatencyHistogram(deadline=1e-3), LatencyHistogram(deadline=1e-3)
+    whole.record_many(values)
+    first.record_many(values[:2000])
+    second.record_many(values[2000:])
+    first.add(second)
+    assert list(first.counts) == list(whole.counts)
+    assert first.get_state() == whole.get_state()
+
+def test_scheduler_times_are_opt_in() -> None:
+    sim = create_simulation("object")
+    run_ttis(sim, 20)
+    for bs in sim.basestations.values():
+        assert bs.scheduler_elapsed_time == []
+        assert bs.scheduler_latency.count == 20
+        bs.record_scheduler_times = True
+    run_ttis(sim, 10)
+    for bs in sim.basestations.values():
+        assert len(bs.scheduler_elapsed_time) == 10
+        assert bs.scheduler_latency.count == 30
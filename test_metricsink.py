@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from simulation.metricsink import MetricsSink, read_metrics
+from simulation.user import User
+from test_snapshot import create_simulation, run_ttis
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_read_metrics_matches_histories(engine: str, tmp_path) -> None:
+    path = str(tmp_path / "metrics.bin")
+    sim = create_simulation(engine)
+    run_ttis(sim, 50) # Entries recorded before the sink was set are pushed by set_metrics_sink
+    sink = MetricsSink(path, chunk_size=64)
+    sim.set_metrics_sink(sink)
+    run_ttis(sim, 250)
+    sink.close()
+    metrics = read_metrics(path)
+    for bs_id, bs in sim.basestations.items():
+        for name in ["hist_n_allocated_RBGs", "hist_agent_reward"]:
+            assert list(metrics["bs{}/{}".format(bs_id, name)]) == list(getattr(bs, name))
+        for slice_id, s in bs.slices.items():
+            prefix = "bs{}/slice{}/".format(bs_id, slice_id)
+            for name in ["hist_n_allocated_RBGs", "hist_allocated_throughput"]:
+                assert list(metrics[prefix + name]) == list(getattr(s, name))
+            for user_id, u in s.users.items():
+                for name in User.hist_names:
+                    column = metrics[prefix + "user{}/{}".format(user_id, name)]
+                    assert list(column) == list(np.asarray(u.get_full_history(name), dtype=np.float64))
+
+def test_full_chunks_reach_disk_before_close(tmp_path) -> None:
+    path = str(tmp_path / "metrics.bin")
+    sink = MetricsSink(path, chunk_size=4)
+    for i in range(10):
+        sink.push("a", i)
+    sink.queue.join() # Waits for the writer thread, without flushing the partial chunk
+    assert list(read_metrics(path)["a"]) == list(range(8))
+    sink.close()
+    assert list(read_metrics(path)["a"]) == list(range(10))
@@ -0,0 +1,51 @@
+import os
+import numpy as np
+
+from simulation.sacactor import SACActor
+
+best_model_zip_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "best_sac", "best_model.zip")
+golden_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "best_sac", "golden_predictions.npz")
+
+def test_batched_predictions_match_stable_baselines3() -> None:
+    golden = np.load(golden_path)
+    actions, _ = SACActor.load(best_model_zip_path).predict(golden["obs"], deterministic=True)
+    assert actions.dtype == np.float32 and actions.shape == golden["actions"].shape
+    np.testing.assert_allclose(actions, golden["actions"], rtol=1e-5, atol=1e-6)
+
+def test_single_predictions_match_stable_baselines3() -> None: # One observation per call, as SAC.schedule does
+    golden = np.load(golden_path)
+    actor = SACActor.load(best_model_zip_path)
+    for obs, expected in zip(golden["obs"], golden["actions"]):
+        action, _ = actor.predict(obs, deterministic=True)
+        assert action.shape == expected.shape
+        np.testing.assert_allclose(action, expected, rtol=1e-5, atol=1e-6)
+
+class RecordingAgent: # Keeps the observations of a DRL simulation and the actions of stable_baselines3
+    def __init__(self, agent) -> None:
+        self.agent = agent
+        self.obs = []
+        self.actions = []
+
+    def predict(self, obs: np.ndarray, deterministic: bool = True):
+        action, state = self.agent.predict(obs, deterministic=deterministic)
+        self.obs.append(np.array(obs))
+        self.actions.append(np.array(action))
+        return action, state
+
+if __name__ == "__main__": # Regenerates the golden predictions (needs stable_baselines3 and torch)
+    import stable_baselines3
+    from benchmark import create_benchmark_simulation, get_synthetic_se, run_ttis
+
+    agent = RecordingAgent(stable_baselines3.SAC.load(best_model_zip_path, None, verbose=0, device="cpu"))
+    for users_per_slice, TTIs in [(1, 50), (5, 50), (20, 50)]: # From idle to overloaded slices
+        sim, bs_id = create_benchmark_simulation("DRL", "object", users_per_slice, 3, 100, 10, 100e6, sac_agent=agent)
+        SEs = get_synthetic_se(len(sim.basestations[bs_id].users), TTIs)
+        run_ttis(sim, bs_id, SEs, TTIs)
+    # The raw observations saturate tanh, so scaled-down and random ones check the rest of the range
+    rng = np.random.default_rng(0)
+    simulated = np.array(agent.obs)
+    scaled = simulated[rng.integers(len(simulated), size=100)]*10.0**rng.uniform(-8, -5, size=(100, 1))
+    for obs in np.concatenate([scaled, rng.normal(size=(100, simulated.shape[1]))]):
+        agent.predict(obs, deterministic=True)
+    np.savez(golden_path, obs=np.array(agent.obs), actions=np.array(agent.actions, dtype=np.float32))
+    print("Saved {} observations in {}".format(len(agent.obs), golden_path))
@@ -0,0 +1,22 @@
+import os
+import stat
+import numpy as np
+
+from simulation.sestore import SEStore
+
+def test_pack(tmp_path) -> None:
+    rng = np.random.default_rng(0)
+    se_file_base_string = str(tmp_path / "trial{}_f{}_ue{}.npy")
+    for trial in range(1, 3):
+        for sub_carrier in range(1, 3):
+            for ue in range(1, 4):
+                np.save(se_file_base_string.format(trial, sub_carrier, ue), rng.uniform(size=50))
+    store_file = str(tmp_path / "se_store.npy")
+    umask = os.umask(0o022)
+    try:
+        store = SEStore(store_file=store_file, se_file_base_string=se_file_base_string, n_trials=2, n_ues=3)
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(store_file).st_mode) == 0o644 # Readable by other users
+    assert os.listdir(tmp_path).count("se_store.npy") == 1 and not any(".tmp" in f for f in os.listdir(tmp_path))
+    assert np.array_equal(store.se[1, 0, 2], np.load(se_file_base_string.format(2, 1, 3)))
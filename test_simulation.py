@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from simulation.sestore import SETrial
+from test_snapshot import SE, create_simulation, run_ttis, get_tails
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_run_parallel_matches_serial(engine: str) -> None:
+    serial = create_simulation(engine)
+    run_ttis(serial, 200)
+    parallel = create_simulation(engine)
+    parallel.run_parallel(TTIs=200, SEs=SETrial(se=SE, multipliers=np.ones(SE.shape[0])))
+    assert parallel.step == serial.step
+    assert get_tails(parallel, 200) == get_tails(serial, 200)
+
+def test_run_parallel_with_limiting_basestation() -> None: # As in the minimum experiment
+    serial = create_simulation("object")
+    for _ in range(200):
+        for bs in serial.basestations.values():
+            for u in bs.users.values():
+                u.set_spectral_efficiency(float(SE[u.id][u.step]))
+        serial.arrive_packets()
+        serial.basestations[0].schedule_rbgs()
+        n_lim_rbgs = sum(len(s.rbgs) for s in serial.basestations[0].slices.values())
+        serial.basestations[1].schedule_rbgs(n_rbgs=n_lim_rbgs)
+        serial.transmit()
+    parallel = create_simulation("object")
+    parallel.run_parallel(
+        TTIs=200,
+        SEs=SETrial(se=SE, multipliers=np.ones(SE.shape[0])),
+        limiting_basestation_id=0,
+    )
+    assert get_tails(parallel, 200) == get_tails(serial, 200)
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+
+from simulation.user import UserConfiguration, User
+from simulation.slice import SliceConfiguration
+from simulation.simulation import Simulation
+from simulation.history import HistoryConfiguration
+from simulation import intersched, intrasched
+
+SE = np.random.default_rng(0).uniform(0.1, 3.0, size=(10, 1000))
+
+def create_simulation(
+    engine: str,
+    seeds: tuple = (1, 2),
+    per_user_rng: bool = False,
+    history_config: HistoryConfiguration = None,
+    max_lat: int = 100, # TTIs
+) -> Simulation:
+    def user_config(flow_throughput: float, pkt_size: int) -> UserConfiguration:
+        return UserConfiguration(
+            max_lat=max_lat,
+            buffer_size=32*1024*8,
+            pkt_size=pkt_size,
+            flow_type="poisson",
+            flow_throughput=flow_throughput,
+        )
+    slice_configs = [
+        (SliceConfiguration("eMBB", {"latency": 20, "throughput": 10e6, "pkt_loss": 0.2}, user_config(15e6, 1500*8)), 3),
+        (SliceConfiguration("URLLC", {"latency": 1, "throughput": 1e6, "pkt_loss": 1e-5}, user_config(1e6, 500*8)), 3),
+        (SliceConfiguration("BE", {"long_term_thr": 5e6, "fifth_perc_thr": 2e6}, user_config(15e6, 1500*8)), 4),
+    ]
+    sim = Simulation(option_5g=0, rbs_per_rbg=4, experiment_name="test")
+    bs_ids = [
+        sim.add_basestation(intersched.StepwiseOptimalAlgorithm(sim.rb_bandwidth, 4, 10), 100e6, 4, "SOA", 10, seed=seeds[0], engine=engine, per_user_rng=per_user_rng, history_config=history_config),
+        sim.add_basestation(intersched.RoundRobin(), 100e6, 4, "RR", 10, seed=seeds[1], engine=engine, per_user_rng=per_user_rng, history_config=history_config),
+    ]
+    for bs_id in bs_ids:
+        for slice_config, n_users in slice_configs:
+            slice_id = sim.add_slice(bs_id, slice_config, intrasched.RoundRobin())
+            sim.add_users(bs_id, slice_id, n_users)
+    return sim
+
+def run_ttis(sim: Simulation, TTIs: int, SEs: np.ndarray = SE) -> None:
+    for _ in range(TTIs):
+        for bs in sim.basestations.values():
+            for u in bs.users.values():
+                u.set_spectral_efficiency(float(SEs[u.id][u.step]))
+        sim.arrive_packets()
+        sim.schedule_rbgs()
+        sim.transmit()
+
+def get_tails(sim: Simulation, n: int) -> dict: # Last n TTIs of every history
+    tails = {}
+    for bs_id, bs in sim.basestations.items():
+        for name in ["hist_n_allocated_RBGs", "hist_agent_reward"]:
+            tails[(bs_id, name)] = list(getattr(bs, name)[-n:])
+        for slice_id, s in bs.slices.items():
+            for name in s.hist_names:
+                tails[(bs_id, slice_id, name)] = list(getattr(s, name)[-n:])
+            for user_id, u in s.users.items():
+                for name in User.hist_names:
+                    tails[(bs_id, user_id, name)] = list(np.asarray(u.get_full_history(name))[-n:])
+                for name in u.buff.hist_names:
+                    tails[(bs_id, user_id, "buff", name)] = list(np.asarray(u.buff.get_full_history(name))[-n:])
+    return tails
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_snapshot_round_trip(engine: str) -> None:
+    reference = create_simulation(engine)
+    run_ttis(reference, 300)
+    snapshot = reference.snapshot()
+    run_ttis(reference, 200)
+
+    sim = create_simulation(engine)
+    sim.restore(snapshot)
+    run_ttis(sim, 200)
+    assert sim.step == reference.step
+    assert get_tails(sim, 200) == get_tails(reference, 200)
+
+@pytest.mark.parametrize("engine", ["object", "pool"])
+def test_chained_snapshots(engine: str) -> None: # Snapshots a simulation that was itself restored
+    reference = create_simulation(engine)
+    run_ttis(reference, 500)
+
+    first = create_simulation(engine)
+    run_ttis(first, 300)
+    second = create_simulation(engine)
+    second.restore(first.snapshot())
+    run_ttis(second, 100)
+    third = create_simulation(engine)
+    third.restore(second.snapshot())
+    run_ttis(third, 100)
+    assert third.step == reference.step
+    assert get_tails(third, 100) == get_tails(reference, 100)
@@ -0,0 +1,39 @@
+import csv
+
+from sweep import columns, read_done_jobs
+
+n_job_rows = {"standard": 2}
+
+def write_rows(results_file: str, rows: list) -> None:
+    with open(results_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+def get_row(trial: int, basestation: int, slice: str) -> dict:
+    row = {c: 0 for c in columns}
+    row.update({"experiment": "standard", "trial": trial, "seed": 1, "load_multiplier": 1.0, "basestation": basestation, "slice": slice})
+    return row
+
+def read_rows(results_file: str) -> list:
+    with open(results_file, newline="") as f:
+        return list(csv.DictReader(f))
+
+def test_truncated_last_line(tmp_path) -> None:
+    results_file = str(tmp_path / "results.csv")
+    write_rows(results_file, [get_row(1, 0, "eMBB"), get_row(1, 0, "URLLC"), get_row(2, 0, "eMBB")])
+    with open(results_file, "a") as f:
+        f.write("standard,2,1,1.0,0,URL") # Interrupted while writing the second row of trial 2
+    assert read_done_jobs(results_file, n_job_rows) == {("standard", 1, 1, 1.0)}
+    rows = read_rows(results_file)
+    assert [(r["trial"], r["slice"]) for r in rows] == [("1", "eMBB"), ("1", "URLLC")]
+
+def test_partially_written_job(tmp_path) -> None:
+    results_file = str(tmp_path / "results.csv")
+    write_rows(results_file, [get_row(2, 0, "eMBB"), get_row(1, 0, "eMBB"), get_row(1, 0, "URLLC")])
+    assert read_done_jobs(results_file, n_job_rows) == {("standard", 1, 1, 1.0)}
+    assert [r["trial"] for r in read_rows(results_file)] == ["1", "1"]
+    assert read_done_jobs(results_file, n_job_rows) == {("standard", 1, 1, 1.0)}
+
+def test_missing_file(tmp_path) -> None:
+    assert read_done_jobs(str(tmp_path / "results.csv"), n_job_rows) == set()
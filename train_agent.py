@@ -138,7 +138,7 @@ if __name__ == "__main__":
         bs=bs,
         max_number_steps=2000,
         SE_multipliers=SE_multipliers,
-        SE_file_base_string="se/trial{}_f2_ue{}.npy",
+        SE_file_base_string="se/trial{}_f{}_ue{}.npy",
         trials=trials,
         window_max=10,
         TTI=sim.TTI,